@@ -10,6 +10,12 @@ if [ $? -eq 0 ];then
     python manage.py loaddata basededatosfinal
     #python manage.py loaddata init_with_files
     #python manage.py loaddata fixtures/initial_data.json
+    echo "Recalculando contadores de los proyectos..."
+    python manage.py rebuild_project_counters
+    echo "Generando resumenes del burndown..."
+    python manage.py rebuild_burndown
+    echo "Moviendo adjuntos al almacen de adjuntos..."
+    python manage.py migrate_attachments
     echo "Creando versiones iniciales..."
     #python manage.py createinitialrevisions
     echo "Ejecutando pruebas..."
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""
+Generacion de graficos del lado del servidor para los reportes en PDF.
+
+El burndown chart se dibuja como SVG directamente en el proceso, sin depender del servidor de exportacion
+de Highcharts (PhantomJS). WeasyPrint embebe la imagen SVG sin pasos intermedios.
+"""
+import base64
+import hashlib
+import json
+import math
+import os
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.utils.html import escape
+import requests
+from requests.adapters import HTTPAdapter
+
+ANCHO = 700
+ALTO = 420
+MARGEN_IZQ = 80
+MARGEN_DER = 30
+MARGEN_SUP = 70
+MARGEN_INF = 80
+FUENTE = 'font-family="Helvetica, Arial, sans-serif"'
+#Mismos colores que usa Highcharts por defecto para las series
+COLORES = ('#7cb5ec', '#434348')
+
+
+def escala(maximo, divisiones=5):
+    """
+    Calcula un paso "redondo" para las marcas del eje Y.
+
+    :param maximo: mayor valor a mostrar
+    :param divisiones: cantidad aproximada de marcas
+    :return: tupla (paso, tope del eje)
+    """
+    if maximo <= 0:
+        return 1, divisiones
+    bruto = float(maximo) / divisiones
+    magnitud = 10 ** math.floor(math.log10(bruto))
+    for factor in (1, 2, 2.5, 5, 10):
+        paso = factor * magnitud
+        if paso >= bruto:
+            break
+    if paso == int(paso):
+        paso = int(paso)
+    tope = paso * int(math.ceil(float(maximo) / paso))
+    return paso, tope
+
+
+def formato(valor):
+    """
+    Formatea un numero para las etiquetas, sin decimales innecesarios.
+    """
+    return ('%.1f' % valor).rstrip('0').rstrip('.') if valor != int(valor) else '%d' % valor
+
+
+def burndown_svg(burndown, subtitulo, titulo='Burndown Chart'):
+    """
+    Dibuja el burndown chart de un sprint como SVG, con las series ideal y real.
+
+    :param burndown: diccionario con las series 'ideal' y 'real' del sprint
+    :param subtitulo: texto debajo del titulo, normalmente el nombre del sprint
+    :param titulo: titulo del grafico
+    :return: documento SVG como unicode
+    """
+    series = [('Ideal', burndown['ideal']), ('Real', burndown['real'])]
+    puntos = max(len(datos) for _, datos in series)
+    paso, tope = escala(max([0] + [v for _, datos in series for v in datos]))
+    ancho_graf = ANCHO - MARGEN_IZQ - MARGEN_DER
+    alto_graf = ALTO - MARGEN_SUP - MARGEN_INF
+    dx = float(ancho_graf) / max(puntos - 1, 1)
+
+    def x(i):
+        return MARGEN_IZQ + i * dx
+
+    def y(valor):
+        return MARGEN_SUP + alto_graf - float(valor) / tope * alto_graf
+
+    svg = [u'<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="%d" height="%d" viewBox="0 0 %d %d">'
+           % (ANCHO, ALTO, ANCHO, ALTO),
+           u'<rect x="0" y="0" width="%d" height="%d" fill="#ffffff"/>' % (ANCHO, ALTO),
+           u'<text x="%d" y="28" text-anchor="middle" font-size="18" fill="#333333" %s>%s</text>'
+           % (ANCHO / 2, FUENTE, escape(titulo)),
+           u'<text x="%d" y="50" text-anchor="middle" font-size="12" fill="#666666" %s>%s</text>'
+           % (ANCHO / 2, FUENTE, escape(subtitulo))]
+
+    #Eje Y: lineas de grilla y etiquetas
+    valor = 0
+    while valor <= tope:
+        svg.append(u'<line x1="%d" y1="%.1f" x2="%d" y2="%.1f" stroke="#d8d8d8" stroke-width="1"/>'
+                   % (MARGEN_IZQ, y(valor), ANCHO - MARGEN_DER, y(valor)))
+        svg.append(u'<text x="%d" y="%.1f" text-anchor="end" font-size="11" fill="#606060" %s>%s hs</text>'
+                   % (MARGEN_IZQ - 8, y(valor) + 4, FUENTE, formato(valor)))
+        valor += paso
+    svg.append(u'<text x="20" y="%d" text-anchor="middle" font-size="12" fill="#606060" %s '
+               u'transform="rotate(-90 20 %d)">Esfuerzo Restante</text>'
+               % (MARGEN_SUP + alto_graf / 2, FUENTE, MARGEN_SUP + alto_graf / 2))
+
+    #Eje X: una etiqueta por dia, salteando si hay demasiados
+    salto = int(math.ceil(puntos / 15.0)) or 1
+    base = MARGEN_SUP + alto_graf
+    svg.append(u'<line x1="%d" y1="%d" x2="%d" y2="%d" stroke="#c0d0e0" stroke-width="1"/>'
+               % (MARGEN_IZQ, base, ANCHO - MARGEN_DER, base))
+    for i in range(0, puntos, salto):
+        svg.append(u'<text x="%.1f" y="%d" text-anchor="middle" font-size="11" fill="#606060" %s>Dia %d</text>'
+                   % (x(i), base + 18, FUENTE, i))
+
+    #Series
+    for (nombre, datos), color in zip(series, COLORES):
+        coordenadas = u' '.join(u'%.1f,%.1f' % (x(i), y(v)) for i, v in enumerate(datos))
+        svg.append(u'<polyline points="%s" fill="none" stroke="%s" stroke-width="2"/>' % (coordenadas, color))
+        for i, v in enumerate(datos):
+            svg.append(u'<circle cx="%.1f" cy="%.1f" r="3" fill="%s"/>' % (x(i), y(v), color))
+
+    #Leyenda
+    leyenda_x = ANCHO / 2 - 80
+    for n, ((nombre, _), color) in enumerate(zip(series, COLORES)):
+        lx = leyenda_x + n * 100
+        svg.append(u'<line x1="%d" y1="%d" x2="%d" y2="%d" stroke="%s" stroke-width="2"/>'
+                   % (lx, ALTO - 25, lx + 16, ALTO - 25, color))
+        svg.append(u'<circle cx="%d" cy="%d" r="3" fill="%s"/>' % (lx + 8, ALTO - 25, color))
+        svg.append(u'<text x="%d" y="%d" font-size="12" fill="#333333" %s>%s</text>'
+                   % (lx + 22, ALTO - 21, FUENTE, nombre))
+    svg.append(u'</svg>')
+    return u'\n'.join(svg)
+
+
+def highcharts_infile(burndown, subtitulo):
+    """
+    Arma la configuracion de Highcharts que recibe el servidor de exportacion.
+
+    :param burndown: diccionario con las series 'ideal' y 'real' del sprint
+    :param subtitulo: nombre del sprint
+    :return: configuracion del grafico como texto
+    """
+    title = "credits: false, title: {text:'Burndown Chart'}, subtitle: {text: '%s'}" % subtitulo
+    xAxis = "xAxis: {labels: {format: 'Dia {value}'}}"
+    yAxis = "yAxis: { title: {text: 'Esfuerzo Restante'}, min: 0, labels: {format: '{value} hs'}}"
+    series = "series:[{name: 'Ideal', data: %s}, {name: 'Real', data: %s}]" % (burndown['ideal'], burndown['real'], )
+    return "{ %s }" % ",".join([title, xAxis, yAxis, series])
+
+
+_sesion = None
+_sesion_lock = threading.Lock()
+
+
+def get_sesion():
+    """
+    Sesion HTTP compartida para el servidor de exportacion. Mantiene abiertas tantas conexiones como
+    exportaciones concurrentes se permiten, para no abrir una conexion TCP nueva por grafico.
+
+    :return: sesion de requests
+    """
+    global _sesion
+    with _sesion_lock:
+        if _sesion is None:
+            workers = getattr(settings, 'HIGHCHARTS_EXPORT_WORKERS', 4)
+            sesion = requests.Session()
+            sesion.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+            sesion.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+            _sesion = sesion
+        return _sesion
+
+
+def exportar_highcharts(infile, url, timeout=5, sesion=None):
+    """
+    Envia la configuracion al servidor de exportacion de Highcharts.
+
+    :param infile: configuracion del grafico
+    :param url: direccion del servidor de exportacion
+    :param timeout: tiempo maximo de espera en segundos
+    :param sesion: sesion HTTP a usar, por defecto la sesion compartida
+    :return: imagen PNG codificada en base64, tal como la devuelve el servidor
+    """
+    sesion = sesion or get_sesion()
+    r = sesion.post(url, data=json.dumps({'infile': infile}), headers={'Content-Type': 'application/json'},
+                    timeout=timeout)
+    r.raise_for_status()
+    return r.content
+
+
+def svg_base64(svg):
+    """
+    Codifica un SVG en base64 para embeberlo con un data URI.
+    """
+    return base64.b64encode(svg.encode('utf-8'))
+
+
+class CacheGraficos(object):
+    """
+    Cache en disco de los graficos generados, direccionada por contenido: la clave es el hash de la
+    configuracion del grafico, por lo que un grafico identico (por ejemplo el de un sprint cerrado) no se
+    vuelve a generar. Cuando el directorio supera CHART_CACHE_MAX_BYTES se eliminan los graficos usados
+    hace mas tiempo (LRU segun la fecha de modificacion, que se actualiza en cada acierto).
+
+    Los contadores de aciertos, fallos y desalojos son del proceso actual. El tamano total se lee del
+    directorio la primera vez y luego se lleva en memoria; el directorio solo se vuelve a recorrer al
+    desalojar. La cache es opcional: si no se puede escribir un grafico, se sigue sin guardarlo.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        self._total = None  # tupla (directorio, bytes) del tamano conocido de la cache
+
+    @property
+    def directorio(self):
+        return getattr(settings, 'CHART_CACHE_DIR', None)
+
+    @staticmethod
+    def clave(renderer, infile):
+        """
+        Calcula la clave de un grafico.
+
+        :param renderer: renderizador con el que se genera
+        :param infile: configuracion del grafico
+        :return: hash sha256 en hexadecimal
+        """
+        return hashlib.sha256(('%s\n%s' % (renderer, infile)).encode('utf-8')).hexdigest()
+
+    def ruta(self, clave):
+        return os.path.join(self.directorio, clave)
+
+    def get(self, clave):
+        """
+        Obtiene un grafico de la cache.
+
+        :param clave: clave del grafico
+        :return: el grafico como data URI o None si no esta en la cache
+        """
+        if not self.directorio:
+            return None
+        try:
+            with open(self.ruta(clave), 'rb') as f:
+                grafico = f.read()
+            os.utime(self.ruta(clave), None)
+        except (IOError, OSError):
+            grafico = None
+        with self.lock:
+            if grafico is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return grafico
+
+    def set(self, clave, grafico):
+        """
+        Guarda un grafico en la cache y desaloja los menos usados si se supera el tamano maximo. Los
+        errores al escribir (disco lleno, permisos) se ignoran.
+
+        :param clave: clave del grafico
+        :param grafico: el grafico como data URI
+        """
+        if not self.directorio:
+            return
+        temporal = None
+        try:
+            if not os.path.isdir(self.directorio):
+                os.makedirs(self.directorio)
+            total = self.tamano_total()
+            try:
+                total -= os.path.getsize(self.ruta(clave))
+            except OSError:
+                pass
+            #Se escribe en un archivo temporal y se renombra para que nunca se lea un grafico a medio escribir
+            fd, temporal = tempfile.mkstemp(dir=self.directorio, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(grafico)
+            os.rename(temporal, self.ruta(clave))
+            temporal = None
+        except (IOError, OSError):
+            if temporal:
+                try:
+                    os.remove(temporal)
+                except OSError:
+                    pass
+            return
+        total += len(grafico)
+        with self.lock:
+            self._total = (self.directorio, total)
+        if total > getattr(settings, 'CHART_CACHE_MAX_BYTES', 50 * 1024 * 1024):
+            self.desalojar()
+
+    def tamano_total(self):
+        """
+        :return: bytes ocupados por la cache, recorriendo el directorio solo si todavia no se conocen
+        """
+        with self.lock:
+            if self._total is not None and self._total[0] == self.directorio:
+                return self._total[1]
+        total = sum(e[1] for e in self.entradas())
+        with self.lock:
+            self._total = (self.directorio, total)
+        return total
+
+    def entradas(self):
+        """
+        :return: lista de (fecha de ultimo uso, tamano, ruta) de los graficos en la cache
+        """
+        entradas = []
+        for nombre in os.listdir(self.directorio):
+            if nombre.startswith('.tmp'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directorio, nombre))
+            except OSError:
+                continue
+            entradas.append((st.st_mtime, st.st_size, os.path.join(self.directorio, nombre)))
+        return entradas
+
+    def desalojar(self):
+        """
+        Elimina los graficos usados hace mas tiempo hasta que la cache no supere el tamano maximo. Se
+        recorre el directorio, lo que ademas corrige el tamano total si otros procesos escribieron en el.
+        """
+        maximo = getattr(settings, 'CHART_CACHE_MAX_BYTES', 50 * 1024 * 1024)
+        entradas = sorted(self.entradas())
+        total = sum(e[1] for e in entradas)
+        for mtime, tamano, ruta in entradas:
+            if total <= maximo:
+                break
+            try:
+                os.remove(ruta)
+            except OSError:
+                continue
+            total -= tamano
+            with self.lock:
+                self.evictions += 1
+        with self.lock:
+            self._total = (self.directorio, total)
+
+    def limpiar(self):
+        """
+        Elimina todos los graficos de la cache.
+        """
+        if self.directorio and os.path.isdir(self.directorio):
+            for mtime, tamano, ruta in self.entradas():
+                os.remove(ruta)
+        with self.lock:
+            self._total = None
+
+    def stats(self):
+        """
+        :return: diccionario con los contadores y el contenido actual de la cache
+        """
+        entradas = self.entradas() if self.directorio and os.path.isdir(self.directorio) else []
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entradas': len(entradas), 'bytes': sum(e[1] for e in entradas)}
+
+
+cache_graficos = CacheGraficos()
+
+
+def grafico_burndown(burndown, subtitulo):
+    """
+    Genera el burndown chart de un sprint con el renderizador configurado en BURNDOWN_CHART_RENDERER.
+    Si el mismo grafico ya fue generado se obtiene de la cache, sin contactar al exportador.
+
+    :param burndown: diccionario con las series 'ideal' y 'real' del sprint
+    :param subtitulo: nombre del sprint
+    :return: imagen como data URI, lista para usar en un tag img
+    """
+    renderer = getattr(settings, 'BURNDOWN_CHART_RENDERER', 'svg')
+    infile = highcharts_infile(burndown, subtitulo)
+    clave = cache_graficos.clave(renderer, infile)
+    grafico = cache_graficos.get(clave)
+    if grafico is None:
+        if renderer == 'highcharts':
+            png = exportar_highcharts(infile, settings.HIGHCHARTS_EXPORT_URL,
+                                      getattr(settings, 'HIGHCHARTS_EXPORT_TIMEOUT', 5))
+            grafico = 'data:image/png;base64,' + png
+        else:
+            grafico = 'data:image/svg+xml;base64,' + svg_base64(burndown_svg(burndown, subtitulo))
+        cache_graficos.set(clave, grafico)
+    return grafico
+
+
+def _grafico_o_none(args):
+    """
+    Genera un grafico y devuelve None si el servidor de exportacion falla, para no perder el resto.
+    """
+    burndown, subtitulo = args
+    try:
+        return grafico_burndown(burndown, subtitulo)
+    except requests.RequestException:
+        return None
+
+
+def graficos_burndown(burndowns):
+    """
+    Genera los burndown charts de varios sprints. Con el exportador de Highcharts los pedidos se hacen
+    en paralelo, con a lo sumo HIGHCHARTS_EXPORT_WORKERS a la vez y HIGHCHARTS_EXPORT_TIMEOUT segundos
+    por grafico; el tiempo total es aproximadamente el del grafico mas lento.
+
+    :param burndowns: lista de tuplas (burndown, subtitulo)
+    :return: lista de imagenes como data URI en el mismo orden; None en los graficos que fallaron
+    """
+    if getattr(settings, 'BURNDOWN_CHART_RENDERER', 'svg') != 'highcharts' or len(burndowns) < 2:
+        return [_grafico_o_none(b) for b in burndowns]
+    pool = ThreadPool(min(getattr(settings, 'HIGHCHARTS_EXPORT_WORKERS', 4), len(burndowns)))
+    try:
+        return pool.map(_grafico_o_none, burndowns)
+    finally:
+        pool.close()
+        pool.join()
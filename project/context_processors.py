@@ -1,18 +1,93 @@
-from django.contrib.auth.decorators import login_required
+# -*- coding: utf-8 -*-
+"""
+Contexto de la barra de navegacion: los primeros proyectos y user stories del usuario.
+
+Como se agrega a todos los templates, el resultado se guarda por usuario en la cache de Django durante
+NAV_CACHE_TIMEOUT segundos. Las claves incluyen la generacion del usuario, que se renueva al modificar sus
+proyectos, sus user stories, su pertenencia a equipos o sus permisos, y una generacion global para los
+cambios que afectan a todos los usuarios. Los usuarios que ven todos los proyectos dependen ademas de la
+generacion de todos los proyectos, que se renueva al modificar cualquier proyecto o user story.
+
+Las generaciones son la hora en que se renovaron y no un contador: si la cache descarta una generacion, se
+vuelve a crear con la hora actual y no puede coincidir con la de una entrada anterior.
+La cache debe ser compartida por todos los procesos (ver CACHES en settings).
+"""
+import time
+from django.conf import settings
+from django.core.cache import cache
 from project.models import Proyecto, UserStory
 
+CLAVE_GLOBAL = 'nav:generacion'
+CLAVE_TODOS = 'nav:generacion:todos'
+
+
+def clave_usuario(usuario_id):
+    return 'nav:generacion:usuario:%s' % usuario_id
+
+
+def invalidar_nav(usuarios=None, todos=False):
+    """
+    Invalida el contexto de navegacion renovando las generaciones correspondientes.
+
+    :param usuarios: ids de los usuarios cuyo contexto se invalida; None invalida el de todos los usuarios
+    :param todos: si se invalida tambien el contexto de los usuarios que ven todos los proyectos
+    """
+    if usuarios is None:
+        claves = [CLAVE_GLOBAL]
+    else:
+        claves = [clave_usuario(usuario_id) for usuario_id in set(usuarios) if usuario_id]
+        if todos:
+            claves.append(CLAVE_TODOS)
+    if claves:
+        cache.set_many(dict.fromkeys(claves, repr(time.time())), None)
+
+
+def get_generaciones(user):
+    """
+    :param user: usuario autenticado
+    :return: diccionario con las generaciones global, de todos los proyectos y del usuario; las que no estan
+    en la cache se crean con la hora actual
+    """
+    claves = [CLAVE_GLOBAL, CLAVE_TODOS, clave_usuario(user.pk)]
+    generaciones = cache.get_many(claves)
+    faltantes = dict.fromkeys([c for c in claves if c not in generaciones], repr(time.time()))
+    if faltantes:
+        cache.set_many(faltantes, None)
+        generaciones.update(faltantes)
+    return generaciones
+
+
+def get_nav(user):
+    """
+    :param user: usuario autenticado
+    :return: diccionario con los proyectos y user stories de la barra de navegacion
+    """
+    if user.has_perm('project.list_all_projects'):
+        nav_projects = Proyecto.objects.order_by('nombre_corto')[:5]
+        nav_us = UserStory.objects.order_by('nombre')[:5]
+    else:
+        nav_projects = user.proyecto_set.order_by('nombre_corto')[:5]
+        nav_us = user.userstory_set.order_by('nombre')[:5]
+    #el progreso de los proyectos se lee de sus contadores, por lo que las instancias se pueden guardar
+    return {'nav_projects': list(nav_projects), 'nav_us': list(nav_us)}
+
 
 def nav_context_processor(request):
-    try:
-        user = request.user
-        if user.has_perm('project.list_all_projects'):
-            nav_projects = Proyecto.objects.order_by('nombre_corto')[:5]
-            nav_us = UserStory.objects.order_by('nombre')[:5]
-        else:
-            nav_projects = user.proyecto_set.order_by('nombre_corto')[:5]
-            nav_us = user.userstory_set.order_by('nombre')[:5]
-        return {'nav_projects': nav_projects, 'nav_us': nav_us}
-    except AttributeError:
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated():
         return {'nav_projects': [],
                 'nav_us': [],
-                }
\ No newline at end of file
+                }
+    timeout = getattr(settings, 'NAV_CACHE_TIMEOUT', None)
+    if not timeout:
+        return get_nav(user)
+    generaciones = get_generaciones(user)
+    clave = 'nav:%s:%s:%s' % (user.pk, generaciones[CLAVE_GLOBAL], generaciones[clave_usuario(user.pk)])
+    entrada = cache.get(clave)
+    #la entrada de un usuario que ve todos los proyectos guarda la generacion de todos los proyectos
+    if entrada is None or entrada['todos'] not in (None, generaciones[CLAVE_TODOS]):
+        nav = get_nav(user)
+        todos = generaciones[CLAVE_TODOS] if user.has_perm('project.list_all_projects') else None
+        entrada = {'todos': todos, 'nav': nav}
+        cache.set(clave, entrada, timeout)
+    return entrada['nav']
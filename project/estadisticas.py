@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Estadisticas de los user stories de un proyecto: cantidad y horas por estado, totales y progreso.
+
+Los totales, las horas y el progreso se leen de los contadores del proyecto, que UserStory.save mantiene
+actualizados. La cantidad y las horas de los user stories de cada estado se calculan con una sola consulta
+agrupada y se guardan en la cache de Django durante PROJECT_STATS_TIMEOUT segundos. UserStory.save y
+UserStory.delete invalidan las estadisticas de su proyecto al terminar su transaccion; si se ejecutan dentro
+de transaccion(), se vuelven a invalidar cuando esta se confirma. El tiempo de vida corto acota lo que pueden
+quedar desactualizadas por cambios que no pasan por UserStory.save, como QuerySet.update, o que se confirman
+en otra transaccion exterior.
+
+Las usan ProjectDetail y el reporte de backlog del proyecto. La pantalla principal no muestra datos por
+proyecto.
+"""
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from project.models import UserStory
+
+
+def clave(proyecto_id):
+    return 'estadisticas:proyecto:%s' % proyecto_id
+
+
+def calcular_por_estado(proyecto_id):
+    """
+    :param proyecto_id: id del proyecto
+    :return: diccionario con 'por_estado', la cantidad de user stories del proyecto en cada estado, y
+    'horas_por_estado', las horas estimadas y registradas de cada estado; (None, None) para los estados sin
+    user stories, como Sum en la base de datos
+    """
+    por_estado = dict((estado, 0) for estado, nombre in UserStory.estado_choices)
+    horas_por_estado = dict((estado, (None, None)) for estado in por_estado)
+    filas = UserStory.objects.filter(proyecto_id=proyecto_id).order_by().values_list('estado')\
+        .annotate(cantidad=Count('id'), estimado=Sum('tiempo_estimado'), registrado=Sum('tiempo_registrado'))
+    for estado, cantidad, estimado, registrado in filas:
+        por_estado[estado] = cantidad
+        horas_por_estado[estado] = (estimado, registrado)
+    return {'por_estado': por_estado, 'horas_por_estado': horas_por_estado}
+
+
+def get_estadisticas(proyecto):
+    """
+    Retorna las estadisticas del proyecto. La cantidad y las horas por estado se toman de la cache,
+    calculandolas si no estan; el resto sale de los contadores del proyecto, sin consultas.
+
+    :param proyecto: proyecto, con sus contadores
+    :return: diccionario con 'por_estado' (cantidad de user stories en cada estado), 'horas_por_estado'
+    (horas estimadas y registradas en cada estado), 'total', 'horas_estimadas', 'horas_trabajadas' y 'progreso'
+    """
+    timeout = getattr(settings, 'PROJECT_STATS_TIMEOUT', None)
+    datos = cache.get(clave(proyecto.pk)) if timeout else None
+    if datos is None:
+        datos = calcular_por_estado(proyecto.pk)
+        if timeout:
+            cache.set(clave(proyecto.pk), datos, timeout)
+    return dict(datos, total=proyecto.us_total, horas_estimadas=proyecto.horas_estimadas,
+                horas_trabajadas=proyecto.horas_trabajadas, progreso=proyecto.progreso)
+
+
+def invalidar(*proyectos):
+    """
+    Descarta las estadisticas de los proyectos.
+
+    :param proyectos: ids de los proyectos cuyas estadisticas se descartan
+    """
+    cache.delete_many([clave(proyecto_id) for proyecto_id in proyectos])
+
+
+def invalidar_al_confirmar(*proyectos):
+    """
+    Invalida las estadisticas de los proyectos y, si hay una transaccion() abierta, los registra en la
+    conexion para volver a invalidarlas cuando se confirme: un request que las lea antes de la confirmacion
+    puede volver a guardar en la cache los datos anteriores.
+
+    :param proyectos: ids de los proyectos cuyas estadisticas se descartan
+    """
+    invalidar(*proyectos)
+    pendientes = getattr(connection, 'estadisticas_pendientes', None)
+    if pendientes is not None:
+        pendientes.update(proyectos)
+
+
+@contextmanager
+def transaccion():
+    """
+    transaction.atomic que, al terminar sin errores, invalida las estadisticas de los proyectos cuyos user
+    stories se modificaron dentro de el. Django 1.7 no permite ejecutar codigo al confirmar una transaccion,
+    por eso los proyectos se registran en la conexion mientras dura el bloque. Si el bloque esta dentro de
+    otra transaccion, la invalidacion ocurre antes de que esa se confirme.
+    """
+    exterior = getattr(connection, 'estadisticas_pendientes', None) is None
+    if exterior:
+        connection.estadisticas_pendientes = set()
+    try:
+        with transaction.atomic():
+            yield
+        pendientes = connection.estadisticas_pendientes
+    finally:
+        if exterior:
+            connection.estadisticas_pendientes = None
+    if exterior:
+        invalidar(*pendientes)
@@ -2,6 +2,7 @@
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm, ReadOnlyPasswordHashField
 from django.contrib.auth.models import Group, Permission, User
 from django import forms
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.forms import BaseFormSet
 from django.utils import timezone
@@ -189,6 +190,35 @@ class FileUploadForm(forms.ModelForm):
         model = Adjunto
         fields = ['nombre', 'descripcion']
 
+    def clean_file(self):
+        """
+        Chequea que el archivo no supere el tamaño maximo de los adjuntos
+        """
+        archivo = self.cleaned_data['file']
+        if archivo.size > settings.ATTACHMENT_MAX_SIZE:
+            raise ValidationError('El archivo supera el tamaño máximo de {} MB'.format(settings.ATTACHMENT_MAX_SIZE / (1024 * 1024)))
+        return archivo
+
+
+class MultiFileUploadForm(forms.Form):
+    """
+    Formulario para adjuntar varios archivos a la vez, con una descripcion comun.
+    """
+    descripcion = forms.CharField(widget=forms.Textarea)
+    files = forms.FileField(label='Archivos', widget=forms.ClearableFileInput(attrs={'multiple': 'multiple'}))
+
+    def clean_files(self):
+        """
+        Chequea que ninguno de los archivos supere el tamaño maximo de los adjuntos
+        :return: lista con todos los archivos subidos
+        """
+        archivos = self.files.getlist('files')
+        for archivo in archivos:
+            if archivo.size > settings.ATTACHMENT_MAX_SIZE:
+                raise ValidationError('El archivo {} supera el tamaño máximo de {} MB'.format(
+                    archivo.name, settings.ATTACHMENT_MAX_SIZE / (1024 * 1024)))
+        return archivos
+
 
 class RegistrarActividadForm(forms.ModelForm):
     '''
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Imagenes derivadas (miniaturas y vistas previas) de los adjuntos de tipo imagen.
+
+Los derivados se generan al subir la imagen, o la primera vez que se piden, y se guardan en
+ATTACHMENT_DERIVATIVES_DIR bajo el hash del contenido original. Como el contenido de un adjunto no
+cambia, un derivado generado nunca queda desactualizado.
+"""
+import errno
+import os
+import shutil
+import tempfile
+from contextlib import closing
+from django.conf import settings
+from PIL import Image
+
+#Formato en el que se guarda cada derivado segun tenga o no transparencia
+FORMATOS = {'png': ('PNG', 'image/png'), 'jpg': ('JPEG', 'image/jpeg')}
+
+
+def clave(adjunto):
+    """
+    :param adjunto: adjunto de tipo imagen
+    :return: hash del contenido del adjunto. Para los adjuntos que todavia estan en la base de datos se
+    usan su id, tamano y fecha de creacion, sin leer el contenido; el contenido de un adjunto no cambia
+    """
+    if adjunto.sha256:
+        return adjunto.sha256
+    return 'adjunto-%d-%s-%s' % (adjunto.pk, adjunto.size, adjunto.creacion.strftime('%Y%m%d%H%M%S%f'))
+
+
+def directorio(sha256):
+    return os.path.join(settings.ATTACHMENT_DERIVATIVES_DIR, sha256[:2], sha256)
+
+
+def buscar(sha256, nombre):
+    """
+    Busca un derivado ya generado.
+
+    :return: tupla (ruta, content_type) o None si no existe
+    """
+    for extension, (formato, content_type) in FORMATOS.items():
+        ruta = os.path.join(directorio(sha256), '%s.%s' % (nombre, extension))
+        if os.path.exists(ruta):
+            return ruta, content_type
+    return None
+
+
+def derivado(adjunto, nombre):
+    """
+    Obtiene un derivado de una imagen, generandolo si todavia no existe.
+
+    :param adjunto: adjunto de tipo imagen
+    :param nombre: nombre del derivado, una de las claves de ATTACHMENT_IMAGE_SIZES
+    :return: tupla (ruta, content_type)
+    :raise IOError: si el contenido no es una imagen que se pueda procesar
+    """
+    sha256 = clave(adjunto)
+    encontrado = buscar(sha256, nombre)
+    if encontrado:
+        return encontrado
+    try:
+        os.makedirs(directorio(sha256))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    temporal = None
+    try:
+        with closing(adjunto.abrir()) as f:
+            imagen = Image.open(f)
+            imagen.thumbnail(settings.ATTACHMENT_IMAGE_SIZES[nombre], Image.ANTIALIAS)
+            if imagen.mode in ('RGBA', 'LA', 'P'):
+                extension = 'png'
+            else:
+                extension = 'jpg'
+                imagen = imagen.convert('RGB')
+            formato, content_type = FORMATOS[extension]
+            fd, temporal = tempfile.mkstemp(dir=directorio(sha256), prefix='.tmp')
+            with os.fdopen(fd, 'wb') as destino:
+                imagen.save(destino, formato)
+        ruta = os.path.join(directorio(sha256), '%s.%s' % (nombre, extension))
+        os.rename(temporal, ruta)
+    except Exception as e:
+        #Pillow informa las imagenes corruptas o demasiado grandes con distintas excepciones (IOError,
+        #SyntaxError, ValueError, DecompressionBombError, ...)
+        if temporal and os.path.exists(temporal):
+            os.remove(temporal)
+        raise IOError('No se pudo generar el derivado %s: %s' % (nombre, e))
+    return ruta, content_type
+
+
+def generar_derivados(adjunto):
+    """
+    Genera todos los derivados de una imagen recien subida. Si el contenido no es una imagen que se
+    pueda procesar no se genera ninguno.
+    """
+    for nombre in settings.ATTACHMENT_IMAGE_SIZES:
+        try:
+            derivado(adjunto, nombre)
+        except IOError:
+            return
+
+
+def listar_derivados():
+    """
+    :return: iterador de tuplas (clave, fecha de creacion) de los directorios de derivados
+    """
+    if not os.path.isdir(settings.ATTACHMENT_DERIVATIVES_DIR):
+        return
+    for prefijo in os.listdir(settings.ATTACHMENT_DERIVATIVES_DIR):
+        base = os.path.join(settings.ATTACHMENT_DERIVATIVES_DIR, prefijo)
+        if not os.path.isdir(base):
+            continue
+        for clave in os.listdir(base):
+            try:
+                yield clave, os.path.getmtime(os.path.join(base, clave))
+            except OSError:
+                continue
+
+
+def eliminar_derivados(sha256):
+    shutil.rmtree(directorio(sha256), ignore_errors=True)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import socket
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from project import charts
+
+#PNG de 1x1 que devuelve el exportador falso
+PNG = base64.b64encode('\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f'
+                       '\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00\x00'
+                       '\x00\x00IEND\xaeB`\x82')
+
+
+class ExportadorFalso(ThreadingMixIn, HTTPServer):
+    """
+    Servidor local que imita al servidor de exportacion de Highcharts: recibe el infile en JSON y
+    responde una imagen PNG en base64 luego de esperar `latencia` segundos. `demoras` asocia un texto
+    con otra latencia, para los pedidos cuyo infile lo contiene.
+    """
+    daemon_threads = True
+
+    def __init__(self, latencia=0, demoras=None):
+        self.latencia = latencia
+        self.demoras = demoras or {}
+        self.pedidos = 0
+        self.conexiones = 0
+        self.sockets = []
+        HTTPServer.__init__(self, ('127.0.0.1', 0), ManejadorExportador)
+
+    def process_request(self, request, client_address):
+        self.conexiones += 1
+        self.sockets.append(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def handle_error(self, request, client_address):
+        #El cliente puede cerrar la conexion al vencer su timeout
+        pass
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def iniciar(self):
+        hilo = threading.Thread(target=self.serve_forever)
+        hilo.daemon = True
+        hilo.start()
+        return self
+
+    def detener(self):
+        self.shutdown()
+        self.server_close()
+        #Cierra las conexiones persistentes para que terminen los hilos que las atienden
+        for request in self.sockets:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class ManejadorExportador(BaseHTTPRequestHandler):
+    #Conexiones persistentes, para poder medir la reutilizacion de conexiones del cliente
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        #Valida que el pedido tenga el formato que espera highcharts-convert.js
+        infile = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))['infile']
+        self.server.pedidos += 1
+        latencia = self.server.latencia
+        for texto, demora in self.server.demoras.items():
+            if texto in infile:
+                latencia = demora
+        time.sleep(latencia)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(PNG)))
+        self.end_headers()
+        self.wfile.write(PNG)
+
+    def log_message(self, *args):
+        pass
+
+
+def burndown_de_prueba(dias):
+    """
+    Series de un burndown sintetico para medir el renderizado sin depender de la base de datos.
+    """
+    total = dias * 8
+    ideal = [round(total - float(total) / dias * d, 1) for d in range(dias + 1)]
+    real = [max(total - d * 7 - (d % 3) * 2, 0) for d in range(dias + 1)]
+    return {'ideal': ideal, 'real': real}
+
+
+class Command(BaseCommand):
+    """
+    Compara el tiempo de generacion de un burndown chart con el renderizador SVG interno y con el
+    servidor de exportacion de Highcharts. Si no se indica --url se usa un exportador falso local,
+    con lo que se mide solo el costo del viaje HTTP (mas la latencia simulada).
+    """
+    help = 'Mide el tiempo por grafico del renderizador SVG contra el exportador de Highcharts.'
+    option_list = BaseCommand.option_list + (
+        make_option('--graficos', dest='graficos', type='int', default=50,
+                    help='Cantidad de graficos a generar con cada renderizador.'),
+        make_option('--dias', dest='dias', type='int', default=14,
+                    help='Duracion del sprint sintetico en dias.'),
+        make_option('--latencia', dest='latencia', type='float', default=0,
+                    help='Segundos que tarda el exportador falso en responder cada grafico.'),
+        make_option('--url', dest='url', default=None,
+                    help='Usar un servidor de exportacion real en lugar del exportador falso.'),
+    )
+
+    def handle(self, *args, **options):
+        n = options['graficos']
+        burndown = burndown_de_prueba(options['dias'])
+
+        inicio = time.time()
+        for i in range(n):
+            charts.svg_base64(charts.burndown_svg(burndown, 'Sprint %d' % i))
+        svg = (time.time() - inicio) / n
+
+        exportador = None
+        url = options['url']
+        if not url:
+            exportador = ExportadorFalso(options['latencia']).iniciar()
+            url = exportador.url
+        try:
+            inicio = time.time()
+            for i in range(n):
+                charts.exportar_highcharts(charts.highcharts_infile(burndown, 'Sprint %d' % i), url)
+            highcharts = (time.time() - inicio) / n
+            inicio = time.time()
+            with override_settings(BURNDOWN_CHART_RENDERER='highcharts', HIGHCHARTS_EXPORT_URL=url):
+                charts.graficos_burndown([(burndown, 'Sprint %d' % i) for i in range(n)])
+            paralelo = (time.time() - inicio) / n
+        finally:
+            if exportador:
+                exportador.detener()
+
+        self.stdout.write('Graficos: {}, dias por sprint: {}'.format(n, options['dias']))
+        self.stdout.write('SVG interno: {:.2f} ms por grafico'.format(svg * 1000))
+        self.stdout.write('Exportador Highcharts ({}): {:.2f} ms por grafico'.format(url, highcharts * 1000))
+        self.stdout.write('Exportador Highcharts en paralelo: {:.2f} ms por grafico'.format(paralelo * 1000))
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from project.charts import cache_graficos
+
+
+class Command(BaseCommand):
+    """
+    Muestra el estado de la cache en disco de los graficos de los reportes y permite vaciarla.
+    Los contadores de aciertos y fallos son de cada proceso, por lo que aqui solo se informa el contenido.
+    """
+    help = 'Muestra o vacia la cache de graficos de los reportes.'
+    option_list = BaseCommand.option_list + (
+        make_option('--limpiar', action='store_true', dest='limpiar', default=False,
+                    help='Elimina todos los graficos de la cache.'),
+    )
+
+    def handle(self, *args, **options):
+        if not cache_graficos.directorio:
+            self.stdout.write('La cache de graficos esta desactivada (CHART_CACHE_DIR).')
+            return
+        if options['limpiar']:
+            cache_graficos.limpiar()
+        stats = cache_graficos.stats()
+        self.stdout.write('{}: {} graficos, {} bytes'.format(cache_graficos.directorio, stats['entradas'], stats['bytes']))
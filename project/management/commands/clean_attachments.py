@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from project.imagenes import clave, eliminar_derivados, listar_derivados
+from project.models import Adjunto
+from project.storage import get_blob_store
+
+
+class Command(BaseCommand):
+    """
+    Comando que elimina del almacen de adjuntos los contenidos que ningun adjunto usa, y las imagenes
+    derivadas que ya no corresponden a ningun adjunto. Al eliminar un adjunto su contenido no se borra,
+    porque otro adjunto puede estar guardando el mismo contenido o la eliminacion se puede deshacer; se
+    borra aqui. Se omiten los escritos en los ultimos ATTACHMENT_ORPHAN_MIN_AGE segundos. Se puede
+    ejecutar periodicamente (cron).
+    """
+    help = 'Elimina los contenidos e imagenes derivadas de adjuntos que ya no se usan.'
+
+    def handle(self, *args, **options):
+        limite = time.time() - getattr(settings, 'ATTACHMENT_ORPHAN_MIN_AGE', 24 * 60 * 60)
+        usados = set(Adjunto.objects.filter(sha256__isnull=False).values_list('sha256', flat=True))
+        store = get_blob_store()
+        contenidos = 0
+        if hasattr(store, 'listar'):
+            for sha256, fecha in list(store.listar()):
+                #se vuelve a consultar por los adjuntos creados mientras se recorria el almacen
+                if sha256 not in usados and fecha < limite and not Adjunto.objects.filter(sha256=sha256).exists():
+                    store.delete(sha256)
+                    contenidos += 1
+        elif int(options['verbosity']) > 0:
+            self.stdout.write('El almacen de adjuntos no permite listar su contenido')
+        #los derivados de los adjuntos que todavia estan en la base de datos se guardan con otra clave
+        usados.update(clave(adjunto) for adjunto in Adjunto.objects.filter(sha256__isnull=True, tipo='img')
+                      .only('pk', 'size', 'creacion', 'sha256'))
+        derivados = 0
+        for sha256, fecha in list(listar_derivados()):
+            if sha256 not in usados and fecha < limite:
+                eliminar_derivados(sha256)
+                derivados += 1
+        if int(options['verbosity']) > 0:
+            self.stdout.write('{} contenidos y {} imagenes derivadas eliminados'.format(contenidos, derivados))
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from project.reports import limpiar_trabajos, marcar_interrumpidos
+
+
+class Command(BaseCommand):
+    """
+    Comando de mantenimiento de los reportes generados en segundo plano: marca con error los trabajos
+    interrumpidos y elimina los trabajos vencidos y sus PDF. Se puede ejecutar periodicamente (cron) y
+    al iniciar el servidor.
+    """
+    help = 'Marca los trabajos de reportes interrumpidos y elimina los trabajos y PDF vencidos.'
+
+    def handle(self, *args, **options):
+        interrumpidos = marcar_interrumpidos()
+        trabajos, archivos = limpiar_trabajos()
+        if int(options['verbosity']) > 0:
+            self.stdout.write('{} trabajos interrumpidos, {} trabajos y {} archivos eliminados'.format(
+                interrumpidos, trabajos, archivos))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from project.imagenes import clave, eliminar_derivados
+from project.models import Adjunto
+from project.storage import get_blob_store
+
+
+class Command(BaseCommand):
+    """
+    Comando que mueve el contenido de los adjuntos guardados en la base de datos (Adjunto.binario) al
+    almacen de adjuntos. Mientras no se ejecuta, esos adjuntos se siguen leyendo de la base de datos.
+    Tambien completa el tamano de los adjuntos que no lo tienen.
+    """
+    help = 'Mueve el contenido de los adjuntos de la base de datos al almacen de adjuntos.'
+    option_list = BaseCommand.option_list + (
+        make_option('--conservar', action='store_true', dest='conservar', default=False,
+                    help='No borrar el contenido de la base de datos luego de copiarlo.'),
+    )
+
+    def handle(self, *args, **options):
+        store = get_blob_store()
+        pendientes = Adjunto.objects.filter(sha256__isnull=True, binario__isnull=False)
+        #Se lee un adjunto por vez para no cargar todos los binarios en memoria, con el binario en la misma
+        #consulta: el manager lo difiere y leerlo despues costaria otra consulta por adjunto
+        for pk in list(pendientes.values_list('pk', flat=True)):
+            adjunto = Adjunto.objects.defer(None).get(pk=pk)
+            sha256, tamano = store.save(bytes(adjunto.binario))
+            campos = {'sha256': sha256, 'size': tamano}
+            if not options['conservar']:
+                campos['binario'] = None
+            Adjunto.objects.filter(pk=pk).update(**campos)
+            if adjunto.tipo == 'img':
+                #los derivados pasan a guardarse bajo el hash del contenido
+                eliminar_derivados(clave(adjunto))
+            if int(options['verbosity']) > 0:
+                self.stdout.write('Adjunto {} ({}): {} bytes'.format(pk, adjunto.filename, tamano))
+        for pk, sha256 in Adjunto.objects.filter(size__isnull=True, sha256__isnull=False).values_list('pk', 'sha256'):
+            Adjunto.objects.filter(pk=pk).update(size=store.size(sha256))
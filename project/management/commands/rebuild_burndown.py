@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from project.models import Sprint, SprintDaySnapshot
+
+
+class Command(BaseCommand):
+    """
+    Comando que genera o reconstruye los resumenes diarios del burndown a partir de las notas
+    registradas. Se usa para cargar los resumenes de datos existentes o para corregirlos
+    luego de modificar notas.
+    """
+    args = '<sprint_id sprint_id ...>'
+    help = 'Reconstruye los resumenes diarios del burndown de los sprints a partir de sus notas.'
+    option_list = BaseCommand.option_list + (
+        make_option('--proyecto', dest='proyecto', default=None,
+                    help='Reconstruir solo los sprints del proyecto indicado.'),
+    )
+
+    def handle(self, *args, **options):
+        sprints = Sprint.objects.all()
+        if args:
+            sprints = sprints.filter(pk__in=args)
+        if options['proyecto']:
+            sprints = sprints.filter(proyecto_id=options['proyecto'])
+        for sprint in sprints:
+            dias = SprintDaySnapshot.reconstruir(sprint)
+            if int(options['verbosity']) > 0:
+                self.stdout.write('Sprint {} ({}): {} dias con actividad'.format(sprint.pk, sprint, dias))
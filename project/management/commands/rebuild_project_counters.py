@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from project import estadisticas
+from project.models import Proyecto
+
+
+class Command(BaseCommand):
+    """
+    Comando que recalcula los contadores de user stories y horas de los proyectos a partir de sus
+    user stories. Se usa para cargarlos en datos existentes o para corregirlos luego de modificar
+    user stories sin pasar por UserStory.save, por ejemplo con QuerySet.update.
+    """
+    args = '<proyecto_id proyecto_id ...>'
+    help = 'Recalcula los contadores de user stories y horas de los proyectos.'
+    option_list = BaseCommand.option_list + (
+        make_option('--verificar', action='store_true', dest='verificar', default=False,
+                    help='Solo informar los proyectos con contadores incorrectos, sin corregirlos.'),
+    )
+
+    def handle(self, *args, **options):
+        proyectos = Proyecto.objects.all()
+        if args:
+            proyectos = proyectos.filter(pk__in=args)
+        incorrectos = 0
+        for proyecto in proyectos:
+            contadores = proyecto.calcular_contadores()
+            diferencias = ['{}: {} -> {}'.format(campo, getattr(proyecto, campo), contadores[campo])
+                           for campo in Proyecto.CONTADORES if getattr(proyecto, campo) != contadores[campo]]
+            if not diferencias:
+                continue
+            incorrectos += 1
+            if not options['verificar']:
+                Proyecto.objects.filter(pk=proyecto.pk).update(**contadores)
+                #las cantidades por estado en la cache pueden estar igual de desactualizadas
+                estadisticas.invalidar(proyecto.pk)
+            if int(options['verbosity']) > 0:
+                self.stdout.write('Proyecto {} ({}): {}'.format(proyecto.pk, proyecto, ', '.join(diferencias)))
+        if int(options['verbosity']) > 0:
+            if options['verificar']:
+                self.stdout.write('{} proyectos con contadores incorrectos'.format(incorrectos))
+            else:
+                self.stdout.write('{} proyectos corregidos'.format(incorrectos))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0009_merge'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SprintDaySnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('dia', models.DateField()),
+                ('horas_trabajadas', models.IntegerField(default=0)),
+                ('us_completados', models.IntegerField(default=0)),
+                ('sprint', models.ForeignKey(to='project.Sprint')),
+            ],
+            options={
+                'ordering': ['dia'],
+                'default_permissions': (),
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='sprintdaysnapshot',
+            unique_together=set([('sprint', 'dia')]),
+        ),
+    ]
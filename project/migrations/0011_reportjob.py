@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('project', '0010_sprintdaysnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('nombre', models.CharField(max_length=200)),
+                ('estado', models.IntegerField(default=0, choices=[(0, b'Pendiente'), (1, b'Generando'), (2, b'Terminado'), (3, b'Error')])),
+                ('archivo', models.CharField(max_length=100, null=True, editable=False)),
+                ('error', models.TextField(blank=True)),
+                ('creacion', models.DateTimeField(auto_now_add=True)),
+                ('fin', models.DateTimeField(null=True)),
+                ('usuario', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-creacion'],
+                'default_permissions': (),
+            },
+            bases=(models.Model,),
+        ),
+    ]
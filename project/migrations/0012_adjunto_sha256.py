@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0011_reportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adjunto',
+            name='sha256',
+            field=models.CharField(max_length=64, null=True, editable=False, db_index=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0012_adjunto_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adjunto',
+            name='size',
+            field=models.PositiveIntegerField(null=True, editable=False),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0013_adjunto_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proyecto',
+            name='horas_estimadas',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='proyecto',
+            name='horas_trabajadas',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='proyecto',
+            name='us_aprobados',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='proyecto',
+            name='us_cancelados',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='proyecto',
+            name='us_total',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+    ]
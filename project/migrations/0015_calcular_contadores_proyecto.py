@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def calcular_contadores(apps, schema_editor):
+    """
+    Carga los contadores de los proyectos existentes a partir de sus user stories, igual que
+    Proyecto.calcular_contadores, con una sola consulta agrupada.
+    """
+    Proyecto = apps.get_model('project', 'Proyecto')
+    UserStory = apps.get_model('project', 'UserStory')
+    contadores = {}
+    totales = UserStory.objects.values('proyecto', 'estado').annotate(
+        cantidad=models.Count('id'), estimado=models.Sum('tiempo_estimado'),
+        registrado=models.Sum('tiempo_registrado'))
+    for total in totales:
+        proyecto = contadores.setdefault(total['proyecto'], dict.fromkeys(
+            ['us_total', 'us_cancelados', 'us_aprobados', 'horas_estimadas', 'horas_trabajadas'], 0))
+        proyecto['us_total'] += total['cantidad']
+        proyecto['horas_estimadas'] += total['estimado'] or 0
+        proyecto['horas_trabajadas'] += total['registrado'] or 0
+        if total['estado'] == 4:
+            proyecto['us_cancelados'] += total['cantidad']
+        elif total['estado'] == 3:
+            proyecto['us_aprobados'] += total['cantidad']
+    for proyecto_id, valores in contadores.items():
+        Proyecto.objects.filter(pk=proyecto_id).update(**valores)
+
+
+def no_hacer_nada(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0014_proyecto_contadores'),
+    ]
+
+    operations = [
+        migrations.RunPython(calcular_contadores, no_hacer_nada),
+    ]
@@ -1,17 +1,24 @@
 # -*- coding: utf-8 -*-
-from base64 import b64encode
-from django.db import models
+import os
+from contextlib import closing
+from io import BytesIO
+from datetime import timedelta
+from django.conf import settings
+from django.db import models, transaction
 from django.contrib.auth.models import User, Group
 from django.core.exceptions import ValidationError
-from django.db.models import Q, Sum
-from django.db.models.signals import m2m_changed, post_save
+from django.db.models import Q, Sum, F, Count
+from django.db.models.signals import m2m_changed, pre_save, post_save, post_delete
 from django.shortcuts import get_object_or_404
 from django.utils.encoding import force_bytes
 from django.utils import timezone
-from guardian.shortcuts import assign_perm, remove_perm, get_perms_for_model, get_perms
+from django.contrib.contenttypes.models import ContentType
+from guardian.models import UserObjectPermission
+from guardian.shortcuts import assign_perm, remove_perm
 from django.core.urlresolvers import reverse_lazy
 import reversion
 from reversion.models import Revision
+from project.storage import get_blob_store
 
 
 class Proyecto(models.Model):
@@ -30,6 +37,14 @@ class Proyecto(models.Model):
     duracion_sprint = models.PositiveIntegerField(default=30)
     descripcion = models.TextField()
     equipo = models.ManyToManyField(User, through='MiembroEquipo')
+    # Contadores de los user stories del proyecto, actualizados al guardar o eliminar un user story.
+    # Se recalculan con el comando rebuild_project_counters
+    us_total = models.IntegerField(default=0, editable=False)
+    us_cancelados = models.IntegerField(default=0, editable=False)
+    us_aprobados = models.IntegerField(default=0, editable=False)
+    horas_estimadas = models.IntegerField(default=0, editable=False)
+    horas_trabajadas = models.IntegerField(default=0, editable=False)
+    CONTADORES = ('us_total', 'us_cancelados', 'us_aprobados', 'horas_estimadas', 'horas_trabajadas')
 
     class Meta:
         # Los permisos estaran asociados a los proyectos, por lo que todos los permisos de ABM de las entidades
@@ -67,19 +82,71 @@ class Proyecto(models.Model):
     def get_absolute_url(self):
         return reverse_lazy('project:project_detail', args=[self.pk])
 
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        """
+        Al modificar un proyecto existente no se escriben los contadores: la instancia puede tener valores
+        viejos, y sobreescribirlos desharia los cambios hechos por UserStory.save desde que se leyo.
+        """
+        if not self._state.adding and not force_insert and update_fields is None:
+            update_fields = [f.name for f in self._meta.concrete_fields
+                             if not f.primary_key and f.name not in self.CONTADORES]
+        super(Proyecto, self).save(force_insert, force_update, using, update_fields)
+
     def get_horas_estimadas(self):
-        return self.userstory_set.aggregate(total=Sum('tiempo_estimado'))['total']
+        return self.horas_estimadas
 
     def get_horas_trabajadas(self):
-        return self.userstory_set.aggregate(total=Sum('tiempo_registrado'))['total']
+        return self.horas_trabajadas
 
     def _get_progreso(self):
-        us_total = self.userstory_set.count() - self.userstory_set.filter(estado=4).count()
-        us_aprobados = self.userstory_set.filter(estado=3).count()
-        progreso = float(us_aprobados) / us_total * 100 if us_total > 0 else 0
+        us_total = self.us_total - self.us_cancelados
+        progreso = float(self.us_aprobados) / us_total * 100 if us_total > 0 else 0
         return int(progreso)
     progreso = property(_get_progreso)
 
+    @staticmethod
+    def contadores_de(estado, tiempo_estimado, tiempo_registrado, signo=1):
+        """
+        Aporte de un user story a los contadores de su proyecto.
+
+        :param signo: 1 para sumar el user story, -1 para restarlo
+        :return: diccionario con el aporte a cada contador
+        """
+        return {'us_total': signo, 'us_cancelados': signo if estado == 4 else 0,
+                'us_aprobados': signo if estado == 3 else 0, 'horas_estimadas': signo * tiempo_estimado,
+                'horas_trabajadas': signo * tiempo_registrado}
+
+    @classmethod
+    def actualizar_contadores(cls, proyecto_id, deltas):
+        """
+        Suma los deltas a los contadores del proyecto con un UPDATE, sin leer el proyecto.
+
+        :param proyecto_id: id del proyecto
+        :param deltas: diccionario con la diferencia de cada contador
+        """
+        deltas = dict((campo, F(campo) + delta) for campo, delta in deltas.items() if delta)
+        if deltas:
+            cls.objects.filter(pk=proyecto_id).update(**deltas)
+
+    def calcular_contadores(self):
+        """
+        Calcula los contadores a partir de los user stories del proyecto.
+
+        :return: diccionario con el valor de cada contador
+        """
+        contadores = dict.fromkeys(self.CONTADORES, 0)
+        totales = self.userstory_set.values('estado').annotate(
+            cantidad=Count('id'), estimado=Sum('tiempo_estimado'), registrado=Sum('tiempo_registrado'))
+        for total in totales:
+            contadores['us_total'] += total['cantidad']
+            contadores['horas_estimadas'] += total['estimado'] or 0
+            contadores['horas_trabajadas'] += total['registrado'] or 0
+            if total['estado'] == 4:
+                contadores['us_cancelados'] += total['cantidad']
+            elif total['estado'] == 3:
+                contadores['us_aprobados'] += total['cantidad']
+        return contadores
+
     def clean(self):
         try:
             if self.inicio > self.fin:
@@ -122,6 +189,18 @@ class MiembroEquipo(models.Model):
         unique_together = ('usuario', 'proyecto')
 
 
+class SprintQuerySet(models.QuerySet):
+    """
+    QuerySet de los sprints con anotaciones para los listados.
+    """
+
+    def with_story_counts(self):
+        """
+        :return: los sprints con la cantidad de sus user stories en num_user_stories
+        """
+        return self.annotate(num_user_stories=Count('userstory'))
+
+
 class Sprint(models.Model):
     """
     Manejo de los sprints del proyecto
@@ -132,6 +211,8 @@ class Sprint(models.Model):
     proyecto = models.ForeignKey(Proyecto, null=False, blank=True)
     #estado = models.BooleanField(default=False)
 
+    objects = SprintQuerySet.as_manager()
+
     class Meta:
         default_permissions = ()
         verbose_name = 'sprint'
@@ -146,6 +227,18 @@ class Sprint(models.Model):
 
 
 
+class FlujoQuerySet(models.QuerySet):
+    """
+    QuerySet de los flujos y plantillas con anotaciones para los listados.
+    """
+
+    def with_activity_counts(self):
+        """
+        :return: los flujos con la cantidad de sus actividades en num_actividades
+        """
+        return self.annotate(num_actividades=Count('actividad'))
+
+
 class Flujo(models.Model):
     """
     Administración de los flujos que forman parte de un proyecto.
@@ -154,6 +247,8 @@ class Flujo(models.Model):
     nombre = models.CharField(max_length=20)
     proyecto = models.ForeignKey(Proyecto, null=True, blank=True)
 
+    objects = FlujoQuerySet.as_manager()
+
     def __unicode__(self):
         return self.nombre
 
@@ -221,24 +316,65 @@ class UserStory(models.Model):
 
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
+        from project.estadisticas import invalidar_al_confirmar
+        from project.permissions import permisos_de_roles
         old_developer = None
+        anterior = None
+
+        with transaction.atomic():
+            #la fila anterior se lee bloqueada: otro guardado del mismo user story espera a que termine este,
+            #y calcula sus diferencias sobre los valores ya guardados
+            if self.pk is not None:
+                anterior = UserStory.objects.select_for_update().filter(pk=self.pk).values_list(
+                    'desarrollador', 'proyecto', 'estado', 'tiempo_estimado', 'tiempo_registrado').first()
+            if anterior:
+                old_developer = anterior[0]
+            self._desarrollador_anterior = old_developer
+            super(UserStory, self).save(force_insert, force_update, using, update_fields)
+            #actualizamos los contadores del proyecto con la diferencia entre la version anterior y la nueva
+            deltas = Proyecto.contadores_de(self.estado, self.tiempo_estimado, self.tiempo_registrado)
+            if anterior:
+                previos = Proyecto.contadores_de(*anterior[2:], signo=-1)
+                if anterior[1] == self.proyecto_id:
+                    deltas = dict((campo, delta + previos[campo]) for campo, delta in deltas.items())
+                else:
+                    Proyecto.actualizar_contadores(anterior[1], previos)
+            Proyecto.actualizar_contadores(self.proyecto_id, deltas)
+        #las estadisticas se invalidan una vez confirmados los cambios
+        proyectos = [self.proyecto_id]
+        if anterior and anterior[1] != self.proyecto_id:
+            proyectos.append(anterior[1])
+        invalidar_al_confirmar(*proyectos)
+        #los permisos sobre el user story son los que dan al desarrollador sus roles: se calculan y se aplica
+        #la diferencia con los que tienen el desarrollador actual y el anterior, como en sincronizar_permisos_roles
+        ct_us = ContentType.objects.get_for_model(UserStory).pk
+        objetivo = set()
+        if self.proyecto_id and self.desarrollador_id:
+            membership = get_object_or_404(MiembroEquipo, usuario=self.desarrollador_id, proyecto=self.proyecto_id)
+            objetivo = set(fila for fila in permisos_de_roles(self.desarrollador_id, self.proyecto_id,
+                                                               membership.roles.prefetch_related('permissions'),
+                                                               [self.pk]) if fila[1] == ct_us)
+        usuarios = set([old_developer, self.desarrollador_id]) - set([None])
+        if usuarios:
+            actuales = set()
+            eliminar = []
+            for pk, usuario, perm_id in UserObjectPermission.objects.filter(
+                    user__in=usuarios, content_type=ct_us, object_pk=unicode(self.pk)).values_list(
+                    'pk', 'user_id', 'permission_id'):
+                fila = (usuario, ct_us, unicode(self.pk), perm_id)
+                actuales.add(fila)
+                if fila not in objetivo:
+                    eliminar.append(pk)
+            if eliminar:
+                UserObjectPermission.objects.filter(pk__in=eliminar).delete()
+            UserObjectPermission.objects.bulk_create(
+                [UserObjectPermission(user_id=usuario, content_type_id=ct, object_pk=object_pk, permission_id=perm)
+                 for usuario, ct, object_pk, perm in objetivo - actuales])
 
-        if self.pk is not None:
-            old_instance = get_object_or_404(UserStory, pk=self.pk)
-            old_developer = old_instance.desarrollador
-        super(UserStory, self).save(force_insert, force_update, using, update_fields)
-        #borramos los permisos del antiguo desarrollador
-        if old_developer:
-            for perm in get_perms(old_developer, self):
-                remove_perm(perm, old_developer, self)
-        #copiamos al user story recién creado los permisos de user story
-        if self.proyecto and self.desarrollador:
-            membership = get_object_or_404(MiembroEquipo, usuario=self.desarrollador, proyecto=self.proyecto)
-            permisos_us = get_perms_for_model(UserStory)
-            for rol in membership.roles.all():
-                for perm in rol.permissions.all():
-                    if perm in permisos_us:
-                        assign_perm(perm.codename, self.desarrollador, self)
+    def delete(self, using=None):
+        from project.estadisticas import invalidar_al_confirmar
+        super(UserStory, self).delete(using)
+        invalidar_al_confirmar(self.proyecto_id)
 
     class Meta:
         verbose_name_plural = 'user stories'
@@ -277,6 +413,101 @@ class Nota(models.Model):
         return '{}({}): {}'.format(self.desarrollador, self.fecha, self.horas_a_registrar)
 
 
+def get_dia(fecha):
+    """
+    Retorna el dia, en la zona horaria actual, al que corresponde una fecha.
+    """
+    return timezone.localtime(fecha).date() if timezone.is_aware(fecha) else fecha.date()
+
+
+class SprintDaySnapshot(models.Model):
+    """
+    Resumen diario del avance de un sprint: horas trabajadas y user stories completados en el dia.
+    Se actualiza cada vez que se registra una nota, de manera que el burndown se obtiene con una sola
+    lectura por rango de dias en vez de recorrer las notas. Las horas restantes no se guardan porque
+    dependen de la estimacion actual del sprint; se calculan al armar el burndown.
+    """
+    sprint = models.ForeignKey(Sprint)
+    dia = models.DateField()
+    horas_trabajadas = models.IntegerField(default=0)
+    us_completados = models.IntegerField(default=0)
+
+    class Meta:
+        default_permissions = ()
+        unique_together = ('sprint', 'dia')
+        ordering = ['dia']
+
+    def __unicode__(self):
+        return '{} ({})'.format(self.sprint, self.dia)
+
+    @staticmethod
+    def get_dias(sprint):
+        """
+        Retorna la lista de dias que abarca el sprint.
+        """
+        return [(sprint.inicio + timedelta(n)).date() for n in range(int((sprint.fin - sprint.inicio).days))]
+
+    @classmethod
+    def get_rango(cls, sprint):
+        """
+        Retorna los resumenes de los dias del sprint ordenados por dia.
+        """
+        dias = cls.get_dias(sprint)
+        if not dias:
+            return cls.objects.none()
+        return cls.objects.filter(sprint=sprint, dia__range=(dias[0], dias[-1]))
+
+    @classmethod
+    def registrar_nota(cls, nota, signo=1):
+        """
+        Suma (o resta, si signo es -1) una nota al resumen del dia en que fue registrada.
+
+        :param nota: nota registrada o eliminada
+        :param signo: 1 si la nota se agrega, -1 si se elimina
+        """
+        if not nota.sprint_id:
+            return
+        dia = get_dia(nota.fecha)
+        horas = nota.horas_a_registrar if nota.horas_a_registrar else 0
+        completados = 1 if nota.estado == 3 else 0
+        with transaction.atomic():
+            if signo > 0:
+                cls.objects.get_or_create(sprint_id=nota.sprint_id, dia=dia)
+            cls.objects.filter(sprint_id=nota.sprint_id, dia=dia).update(
+                horas_trabajadas=F('horas_trabajadas') + signo * horas,
+                us_completados=F('us_completados') + signo * completados)
+
+    @classmethod
+    def reconstruir(cls, sprint):
+        """
+        Vuelve a generar los resumenes del sprint a partir de todas sus notas.
+
+        :param sprint: sprint a reconstruir
+        :return: cantidad de dias con resumen
+        """
+        por_dia = {}
+        notas = sprint.nota_set.values_list('fecha', 'estado', 'horas_a_registrar')
+        for fecha, estado, horas in notas.iterator():
+            snapshot = por_dia.setdefault(get_dia(fecha), cls(sprint=sprint, dia=get_dia(fecha)))
+            snapshot.horas_trabajadas += horas if horas else 0
+            if estado == 3:
+                snapshot.us_completados += 1
+        with transaction.atomic():
+            cls.objects.filter(sprint=sprint).delete()
+            cls.objects.bulk_create([por_dia[dia] for dia in sorted(por_dia)])
+        return len(por_dia)
+
+
+class AdjuntoManager(models.Manager):
+    """
+    Manager de los adjuntos que no carga el contenido guardado en la base de datos (binario). Al listar
+    adjuntos solo se leen sus datos; el contenido se obtiene con Adjunto.abrir() cuando se necesita.
+    """
+
+    def get_queryset(self):
+        return super(AdjuntoManager, self).get_queryset().defer('binario')
+
+
 class Adjunto(models.Model):
     """
     Modelo para la administración de archivos adjuntos a un User Story.
@@ -288,21 +519,106 @@ class Adjunto(models.Model):
     nombre = models.CharField(max_length=20)
     descripcion = models.TextField()
     filename = models.CharField(max_length=100, null=True, editable=False)
-    binario = models.BinaryField(null=True, blank=True)
+    binario = models.BinaryField(null=True, blank=True)  # Solo adjuntos anteriores al almacen de adjuntos
+    sha256 = models.CharField(max_length=64, null=True, editable=False, db_index=True)
+    size = models.PositiveIntegerField(null=True, editable=False)
     content_type = models.CharField(null=True, editable=False, max_length=50)
     creacion = models.DateTimeField(auto_now_add=True)
     user_story = models.ForeignKey(UserStory)
     tipo = models.CharField(choices=tipo_choices, default='misc', max_length=10)
     lenguaje = models.CharField(choices=lang_choices, null=True, max_length=10)
 
+    objects = AdjuntoManager()
+
     def __unicode__(self):
         return self.nombre
 
-    def img64(self):
-        return b64encode(force_bytes(self.binario))
+    def abrir(self):
+        """
+        Abre el contenido del adjunto. Se lee del almacen de adjuntos; los adjuntos que todavia no se
+        migraron con el comando migrate_attachments se leen de la base de datos.
+
+        :return: archivo abierto en modo binario
+        """
+        if self.sha256:
+            return get_blob_store().open(self.sha256)
+        return BytesIO(force_bytes(self.binario or b''))
+
+    def tamano(self):
+        """
+        :return: tamano del contenido en bytes
+        """
+        if self.size is not None:
+            return self.size
+        if self.sha256:
+            return get_blob_store().size(self.sha256)
+        return len(self.binario or b'')
+
+    def contenido(self):
+        """
+        :return: el contenido completo del adjunto
+        """
+        with closing(self.abrir()) as f:
+            return f.read()
 
     def get_absolute_url(self):
         return reverse_lazy('project:file_detail', args=[self.pk])
 
     def get_download_url(self):
-        return reverse_lazy('project:download_attachment', args=[self.pk])
\ No newline at end of file
+        return reverse_lazy('project:download_attachment', args=[self.pk])
+
+
+class ReportJob(models.Model):
+    """
+    Reporte en PDF generado en segundo plano. La vista del reporte arma el HTML y encola el trabajo;
+    el PDF se escribe en REPORT_ROOT y se descarga una vez terminado.
+    """
+    PENDIENTE, GENERANDO, TERMINADO, ERROR = range(4)
+    estado_choices = ((PENDIENTE, 'Pendiente'), (GENERANDO, 'Generando'), (TERMINADO, 'Terminado'), (ERROR, 'Error'), )
+    usuario = models.ForeignKey(User)
+    nombre = models.CharField(max_length=200)
+    estado = models.IntegerField(choices=estado_choices, default=PENDIENTE)
+    archivo = models.CharField(max_length=100, null=True, editable=False)
+    error = models.TextField(blank=True)
+    creacion = models.DateTimeField(auto_now_add=True)
+    fin = models.DateTimeField(null=True)
+
+    class Meta:
+        default_permissions = ()
+        ordering = ['-creacion']
+
+    def __unicode__(self):
+        return self.nombre
+
+    def get_absolute_url(self):
+        return reverse_lazy('project:report_job', args=[self.pk])
+
+    def get_download_url(self):
+        return reverse_lazy('project:report_job_download', args=[self.pk])
+
+    def ruta(self):
+        """
+        :return: ruta del PDF generado en el disco
+        """
+        return os.path.join(settings.REPORT_ROOT, self.archivo)
+
+
+from project.signals import add_nota_snapshot, remove_nota_snapshot, save_nota_anterior
+pre_save.connect(save_nota_anterior, sender=Nota, dispatch_uid='save_nota_anterior_signal')
+post_save.connect(add_nota_snapshot, sender=Nota, dispatch_uid='add_nota_snapshot_signal')
+post_delete.connect(remove_nota_snapshot, sender=Nota, dispatch_uid='remove_nota_snapshot_signal')
+from project.signals import remove_userstory_contadores
+post_delete.connect(remove_userstory_contadores, sender=UserStory, dispatch_uid='remove_userstory_contadores_signal')
+from project.signals import invalidar_nav, save_desarrollador_anterior
+pre_save.connect(save_desarrollador_anterior, sender=UserStory, dispatch_uid='save_desarrollador_anterior_signal')
+for modelo in (Proyecto, UserStory, MiembroEquipo):
+    post_save.connect(invalidar_nav, sender=modelo, dispatch_uid='invalidar_nav_save_%s' % modelo.__name__)
+    post_delete.connect(invalidar_nav, sender=modelo, dispatch_uid='invalidar_nav_delete_%s' % modelo.__name__)
+for relacion in (User.groups.through, User.user_permissions.through, Group.permissions.through):
+    m2m_changed.connect(invalidar_nav, sender=relacion, dispatch_uid='invalidar_nav_%s' % relacion.__name__)
+from project.signals import invalidar_reportes
+for modelo in (Proyecto, Sprint, Flujo, Actividad, MiembroEquipo, User, Group):
+    post_save.connect(invalidar_reportes, sender=modelo, dispatch_uid='invalidar_reportes_save_%s' % modelo.__name__)
+    post_delete.connect(invalidar_reportes, sender=modelo,
+                        dispatch_uid='invalidar_reportes_delete_%s' % modelo.__name__)
+m2m_changed.connect(invalidar_reportes, sender=MiembroEquipo.roles.through, dispatch_uid='invalidar_reportes_roles')
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Resolucion de los permisos por objeto del usuario dentro de un request, y sincronizacion de los permisos
+por objeto de los miembros de equipo con sus roles.
+
+guardian consulta la base de datos en cada get_perms o has_perm sobre un objeto. Las vistas comprueban
+varias veces los permisos del usuario sobre el proyecto y sus user stories, por lo que los permisos sobre
+un proyecto y sus user stories se cargan una sola vez por request y el resto de las comprobaciones se
+responden en memoria.
+"""
+from itertools import chain
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Q
+from guardian.exceptions import WrongAppError
+from guardian.models import UserObjectPermission, GroupObjectPermission
+from project.models import MiembroEquipo, Proyecto, UserStory
+
+#Permisos de los roles que se asignan sobre los user stories del miembro y no sobre el proyecto
+PERMISOS_MIS_USER_STORIES = ('edit_my_userstory', 'registraractividad_my_userstory')
+
+
+class PermisosUsuario(object):
+    """
+    Permisos por objeto de un usuario. La primera vez que se pide un permiso sobre un proyecto o uno de
+    sus user stories se cargan los permisos del usuario, propios y de sus grupos, sobre ese proyecto y
+    todos sus user stories. Los permisos sobre objetos de otros tipos se cargan objeto por objeto.
+
+    Igual que con guardian, un superusuario tiene todos los permisos y un usuario inactivo ninguno.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._permisos = {}  # alcance cargado: {(id del content type, pk del objeto): set de codenames}
+        self._todos = {}  # id del content type: set de codenames, para un superusuario
+
+    def get_perms(self, obj):
+        """
+        :param obj: objeto sobre el cual se consultan los permisos
+        :return: lista con los codenames de los permisos del usuario sobre el objeto
+        """
+        if not self.user.is_active:
+            return []
+        ctype = ContentType.objects.get_for_model(obj)
+        if self.user.is_superuser:
+            if ctype.id not in self._todos:
+                self._todos[ctype.id] = set(Permission.objects.filter(content_type=ctype)
+                                            .values_list('codename', flat=True))
+            return list(self._todos[ctype.id])
+        return list(self._cargar(obj, ctype).get((ctype.id, unicode(obj.pk)), ()))
+
+    def has_perm(self, perm, obj=None):
+        """
+        :param perm: permiso, con o sin el prefijo de la aplicacion
+        :param obj: objeto sobre el cual se comprueba el permiso; sin objeto se comprueba el permiso global
+        :return: True si el usuario tiene el permiso
+        :raise WrongAppError: si el prefijo del permiso no es la aplicacion del objeto, como en guardian
+        """
+        if obj is None:
+            return self.user.has_perm(perm)
+        if '.' in perm:
+            app_label, perm = perm.split('.', 1)
+            if app_label != obj._meta.app_label:
+                raise WrongAppError("Passed perm has app label of '%s' and given obj has '%s'"
+                                    % (app_label, obj._meta.app_label))
+        if self.user.is_active and self.user.is_superuser:
+            return True
+        return perm in self.get_perms(obj)
+
+    def _cargar(self, obj, ctype):
+        """
+        Carga, si todavia no se cargaron, los permisos del usuario sobre el alcance del objeto: su proyecto
+        y los user stories del proyecto si el objeto es un proyecto o un user story, o solo el objeto.
+
+        :param obj: objeto sobre el cual se consultan los permisos
+        :param ctype: content type del objeto
+        :return: diccionario con los permisos del usuario sobre cada objeto del alcance
+        """
+        if isinstance(obj, (Proyecto, UserStory)):
+            proyecto_id = obj.pk if isinstance(obj, Proyecto) else obj.proyecto_id
+            clave = ('proyecto', proyecto_id)
+        else:
+            proyecto_id = None
+            clave = (ctype.id, unicode(obj.pk))
+        if clave not in self._permisos:
+            if proyecto_id is None:
+                objetos = [Q(content_type=ctype, object_pk=unicode(obj.pk))]
+            else:
+                objetos = alcance_proyecto(proyecto_id)
+            permisos = {}
+            for q in objetos:
+                filas = chain(UserObjectPermission.objects.filter(q, user=self.user)
+                              .values_list('content_type_id', 'object_pk', 'permission__codename'),
+                              GroupObjectPermission.objects.filter(q, group__user=self.user)
+                              .values_list('content_type_id', 'object_pk', 'permission__codename'))
+                for ct, object_pk, codename in filas:
+                    permisos.setdefault((ct, object_pk), set()).add(codename)
+            self._permisos[clave] = permisos
+        return self._permisos[clave]
+
+
+#Cantidad maxima de pks de user stories por consulta de permisos, por el limite de parametros de sqlite
+BLOQUE_USER_STORIES = 500
+
+
+def alcance_proyecto(proyecto_id):
+    """
+    Filtros de los permisos por objeto sobre un proyecto y sus user stories. object_pk es un texto, por lo
+    que los user stories se filtran con la lista de sus pks, partida en bloques de BLOQUE_USER_STORIES.
+
+    :param proyecto_id: id del proyecto
+    :return: lista de Q, cada uno para una consulta
+    """
+    ct_proyecto = ContentType.objects.get_for_model(Proyecto)
+    ct_us = ContentType.objects.get_for_model(UserStory)
+    user_stories = [unicode(pk) for pk in UserStory.objects.filter(proyecto=proyecto_id).values_list('pk', flat=True)]
+    proyecto = Q(content_type=ct_proyecto, object_pk=unicode(proyecto_id))
+    objetos = [Q(content_type=ct_us, object_pk__in=user_stories[i:i + BLOQUE_USER_STORIES])
+               for i in range(0, len(user_stories), BLOQUE_USER_STORIES)]
+    if not objetos:
+        return [proyecto]
+    return [proyecto | objetos[0]] + objetos[1:]
+
+
+def get_permisos(request):
+    """
+    Retorna los permisos del usuario del request, creandolos la primera vez que se piden en el request.
+
+    :param request: request del cliente
+    :return: PermisosUsuario del usuario del request
+    """
+    if getattr(request, '_permisos', None) is None:
+        request._permisos = PermisosUsuario(request.user)
+    return request._permisos
+
+
+def sincronizar_permisos_roles(miembros):
+    """
+    Ajusta los permisos por objeto de los miembros de equipo a los permisos de sus roles: sobre el proyecto
+    los permisos de los roles, y sobre los user stories de los que el miembro es desarrollador los permisos
+    de PERMISOS_MIS_USER_STORIES. Los demas permisos del usuario sobre esos objetos se eliminan, salvo
+    view_project que se asigna al agregar el miembro.
+
+    Se calcula el conjunto de permisos que deben existir y se aplica la diferencia con los existentes con
+    una eliminacion y una insercion masivas, en una sola transaccion.
+
+    :param miembros: queryset o lista de ids de MiembroEquipo
+    :return: tupla (permisos creados, permisos eliminados)
+    """
+    miembros = list(MiembroEquipo.objects.filter(pk__in=miembros).prefetch_related('roles__permissions'))
+    if not miembros:
+        return 0, 0
+    ct_proyecto = ContentType.objects.get_for_model(Proyecto)
+    ct_us = ContentType.objects.get_for_model(UserStory)
+    view_project = Permission.objects.get(content_type=ct_proyecto, codename='view_project').pk
+    usuarios = set(m.usuario_id for m in miembros)
+    proyectos = set(m.proyecto_id for m in miembros)
+    user_stories = {}
+    for us, proyecto, usuario in UserStory.objects.filter(proyecto__in=proyectos, desarrollador__in=usuarios)\
+            .values_list('pk', 'proyecto_id', 'desarrollador_id'):
+        user_stories.setdefault((usuario, proyecto), []).append(unicode(us))
+
+    #Objetos a sincronizar y permisos que deben tener: (usuario, content type, pk del objeto, permiso)
+    alcance = set()
+    objetivo = set()
+    for miembro in miembros:
+        mis_us = user_stories.get((miembro.usuario_id, miembro.proyecto_id), [])
+        alcance.add((miembro.usuario_id, ct_proyecto.pk, unicode(miembro.proyecto_id)))
+        alcance.update((miembro.usuario_id, ct_us.pk, us) for us in mis_us)
+        objetivo.update(permisos_de_roles(miembro.usuario_id, miembro.proyecto_id, miembro.roles.all(), mis_us))
+
+    existentes = UserObjectPermission.objects.filter(user__in=usuarios).filter(
+        Q(content_type=ct_proyecto, object_pk__in=[unicode(p) for p in proyectos]) |
+        Q(content_type=ct_us, object_pk__in=[us for lista in user_stories.values() for us in lista]))
+    actuales = set()
+    eliminar = []
+    for pk, usuario, ct, object_pk, perm_id in existentes.values_list('pk', 'user_id', 'content_type_id',
+                                                                        'object_pk', 'permission_id'):
+        if (usuario, ct, object_pk) not in alcance:
+            continue
+        actuales.add((usuario, ct, object_pk, perm_id))
+        if (usuario, ct, object_pk, perm_id) not in objetivo and perm_id != view_project:
+            eliminar.append(pk)
+    crear = [UserObjectPermission(user_id=usuario, content_type_id=ct, object_pk=object_pk, permission_id=perm_id)
+             for usuario, ct, object_pk, perm_id in objetivo - actuales]
+    with transaction.atomic():
+        if eliminar:
+            UserObjectPermission.objects.filter(pk__in=eliminar).delete()
+        UserObjectPermission.objects.bulk_create(crear)
+    return len(crear), len(eliminar)
+
+
+def permisos_de_roles(usuario_id, proyecto_id, roles, user_stories):
+    """
+    Permisos por objeto que corresponden a un miembro de equipo segun sus roles: los permisos de proyecto
+    sobre el proyecto, y los de PERMISOS_MIS_USER_STORIES sobre sus user stories.
+
+    :param usuario_id: id del usuario del miembro
+    :param proyecto_id: id del proyecto
+    :param roles: roles del miembro, idealmente con sus permisos obtenidos con prefetch_related
+    :param user_stories: ids de los user stories del proyecto de los que el usuario es desarrollador
+    :return: set de tuplas (usuario, content type, pk del objeto, permiso)
+    """
+    ct_proyecto = ContentType.objects.get_for_model(Proyecto)
+    ct_us = ContentType.objects.get_for_model(UserStory)
+    filas = set()
+    for rol in roles:
+        for perm in rol.permissions.all():
+            if perm.codename in PERMISOS_MIS_USER_STORIES:
+                if perm.content_type_id == ct_us.pk:
+                    filas.update((usuario_id, ct_us.pk, unicode(us), perm.pk) for us in user_stories)
+            elif perm.content_type_id == ct_proyecto.pk:
+                filas.add((usuario_id, ct_proyecto.pk, unicode(proyecto_id), perm.pk))
+    return filas
+
+
+def otorgar_permisos(filas):
+    """
+    Asigna permisos por objeto a usuarios con un solo bulk_create, omitiendo los que ya existen.
+
+    :param filas: iterable de tuplas (usuario, content type, pk del objeto, permiso), con ids
+    :return: cantidad de permisos creados
+    """
+    filas = set((usuario, ct, unicode(object_pk), perm) for usuario, ct, object_pk, perm in filas)
+    if not filas:
+        return 0
+    existentes = UserObjectPermission.objects.filter(user__in=set(f[0] for f in filas),
+                                                     content_type__in=set(f[1] for f in filas),
+                                                     object_pk__in=set(f[2] for f in filas))
+    filas -= set(existentes.values_list('user_id', 'content_type_id', 'object_pk', 'permission_id'))
+    UserObjectPermission.objects.bulk_create(
+        [UserObjectPermission(user_id=usuario, content_type_id=ct, object_pk=object_pk, permission_id=perm)
+         for usuario, ct, object_pk, perm in filas])
+    return len(filas)
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Generacion de reportes en PDF en segundo plano.
+
+El HTML del reporte se arma en el pedido, que tiene el usuario y el contexto; en los hilos de trabajo
+solo se ejecuta WeasyPrint, que es la parte lenta. No se necesita un broker externo: los trabajos se
+registran en ReportJob y se procesan en un pool de hilos del proceso.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.core.cache import cache
+from django.core.servers.basehttp import FileWrapper
+from django.db import connection
+from django.http import StreamingHttpResponse
+from django.template.defaultfilters import slugify
+from django.utils import timezone
+from django.utils._os import safe_join
+from project.models import ReportJob
+import weasyprint
+
+#Tamano de los bloques con los que se envian los PDF
+BLOQUE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class CacheReportes(object):
+    """
+    Cache en disco de los PDF generados. Por cada reporte (tipo e id del objeto) se guarda solo la
+    ultima version, identificada por su etag; al guardar una version nueva se eliminan las anteriores.
+    """
+
+    @property
+    def directorio(self):
+        return getattr(settings, 'REPORT_CACHE_DIR', None)
+
+    def ruta(self, objetivo, etag):
+        return os.path.join(self.directorio, '%s-%s.pdf' % (objetivo, etag))
+
+    def get(self, objetivo, etag):
+        """
+        :param objetivo: tipo de reporte e id del objeto, por ejemplo 'backlog_producto-3'
+        :param etag: version de los datos del reporte
+        :return: el PDF abierto o None si no esta en la cache
+        """
+        if not self.directorio:
+            return None
+        try:
+            return open(self.ruta(objetivo, etag), 'rb')
+        except IOError:
+            return None
+
+    def set(self, objetivo, etag, pdf):
+        """
+        Guarda el PDF de un reporte y elimina las versiones anteriores del mismo reporte. La cache es
+        opcional: si no se puede escribir el PDF (disco lleno, permisos) se sigue sin guardarlo.
+
+        :param pdf: archivo con el PDF generado
+        :return: el PDF guardado, abierto y posicionado al inicio; si no se pudo guardar, el archivo recibido
+        """
+        temporal = None
+        try:
+            if not os.path.isdir(self.directorio):
+                os.makedirs(self.directorio)
+            fd, temporal = tempfile.mkstemp(dir=self.directorio, prefix='.tmp')
+            #El archivo queda abierto, asi se puede servir aunque otro pedido lo reemplace
+            guardado = os.fdopen(fd, 'w+b')
+            try:
+                pdf.seek(0)
+                shutil.copyfileobj(pdf, guardado, BLOQUE)
+                guardado.flush()
+                ruta = self.ruta(objetivo, etag)
+                os.rename(temporal, ruta)
+                temporal = None
+            except (IOError, OSError):
+                guardado.close()
+                raise
+        except (IOError, OSError) as e:
+            logger.warning('No se pudo guardar el reporte %s en la cache: %s', objetivo, e)
+            if temporal:
+                try:
+                    os.remove(temporal)
+                except OSError:
+                    pass
+            pdf.seek(0)
+            return pdf
+        pdf.close()
+        for nombre in os.listdir(self.directorio):
+            anterior = os.path.join(self.directorio, nombre)
+            if nombre.startswith(objetivo + '-') and anterior != ruta:
+                try:
+                    os.remove(anterior)
+                except OSError:
+                    pass
+        guardado.seek(0)
+        return guardado
+
+
+cache_reportes = CacheReportes()
+
+#Generaciones de los datos de los reportes que no registran su ultimo cambio: sprints, flujos, actividades
+#y equipos de cada proyecto, y usuarios y roles de todos los proyectos. Como las del contexto de navegacion,
+#son la hora en que se renovaron y se guardan en la cache de Django, compartida por todos los procesos.
+CLAVE_GENERACION = 'reportes:generacion'
+
+
+def clave_generacion(proyecto_id):
+    return 'reportes:generacion:proyecto:%s' % proyecto_id
+
+
+def invalidar_reportes(proyectos=None):
+    """
+    Renueva las generaciones de los datos relacionados, con lo que cambia la version de los reportes.
+
+    :param proyectos: ids de los proyectos cuyos datos cambiaron; None si el cambio afecta a todos los proyectos
+    """
+    if proyectos is None:
+        claves = [CLAVE_GENERACION]
+    else:
+        claves = [clave_generacion(proyecto_id) for proyecto_id in set(proyectos) if proyecto_id]
+    if claves:
+        cache.set_many(dict.fromkeys(claves, repr(time.time())), None)
+
+
+def get_generaciones(proyectos):
+    """
+    :param proyectos: ids de los proyectos de los datos del reporte
+    :return: tupla con la generacion global y la de cada proyecto, en orden; las que no estan en la cache
+    se crean con la hora actual
+    """
+    claves = [CLAVE_GENERACION] + [clave_generacion(proyecto_id) for proyecto_id in sorted(set(proyectos))]
+    generaciones = cache.get_many(claves)
+    faltantes = dict.fromkeys([c for c in claves if c not in generaciones], repr(time.time()))
+    if faltantes:
+        cache.set_many(faltantes, None)
+        generaciones.update(faltantes)
+    return tuple(generaciones[c] for c in claves)
+
+
+def url_fetcher(url):
+    if url.startswith('assets://'):
+        url = url[len('assets://'):]
+        url = "file://" + safe_join(settings.ASSETS_ROOT, url)
+    return weasyprint.default_url_fetcher(url)
+
+
+def escribir_pdf(html, base_url, destino):
+    """
+    Genera el PDF de un reporte.
+
+    :param html: HTML del reporte
+    :param base_url: URL base para resolver las direcciones relativas
+    :param destino: archivo o respuesta donde se escribe el PDF
+    """
+    weasyprint.HTML(string=html, base_url=base_url, url_fetcher=url_fetcher).write_pdf(destino)
+
+
+def generar_pdf(html, base_url):
+    """
+    Genera el PDF de un reporte en un archivo temporal. Hasta REPORT_SPOOL_MAX_BYTES se mantiene en
+    memoria; los PDF mas grandes se pasan a disco, de modo que la memoria usada por pedido es acotada.
+
+    :param html: HTML del reporte
+    :param base_url: URL base para resolver las direcciones relativas
+    :return: archivo temporal con el PDF
+    """
+    pdf = tempfile.SpooledTemporaryFile(max_size=getattr(settings, 'REPORT_SPOOL_MAX_BYTES', 1024 * 1024))
+    escribir_pdf(html, base_url, pdf)
+    return pdf
+
+
+def respuesta_pdf(pdf, nombre=None):
+    """
+    Respuesta que envia un PDF por bloques desde un archivo, sin cargarlo entero en memoria.
+
+    :param pdf: archivo con el PDF; se cierra al terminar la respuesta
+    :param nombre: nombre del archivo descargado; sin nombre el PDF se muestra en el navegador
+    :return: StreamingHttpResponse con Content-Length
+    """
+    pdf.seek(0, os.SEEK_END)
+    tamano = pdf.tell()
+    pdf.seek(0)
+    response = StreamingHttpResponse(FileWrapper(pdf, BLOQUE), content_type='application/pdf')
+    response['Content-Length'] = tamano
+    #el archivo queda disponible para guardarlo en la cache de reportes sin volver a leer la respuesta
+    response.archivo_pdf = pdf
+    if nombre:
+        response['Content-Disposition'] = 'attachment; filename=%s.pdf' % slugify(nombre)
+    return response
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            #los trabajos que quedaron sin terminar por un reinicio ya no los va a procesar ningun hilo
+            marcar_interrumpidos()
+            _pool = ThreadPool(settings.REPORT_WORKERS)
+        return _pool
+
+
+def marcar_interrumpidos():
+    """
+    Marca con error los trabajos pendientes o en generacion creados hace mas de REPORT_JOB_TIMEOUT
+    segundos. Como el pool de hilos es del proceso, esos trabajos quedaron interrumpidos.
+
+    :return: cantidad de trabajos marcados
+    """
+    limite = timezone.now() - timedelta(seconds=getattr(settings, 'REPORT_JOB_TIMEOUT', 60 * 60))
+    return ReportJob.objects.filter(estado__in=[ReportJob.PENDIENTE, ReportJob.GENERANDO], creacion__lt=limite)\
+        .update(estado=ReportJob.ERROR, error=u'La generacion del reporte fue interrumpida', fin=timezone.now())
+
+
+def limpiar_trabajos():
+    """
+    Elimina los trabajos terminados, con o sin error, hace mas de REPORT_JOB_MAX_AGE segundos junto con
+    sus PDF. Tambien elimina los archivos de REPORT_ROOT que no corresponden a ningun trabajo, si tienen
+    mas de REPORT_JOB_TIMEOUT segundos, para no borrar los de un trabajo que se esta generando.
+
+    :return: tupla (trabajos eliminados, archivos eliminados)
+    """
+    limite = timezone.now() - timedelta(seconds=getattr(settings, 'REPORT_JOB_MAX_AGE', 7 * 24 * 60 * 60))
+    vencidos = ReportJob.objects.filter(estado__in=[ReportJob.TERMINADO, ReportJob.ERROR], fin__lt=limite)
+    trabajos = vencidos.count()
+    vencidos.delete()
+    archivos = 0
+    if not os.path.isdir(settings.REPORT_ROOT):
+        return trabajos, archivos
+    vigentes = set(ReportJob.objects.exclude(archivo=None).values_list('archivo', flat=True))
+    antiguedad = time.time() - getattr(settings, 'REPORT_JOB_TIMEOUT', 60 * 60)
+    for nombre in os.listdir(settings.REPORT_ROOT):
+        ruta = os.path.join(settings.REPORT_ROOT, nombre)
+        try:
+            if nombre not in vigentes and os.path.getmtime(ruta) < antiguedad:
+                os.remove(ruta)
+                archivos += 1
+        except OSError:
+            pass
+    return trabajos, archivos
+
+
+def encolar(job, html, base_url, cache=None):
+    """
+    Encola la generacion del PDF de un trabajo. Con REPORT_WORKERS = 0 se genera inmediatamente.
+
+    :param job: trabajo recien creado
+    :param html: HTML del reporte
+    :param base_url: URL base para resolver las direcciones relativas
+    :param cache: tupla (objetivo, etag) con la que se guarda el PDF en la cache de reportes, o None
+    """
+    if getattr(settings, 'REPORT_WORKERS', 0) > 0:
+        get_pool().apply_async(generar, (job.pk, html, base_url, True, cache))
+    else:
+        generar(job.pk, html, base_url, cache=cache)
+
+
+def generar(job_pk, html, base_url, en_hilo=False, cache=None):
+    """
+    Genera el PDF de un trabajo y actualiza su estado.
+
+    :param job_pk: id del trabajo
+    :param html: HTML del reporte
+    :param base_url: URL base para resolver las direcciones relativas
+    :param en_hilo: si se ejecuta en un hilo de trabajo, que debe cerrar su conexion a la base de datos
+    :param cache: tupla (objetivo, etag) con la que se guarda el PDF en la cache de reportes, o None
+    """
+    trabajos = ReportJob.objects.filter(pk=job_pk)
+    try:
+        trabajos.update(estado=ReportJob.GENERANDO)
+        if not os.path.isdir(settings.REPORT_ROOT):
+            try:
+                os.makedirs(settings.REPORT_ROOT)
+            except OSError:
+                pass
+        archivo = '%d.pdf' % job_pk
+        fd, temporal = tempfile.mkstemp(dir=settings.REPORT_ROOT, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                escribir_pdf(html, base_url, f)
+            os.rename(temporal, os.path.join(settings.REPORT_ROOT, archivo))
+        except Exception:
+            os.remove(temporal)
+            raise
+        if cache and cache_reportes.directorio:
+            cache_reportes.set(cache[0], cache[1], open(os.path.join(settings.REPORT_ROOT, archivo), 'rb')).close()
+        trabajos.update(estado=ReportJob.TERMINADO, archivo=archivo, fin=timezone.now())
+    except Exception as e:
+        trabajos.update(estado=ReportJob.ERROR, error=unicode(e), fin=timezone.now())
+    finally:
+        if en_hilo:
+            connection.close()
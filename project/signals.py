@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-from guardian.shortcuts import assign_perm, get_perms, remove_perm
 from project.models import UserStory
 
 
@@ -11,17 +10,159 @@ def add_permissions_team_member(sender, **kwargs):
     :param sender: Clase que envia la signal
     :param kwargs: Diccionario con parámetros
     '''
+    from project.permissions import otorgar_permisos, permisos_de_roles
     instance = kwargs['instance']
     action = kwargs['action']
-    exceptions = ['edit_my_userstory', 'registraractividad_my_userstory'] #Permisos a no copiar en el proyecto
     if(action=="post_add"):
-        #Copiar permisos del grupo al usuario para la instancia del proyecto y a los user stories que puedan corresponder dentro del proyecto
-        for role in instance.roles.all():
-            for perm in role.permissions.all():
-                if not perm.codename in exceptions:
-                    assign_perm(perm.codename, instance.usuario, instance.proyecto)
-                else:
-                    #buscamos los US que pertenezcan al usuario y le asignamos los permisos del rol
-                    uslist = UserStory.objects.filter(proyecto=instance.proyecto, desarrollador=instance.usuario)
-                    for us in uslist:
-                        assign_perm(perm.codename, instance.usuario, us)
\ No newline at end of file
+        #Copiar permisos de los roles al usuario para la instancia del proyecto y a los user stories que puedan corresponder dentro del proyecto
+        uslist = UserStory.objects.filter(proyecto=instance.proyecto_id, desarrollador=instance.usuario_id)\
+            .values_list('pk', flat=True)
+        otorgar_permisos(permisos_de_roles(instance.usuario_id, instance.proyecto_id,
+                                           instance.roles.prefetch_related('permissions'), uslist))
+
+
+def save_nota_anterior(sender, **kwargs):
+    '''
+    Signal que se ejecuta antes de guardar una nota modificada y guarda en la instancia los datos con los
+    que estaba registrada, para descontarlos del resumen diario del sprint.
+
+    :param sender: Clase que envia la signal
+    :param kwargs: Diccionario con parámetros
+    '''
+    from project.models import Nota
+    instance = kwargs['instance']
+    instance._anterior = None
+    if instance.pk is not None and not kwargs.get('raw', False):
+        instance._anterior = Nota.objects.filter(pk=instance.pk).only(
+            'sprint', 'fecha', 'horas_a_registrar', 'estado').first()
+
+
+def add_nota_snapshot(sender, **kwargs):
+    '''
+    Signal que se ejecuta al guardar una nota y suma sus horas al resumen diario del sprint. Si la nota
+    se modifico, primero se descuentan los datos con los que estaba registrada.
+
+    :param sender: Clase que envia la signal
+    :param kwargs: Diccionario con parámetros
+    '''
+    from project.models import SprintDaySnapshot
+    if kwargs.get('raw', False):
+        return
+    instance = kwargs['instance']
+    anterior = getattr(instance, '_anterior', None)
+    if not kwargs['created'] and anterior is None:
+        return
+    if anterior is not None:
+        campos = ('sprint_id', 'fecha', 'horas_a_registrar', 'estado')
+        if all(getattr(anterior, c) == getattr(instance, c) for c in campos):
+            return
+        SprintDaySnapshot.registrar_nota(anterior, signo=-1)
+    SprintDaySnapshot.registrar_nota(instance)
+
+
+def remove_nota_snapshot(sender, **kwargs):
+    '''
+    Signal que se ejecuta al eliminar una nota y descuenta sus horas del resumen diario del sprint.
+
+    :param sender: Clase que envia la signal
+    :param kwargs: Diccionario con parámetros
+    '''
+    from project.models import SprintDaySnapshot
+    SprintDaySnapshot.registrar_nota(kwargs['instance'], signo=-1)
+
+
+def remove_userstory_contadores(sender, **kwargs):
+    '''
+    Signal que se ejecuta al eliminar un user story y lo descuenta de los contadores de su proyecto.
+
+    :param sender: Clase que envia la signal
+    :param kwargs: Diccionario con parámetros
+    '''
+    from project.models import Proyecto
+    instance = kwargs['instance']
+    Proyecto.actualizar_contadores(instance.proyecto_id, Proyecto.contadores_de(
+        instance.estado, instance.tiempo_estimado, instance.tiempo_registrado, signo=-1))
+
+
+def save_desarrollador_anterior(sender, **kwargs):
+    '''
+    Signal que se ejecuta antes de guardar un user story modificado y guarda en la instancia el desarrollador
+    que tenia, para invalidar tambien su contexto de navegacion si el user story se reasigna.
+
+    :param sender: Clase que envia la signal
+    :param kwargs: Diccionario con parámetros
+    '''
+    instance = kwargs['instance']
+    if hasattr(instance, '_desarrollador_anterior'):
+        return  # UserStory.save ya lo leyo junto con la fila anterior
+    instance._desarrollador_anterior = None
+    if instance.pk is not None and not kwargs.get('raw', False):
+        instance._desarrollador_anterior = UserStory.objects.filter(pk=instance.pk)\
+            .values_list('desarrollador', flat=True).first()
+
+
+def invalidar_nav(sender, **kwargs):
+    '''
+    Signal que se ejecuta al modificar proyectos, user stories, miembros de equipo o permisos de usuarios
+    y grupos, e invalida el contexto de navegacion de los usuarios afectados: los miembros del proyecto y
+    el desarrollador del user story, o el usuario cuyos equipos o permisos cambiaron. Los cambios en los
+    permisos de un grupo invalidan el contexto de todos los usuarios. Si el user story se reasigna se
+    invalida tambien el del desarrollador anterior.
+
+    :param sender: Clase que envia la signal
+    :param kwargs: Diccionario con parámetros
+    '''
+    from django.contrib.auth.models import Group, User
+    from project.context_processors import invalidar_nav
+    from project.models import MiembroEquipo, Proyecto, UserStory
+    instance = kwargs['instance']
+    if 'action' in kwargs:
+        if not kwargs['action'].startswith('post_'):
+            return
+        if sender is Group.permissions.through:
+            invalidar_nav()
+        elif isinstance(instance, User):
+            invalidar_nav([instance.pk])
+        elif kwargs['pk_set']:
+            invalidar_nav(kwargs['pk_set'])
+        else:
+            invalidar_nav()
+    elif sender is MiembroEquipo:
+        invalidar_nav([instance.usuario_id])
+    else:
+        proyecto_id = instance.pk if sender is Proyecto else instance.proyecto_id
+        usuarios = list(MiembroEquipo.objects.filter(proyecto=proyecto_id).values_list('usuario', flat=True))
+        if sender is UserStory:
+            usuarios.extend([instance.desarrollador_id, instance.__dict__.pop('_desarrollador_anterior', None)])
+        invalidar_nav(usuarios, todos=True)
+
+
+
+def invalidar_reportes(sender, **kwargs):
+    '''
+    Signal que se ejecuta al modificar proyectos, sprints, flujos, actividades, miembros de equipo y sus roles,
+    usuarios o grupos, y renueva la generacion de los datos de los reportes del proyecto afectado. Los cambios
+    en usuarios y grupos afectan a los reportes de todos los proyectos. El registro del ultimo inicio de sesion
+    de un usuario no cambia los reportes.
+
+    :param sender: Clase que envia la signal
+    :param kwargs: Diccionario con parámetros
+    '''
+    from django.contrib.auth.models import Group, User
+    from project.models import Actividad, Flujo, Proyecto
+    from project.reports import invalidar_reportes
+    instance = kwargs['instance']
+    if 'action' in kwargs and not kwargs['action'].startswith('post_'):
+        return
+    if isinstance(instance, (User, Group)):
+        if kwargs.get('update_fields') != frozenset(['last_login']):
+            invalidar_reportes()
+    elif sender is Proyecto:
+        invalidar_reportes([instance.pk])
+    elif sender is Actividad:
+        proyecto_id = Flujo.objects.filter(pk=instance.flujo_id).values_list('proyecto', flat=True).first()
+        #si el flujo ya se elimino no se sabe el proyecto
+        invalidar_reportes([proyecto_id] if proyecto_id else None)
+    else:
+        #sprints, flujos y miembros de equipo; los flujos de las plantillas no tienen proyecto
+        invalidar_reportes([instance.proyecto_id])
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Almacenamiento del contenido de los archivos adjuntos fuera de la base de datos.
+
+El contenido se guarda direccionado por su hash SHA-256: dos adjuntos con el mismo contenido comparten
+el mismo archivo. El backend se configura con ATTACHMENT_STORAGE, por lo que se puede reemplazar el
+almacen en disco por otro con la misma interfaz.
+"""
+import errno
+import hashlib
+import os
+import tempfile
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class FileSystemBlobStore(object):
+    """
+    Almacen de contenido en el sistema de archivos. Cada contenido se guarda en
+    <location>/<2 caracteres>/<2 caracteres>/<sha256>, de manera que los directorios no crezcan demasiado.
+    """
+
+    def __init__(self, location):
+        self.location = location
+
+    def path(self, sha256):
+        """
+        :param sha256: hash del contenido
+        :return: ruta del archivo con el contenido
+        """
+        return os.path.join(self.location, sha256[:2], sha256[2:4], sha256)
+
+    def exists(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def save(self, contenido):
+        """
+        Guarda un contenido. Si ya existe un contenido igual no se vuelve a escribir.
+
+        :param contenido: bytes o iterable de bloques de bytes, por ejemplo UploadedFile.chunks()
+        :return: tupla (sha256, tamano en bytes)
+        """
+        if isinstance(contenido, bytes):
+            contenido = [contenido]
+        if not os.path.isdir(self.location):
+            self._makedirs(self.location)
+        #Se escribe en un archivo temporal mientras se calcula el hash, y luego se mueve a su lugar
+        fd, temporal = tempfile.mkstemp(dir=self.location, prefix='.tmp')
+        sha = hashlib.sha256()
+        tamano = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for bloque in contenido:
+                    sha.update(bloque)
+                    tamano += len(bloque)
+                    f.write(bloque)
+            sha256 = sha.hexdigest()
+            ruta = self.path(sha256)
+            if os.path.exists(ruta):
+                os.remove(temporal)
+                #se actualiza la fecha para que clean_attachments no lo tome como huerfano mientras se
+                #guarda el adjunto que lo vuelve a usar
+                os.utime(ruta, None)
+            else:
+                self._makedirs(os.path.dirname(ruta))
+                os.rename(temporal, ruta)
+        except Exception:
+            if os.path.exists(temporal):
+                os.remove(temporal)
+            raise
+        return sha256, tamano
+
+    def open(self, sha256):
+        """
+        :param sha256: hash del contenido
+        :return: el contenido como archivo abierto en modo binario
+        """
+        return open(self.path(sha256), 'rb')
+
+    def size(self, sha256):
+        return os.path.getsize(self.path(sha256))
+
+    def listar(self):
+        """
+        :return: iterador de tuplas (sha256, fecha de ultima escritura) de los contenidos guardados
+        """
+        for raiz, directorios, archivos in os.walk(self.location):
+            for nombre in archivos:
+                if nombre.startswith('.tmp'):
+                    continue
+                try:
+                    yield nombre, os.path.getmtime(os.path.join(raiz, nombre))
+                except OSError:
+                    continue
+
+    def delete(self, sha256):
+        try:
+            os.remove(self.path(sha256))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    @staticmethod
+    def _makedirs(directorio):
+        try:
+            os.makedirs(directorio)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def get_blob_store():
+    """
+    Retorna el almacen de adjuntos configurado en ATTACHMENT_STORAGE.
+    """
+    config = settings.ATTACHMENT_STORAGE
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
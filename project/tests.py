@@ -1,14 +1,44 @@
 # -*- coding: utf-8 -*-
 import datetime
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from StringIO import StringIO
+from xml.etree import ElementTree
+from importlib import import_module
+from PIL import Image
+from django.apps import apps
+from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.models import Permission
 from django.core.urlresolvers import reverse
-from django.test import TestCase
-from django.contrib.auth.models import User, Group, Permission
+from django.test import TestCase, RequestFactory
+from django.views.generic.detail import SingleObjectMixin
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.db import connection, transaction
+from django.contrib.auth.models import AnonymousUser, User, Group, Permission
 from django.contrib.auth import SESSION_KEY
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db.models import Sum
 from django.utils import timezone
 import reversion
-from project.models import Proyecto, Flujo, UserStory, Sprint, Actividad
+from guardian.exceptions import WrongAppError
+from guardian.models import UserObjectPermission
+from guardian.shortcuts import assign_perm, get_perms
+from project import charts, reports
+from project import estadisticas, imagenes
+from project import context_processors
+from project.context_processors import nav_context_processor
+from project.management.commands.benchmark_charts import ExportadorFalso, burndown_de_prueba
+from project.permissions import PermisosUsuario, sincronizar_permisos_roles
+from project.models import Proyecto, Flujo, UserStory, Sprint, Actividad, Nota, SprintDaySnapshot, ReportJob, \
+    Adjunto, MiembroEquipo
 
 
 class LoginTest(TestCase):
@@ -1017,3 +1047,1655 @@ class SprintTest(TestCase):
             s=Sprint.objects.first()
             response = c.get(reverse('project:sprint_update', args=(str(s.id))))
             self.assertEquals(response.status_code, 403)
+
+
+def burndown_por_dia(sprint):
+    """
+    Implementacion original del burndown, con consultas por cada dia del sprint.
+    Se mantiene como referencia para comprobar los resultados de get_sprint_burndown.
+    """
+    from project.views import daterange
+    total = sprint.userstory_set.aggregate(sum=Sum('tiempo_estimado'))['sum']
+    h_restante = h_total = total if total else 0
+    lh_real = [h_total]
+    lh_ideal = [h_total]
+    m = float(h_total) / sprint.proyecto.duracion_sprint
+    us_restante = us_total = sprint.userstory_set.count()
+    lus_restante = [us_total]
+    lus_completado = [0]
+    db_hwork = [0]
+    for dia in daterange(sprint.inicio, sprint.fin):
+        notas = sprint.nota_set.filter(fecha__year=dia.year, fecha__month=dia.month, fecha__day=dia.day)
+        completados = notas.filter(estado=3).count()
+        hwork = notas.aggregate(sum=Sum('horas_a_registrar'))['sum']
+        hwork = hwork if hwork else 0
+        db_hwork.append(hwork)
+        h_restante -= hwork if h_restante >= hwork else 0
+        h_total -= m
+        us_restante -= completados
+        lh_real.append(h_restante)
+        lh_ideal.append(round(h_total, 1))
+        lus_restante.append(us_restante if us_restante > 0 else 0)
+        lus_completado.append(completados)
+    return {'ideal': lh_ideal, 'real': lh_real, 'us_faltante': lus_restante, 'us_terminado': lus_completado, 'db_hwork': db_hwork}
+
+
+def cargar_fixture(nombre, modelos):
+    """
+    Carga solo los modelos indicados de un fixture. Los fixtures incluyen content types y permisos con
+    claves fijas que no coinciden con los de la base de pruebas, por eso se filtran.
+    """
+    with open(os.path.join(settings.BASE_DIR, 'fixtures', nombre)) as f:
+        objetos = [o for o in json.load(f) if o['model'] in modelos]
+    for o in objetos:
+        if o['model'] == 'auth.user':
+            o['fields'].pop('groups', None)
+            o['fields'].pop('user_permissions', None)
+    archivo = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+    try:
+        json.dump(objetos, archivo)
+        archivo.close()
+        call_command('loaddata', archivo.name, verbosity=0)
+    finally:
+        os.remove(archivo.name)
+
+
+class BaseDatosFinalTestCase(TestCase):
+    """
+    Pruebas que usan los datos de fixtures/basededatosfinal.json, cargados antes de cada prueba.
+    """
+    modelos_fixture = ['auth.user', 'project.proyecto', 'project.sprint', 'project.flujo', 'project.actividad',
+                       'project.userstory', 'project.nota']
+
+    def setUp(self):
+        cargar_fixture('basededatosfinal.json', self.modelos_fixture)
+
+
+class BurndownTest(BaseDatosFinalTestCase):
+
+    def setUp(self):
+        super(BurndownTest, self).setUp()
+        #project.forms consulta la base de datos al importarse, por eso las vistas se importan aca
+        from project.views import get_sprint_burndown, get_project_burndown
+        self.get_sprint_burndown = get_sprint_burndown
+        self.get_project_burndown = get_project_burndown
+        call_command('rebuild_burndown', verbosity=0)
+
+    def get_snapshots(self, sprint):
+        return list(SprintDaySnapshot.objects.filter(sprint=sprint).values_list('dia', 'horas_trabajadas',
+                                                                               'us_completados'))
+
+    def test_burndown_igual_a_consulta_por_dia(self):
+        sprints = Sprint.objects.all()
+        self.assertTrue(sprints.exists())
+        for sprint in sprints:
+            self.assertEquals(self.get_sprint_burndown(sprint), burndown_por_dia(sprint))
+
+    def test_burndown_cantidad_de_consultas_constante(self):
+        #la cantidad de consultas no depende de la duracion del sprint
+        for sprint in Sprint.objects.all():
+            sprint = Sprint.objects.get(pk=sprint.pk)
+            with self.assertNumQueries(3):
+                self.get_sprint_burndown(sprint)
+
+    def test_snapshot_incremental_igual_a_reconstruccion(self):
+        sprint = Sprint.objects.filter(userstory__isnull=False).distinct().first()
+        us = sprint.userstory_set.first()
+        for dias, horas, estado in [(0, 5, 2), (1, 3, 2), (1, 2, 3), (4, 8, 3)]:
+            Nota.objects.create(user_story=us, sprint=sprint, fecha=sprint.inicio + datetime.timedelta(dias),
+                                horas_a_registrar=horas, estado=estado)
+        incremental = self.get_snapshots(sprint)
+        SprintDaySnapshot.reconstruir(sprint)
+        self.assertEquals(incremental, self.get_snapshots(sprint))
+        self.assertEquals(self.get_sprint_burndown(sprint), burndown_por_dia(sprint))
+
+    def test_snapshot_al_modificar_nota(self):
+        sprints = Sprint.objects.filter(userstory__isnull=False).distinct()
+        sprint, otro = sprints[0], Sprint.objects.exclude(pk=sprints[0].pk).first()
+        us = sprint.userstory_set.first()
+        nota = Nota.objects.create(user_story=us, sprint=sprint, fecha=sprint.inicio + datetime.timedelta(1),
+                                   horas_a_registrar=4, estado=2)
+        nota.horas_a_registrar = 9
+        nota.estado = 3
+        nota.fecha = sprint.inicio + datetime.timedelta(3)
+        nota.save()
+        incremental = self.get_snapshots(sprint)
+        SprintDaySnapshot.reconstruir(sprint)
+        self.assertEquals([s for s in incremental if s[1] or s[2]],
+                          [s for s in self.get_snapshots(sprint) if s[1] or s[2]])
+        #al cambiar de sprint la nota se descuenta del anterior y se suma al nuevo
+        nota.sprint = otro
+        nota.save()
+        for s in (sprint, otro):
+            incremental = self.get_snapshots(s)
+            SprintDaySnapshot.reconstruir(s)
+            self.assertEquals([x for x in incremental if x[1] or x[2]],
+                              [x for x in self.get_snapshots(s) if x[1] or x[2]])
+
+    def test_snapshot_al_eliminar_nota(self):
+        sprint = Sprint.objects.filter(userstory__isnull=False).distinct().first()
+        us = sprint.userstory_set.first()
+        antes = self.get_snapshots(sprint)
+        nota = Nota.objects.create(user_story=us, sprint=sprint, fecha=sprint.inicio + datetime.timedelta(2),
+                                   horas_a_registrar=7, estado=3)
+        self.assertNotEquals(antes, self.get_snapshots(sprint))
+        nota.delete()
+        self.assertEquals([s[1:] for s in antes if s[1] or s[2]],
+                          [s[1:] for s in self.get_snapshots(sprint) if s[1] or s[2]])
+
+    def test_burndown_proyecto_igual_a_burndown_por_sprint(self):
+        for proyecto in Proyecto.objects.filter(sprint__isnull=False).distinct():
+            datos = self.get_project_burndown(proyecto)
+            self.assertEquals(len(datos['burndowns']), proyecto.sprint_set.count())
+            for sprint, burndown in datos['burndowns']:
+                self.assertEquals(burndown, self.get_sprint_burndown(sprint))
+            trabajado = [sum(b['db_hwork']) for s, b in datos['burndowns']]
+            self.assertEquals(datos['velocidad']['trabajado'], trabajado)
+
+    def test_burndown_proyecto_cantidad_de_consultas_constante(self):
+        #sprints, totales de user stories y resumenes diarios, sin importar la cantidad de sprints
+        for proyecto in Proyecto.objects.all():
+            with self.assertNumQueries(3):
+                self.get_project_burndown(proyecto)
+
+    def test_velocidad_proyecto(self):
+        User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.client.login(username='admin_test', password='admin_test')
+        proyecto = Proyecto.objects.filter(sprint__isnull=False).distinct().first()
+        response = self.client.get(reverse('project:project_velocity', args=(proyecto.pk,)))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(len(response.context['resumen']), proyecto.sprint_set.count())
+        #el nombre del proyecto se escapa dentro del javascript del grafico
+        Proyecto.objects.filter(pk=proyecto.pk).update(nombre_corto="Vel'ocidad")
+        response = self.client.get(reverse('project:project_velocity', args=(proyecto.pk,)))
+        self.assertContains(response, "text: 'Vel\\u0027ocidad'")
+
+
+class BurndownChartTest(BaseDatosFinalTestCase):
+
+    def setUp(self):
+        super(BurndownChartTest, self).setUp()
+        call_command('rebuild_burndown', verbosity=0)
+        from project.views import get_graficos, get_sprint_burndown
+        self.get_graficos = get_graficos
+        self.get_sprint_burndown = get_sprint_burndown
+        self.proyecto = Proyecto.objects.filter(sprint__isnull=False).distinct().first()
+
+    def test_escala(self):
+        self.assertEquals(charts.escala(0), (1, 5))
+        self.assertEquals(charts.escala(100), (20, 100))
+        self.assertEquals(charts.escala(97), (20, 100))
+        self.assertEquals(charts.escala(12), (2.5, 12.5))
+
+    def test_svg_burndown(self):
+        sprint = self.proyecto.sprint_set.first()
+        burndown = self.get_sprint_burndown(sprint)
+        svg = ElementTree.fromstring(charts.burndown_svg(burndown, u'Sprint <ñ>').encode('utf-8'))
+        lineas = svg.findall('{http://www.w3.org/2000/svg}polyline')
+        self.assertEquals(len(lineas), 2)
+        self.assertEquals(len(lineas[0].get('points').split()), len(burndown['ideal']))
+        self.assertEquals(len(lineas[1].get('points').split()), len(burndown['real']))
+
+    def test_graficos_svg_sin_exportador(self):
+        graficos = self.get_graficos(self.proyecto)
+        self.assertEquals(len(graficos), self.proyecto.sprint_set.count())
+        for g in graficos:
+            self.assertTrue(g.startswith('data:image/svg+xml;base64,'))
+
+    def test_graficos_highcharts(self):
+        exportador = ExportadorFalso().iniciar()
+        try:
+            with self.settings(BURNDOWN_CHART_RENDERER='highcharts', HIGHCHARTS_EXPORT_URL=exportador.url):
+                graficos = self.get_graficos(self.proyecto)
+        finally:
+            exportador.detener()
+        self.assertEquals(exportador.pedidos, self.proyecto.sprint_set.count())
+        for g in graficos:
+            self.assertTrue(g.startswith('data:image/png;base64,'))
+
+    def test_reporte_burndown_pdf(self):
+        User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.client.login(username='admin_test', password='admin_test')
+        response = self.client.get(reverse('project:reporte_burndown', args=(self.proyecto.pk,)))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'application/pdf')
+
+    def test_reporte_burndown_sin_exportador(self):
+        User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.client.login(username='admin_test', password='admin_test')
+        exportador = ExportadorFalso().iniciar()
+        exportador.detener()
+        with self.settings(BURNDOWN_CHART_RENDERER='highcharts', HIGHCHARTS_EXPORT_URL=exportador.url):
+            response = self.client.get(reverse('project:reporte_burndown', args=(self.proyecto.pk,)))
+        self.assertTemplateUsed(response, 'reportes/export_error.html')
+
+    def test_benchmark_charts(self):
+        salida = StringIO()
+        call_command('benchmark_charts', graficos=2, stdout=salida)
+        self.assertIn('SVG interno', salida.getvalue())
+
+
+class ExportacionConcurrenteTest(TestCase):
+
+    def setUp(self):
+        self.burndowns = [(burndown_de_prueba(10), 'Sprint %d' % i) for i in range(4)]
+
+    def exportar(self, exportador, **kwargs):
+        with self.settings(BURNDOWN_CHART_RENDERER='highcharts', HIGHCHARTS_EXPORT_URL=exportador.url, **kwargs):
+            inicio = time.time()
+            graficos = charts.graficos_burndown(self.burndowns)
+            return graficos, time.time() - inicio
+
+    def test_exportacion_en_paralelo(self):
+        #cuatro graficos de 0.3s terminan en aproximadamente el tiempo del mas lento
+        exportador = ExportadorFalso(latencia=0.3).iniciar()
+        try:
+            graficos, duracion = self.exportar(exportador, HIGHCHARTS_EXPORT_WORKERS=4)
+        finally:
+            exportador.detener()
+        self.assertEquals(exportador.pedidos, 4)
+        self.assertTrue(all(g.startswith('data:image/png;base64,') for g in graficos))
+        self.assertLess(duracion, 0.9)
+
+    def test_grafico_fallido_no_cancela_el_reporte(self):
+        exportador = ExportadorFalso(latencia=0.1, demoras={'Sprint 2': 3}).iniciar()
+        try:
+            graficos, duracion = self.exportar(exportador, HIGHCHARTS_EXPORT_TIMEOUT=0.5)
+        finally:
+            exportador.detener()
+        self.assertIsNone(graficos[2])
+        self.assertEquals(len([g for g in graficos if g]), 3)
+        self.assertLess(duracion, 2)
+
+    def test_reutiliza_conexiones(self):
+        exportador = ExportadorFalso().iniciar()
+        try:
+            graficos, duracion = self.exportar(exportador, HIGHCHARTS_EXPORT_WORKERS=1)
+        finally:
+            exportador.detener()
+        self.assertEquals(exportador.pedidos, 4)
+        self.assertEquals(exportador.conexiones, 1)
+
+
+class CacheGraficosTest(TestCase):
+
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        self.burndowns = [(burndown_de_prueba(10), 'Sprint %d' % i) for i in range(3)]
+        self.inicial = charts.cache_graficos.stats()
+
+    def tearDown(self):
+        shutil.rmtree(self.directorio)
+
+    def contador(self, nombre):
+        return charts.cache_graficos.stats()[nombre] - self.inicial[nombre]
+
+    def test_grafico_identico_no_contacta_al_exportador(self):
+        exportador = ExportadorFalso().iniciar()
+        try:
+            with self.settings(BURNDOWN_CHART_RENDERER='highcharts', HIGHCHARTS_EXPORT_URL=exportador.url,
+                               CHART_CACHE_DIR=self.directorio):
+                primeros = charts.graficos_burndown(self.burndowns)
+                segundos = charts.graficos_burndown(self.burndowns)
+        finally:
+            exportador.detener()
+        self.assertEquals(primeros, segundos)
+        self.assertEquals(exportador.pedidos, 3)
+        self.assertEquals(self.contador('misses'), 3)
+        self.assertEquals(self.contador('hits'), 3)
+
+    def test_clave_depende_de_la_configuracion(self):
+        with self.settings(CHART_CACHE_DIR=self.directorio):
+            charts.grafico_burndown(*self.burndowns[0])
+            charts.grafico_burndown(burndown_de_prueba(11), 'Sprint 0')
+            with self.settings(BURNDOWN_CHART_RENDERER='otro'):
+                charts.grafico_burndown(*self.burndowns[0])
+        self.assertEquals(self.contador('misses'), 3)
+        self.assertEquals(self.contador('hits'), 0)
+
+    def test_error_al_escribir_no_falla(self):
+        archivo = os.path.join(self.directorio, 'archivo')
+        open(archivo, 'w').close()
+        with self.settings(CHART_CACHE_DIR=os.path.join(archivo, 'graficos')):
+            grafico = charts.grafico_burndown(*self.burndowns[0])
+        self.assertTrue(grafico.startswith('data:image/svg+xml;base64,'))
+
+    def test_directorio_recorrido_una_vez(self):
+        recorridos = []
+        entradas = charts.cache_graficos.entradas
+        charts.cache_graficos.entradas = lambda: recorridos.append(1) or entradas()
+        try:
+            with self.settings(CHART_CACHE_DIR=self.directorio):
+                charts.graficos_burndown(self.burndowns)
+        finally:
+            del charts.cache_graficos.entradas
+        self.assertEquals(len(recorridos), 1)
+        self.assertEquals(charts.cache_graficos._total[1], sum(
+            os.path.getsize(os.path.join(self.directorio, n)) for n in os.listdir(self.directorio)))
+
+    def test_desalojo_lru_con_tamano_maximo(self):
+        with self.settings(CHART_CACHE_DIR=self.directorio):
+            grafico = charts.grafico_burndown(*self.burndowns[0])
+            with self.settings(CHART_CACHE_MAX_BYTES=len(grafico) * 2 + 10):
+                charts.grafico_burndown(*self.burndowns[1])
+                #el segundo queda como el usado hace mas tiempo, aunque el primero se haya escrito antes
+                clave = charts.cache_graficos.clave('svg', charts.highcharts_infile(*self.burndowns[1]))
+                os.utime(charts.cache_graficos.ruta(clave), (0, 0))
+                charts.grafico_burndown(*self.burndowns[0])
+                charts.grafico_burndown(*self.burndowns[2])
+            self.assertEquals(self.contador('evictions'), 1)
+            self.assertEquals(charts.cache_graficos.stats()['entradas'], 2)
+            hits = self.contador('hits')
+            charts.grafico_burndown(*self.burndowns[0])
+            self.assertEquals(self.contador('hits'), hits + 1)
+            charts.grafico_burndown(*self.burndowns[1])
+            self.assertEquals(self.contador('hits'), hits + 1)
+
+
+class ReportJobTest(BaseDatosFinalTestCase):
+
+    def setUp(self):
+        super(ReportJobTest, self).setUp()
+        User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.client.login(username='admin_test', password='admin_test')
+        self.proyecto = Proyecto.objects.filter(userstory__isnull=False).distinct().first()
+        self.directorio = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directorio)
+
+    def encolar(self, directorio=None):
+        url = reverse('project:reporte_backlog_producto', args=(self.proyecto.pk,)) + '?async=1'
+        with self.settings(REPORT_WORKERS=0, REPORT_ROOT=directorio or self.directorio):
+            return self.client.get(url)
+
+    def test_reporte_asincronico(self):
+        response = self.encolar()
+        job = ReportJob.objects.get()
+        self.assertRedirects(response, unicode(job.get_absolute_url()))
+        self.assertEquals(job.estado, ReportJob.TERMINADO)
+        self.assertEquals(job.usuario.username, 'admin_test')
+
+        estado = json.loads(self.client.get(reverse('project:report_job_status', args=(job.pk,))).content)
+        self.assertEquals(estado['estado'], ReportJob.TERMINADO)
+        self.assertEquals(estado['descarga'], job.get_download_url())
+
+        with self.settings(REPORT_ROOT=self.directorio):
+            response = self.client.get(job.get_download_url())
+            contenido = ''.join(response.streaming_content)
+        self.assertEquals(response['Content-Type'], 'application/pdf')
+        self.assertEquals(int(response['Content-Length']), len(contenido))
+        self.assertTrue(contenido.startswith('%PDF'))
+
+    def test_reporte_sincronico_sin_parametro(self):
+        response = self.client.get(reverse('project:reporte_backlog_producto', args=(self.proyecto.pk,)))
+        self.assertEquals(response['Content-Type'], 'application/pdf')
+        self.assertFalse(ReportJob.objects.exists())
+
+    def test_error_al_generar(self):
+        archivo = os.path.join(self.directorio, 'archivo')
+        open(archivo, 'w').close()
+        self.encolar(archivo)
+        job = ReportJob.objects.get()
+        self.assertEquals(job.estado, ReportJob.ERROR)
+        self.assertNotEquals(job.error, '')
+        self.assertEquals(self.client.get(job.get_download_url()).status_code, 404)
+
+    def test_trabajo_de_otro_usuario(self):
+        self.encolar()
+        job = ReportJob.objects.get()
+        User.objects.create_user('otro', 'otro@test.com', 'otro')
+        self.client.login(username='otro', password='otro')
+        self.assertEquals(self.client.get(job.get_absolute_url()).status_code, 404)
+        self.assertEquals(self.client.get(job.get_download_url()).status_code, 404)
+
+
+    def test_limpieza_de_trabajos(self):
+        usuario = User.objects.get(username='admin_test')
+        hace = lambda segundos: timezone.now() - datetime.timedelta(seconds=segundos)
+        viejo = ReportJob.objects.create(usuario=usuario, nombre='Viejo', estado=ReportJob.TERMINADO,
+                                         archivo='viejo.pdf', fin=hace(8 * 24 * 3600))
+        nuevo = ReportJob.objects.create(usuario=usuario, nombre='Nuevo', estado=ReportJob.TERMINADO,
+                                         archivo='nuevo.pdf', fin=hace(60))
+        colgado = ReportJob.objects.create(usuario=usuario, nombre='Colgado', estado=ReportJob.GENERANDO)
+        ReportJob.objects.filter(pk=colgado.pk).update(creacion=hace(2 * 3600))
+        en_curso = ReportJob.objects.create(usuario=usuario, nombre='En curso', estado=ReportJob.PENDIENTE)
+        for nombre in ('viejo.pdf', 'nuevo.pdf', 'huerfano.pdf', '.tmpreciente'):
+            open(os.path.join(self.directorio, nombre), 'w').close()
+        for nombre in ('viejo.pdf', 'nuevo.pdf', 'huerfano.pdf'):
+            os.utime(os.path.join(self.directorio, nombre), (0, 0))
+        salida = StringIO()
+        with self.settings(REPORT_ROOT=self.directorio):
+            call_command('clean_report_jobs', stdout=salida)
+        self.assertIn('1 trabajos interrumpidos, 1 trabajos y 2 archivos eliminados', salida.getvalue())
+        self.assertEquals(sorted(os.listdir(self.directorio)), ['.tmpreciente', 'nuevo.pdf'])
+        self.assertFalse(ReportJob.objects.filter(pk=viejo.pk).exists())
+        self.assertEquals(ReportJob.objects.get(pk=nuevo.pk).estado, ReportJob.TERMINADO)
+        self.assertEquals(ReportJob.objects.get(pk=colgado.pk).estado, ReportJob.ERROR)
+        self.assertEquals(ReportJob.objects.get(pk=en_curso.pk).estado, ReportJob.PENDIENTE)
+
+class CacheReportesTest(BaseDatosFinalTestCase):
+
+    def setUp(self):
+        super(CacheReportesTest, self).setUp()
+        User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.client.login(username='admin_test', password='admin_test')
+        self.proyecto = Proyecto.objects.filter(userstory__isnull=False).distinct().first()
+        self.url = reverse('project:reporte_backlog_producto', args=(self.proyecto.pk,))
+        self.directorio = tempfile.mkdtemp()
+        #se cuentan las veces que se ejecuta WeasyPrint
+        self.generados = 0
+        self.escribir_pdf = reports.escribir_pdf
+
+        def contar(*args):
+            self.generados += 1
+            return self.escribir_pdf(*args)
+        reports.escribir_pdf = contar
+
+    def tearDown(self):
+        reports.escribir_pdf = self.escribir_pdf
+        shutil.rmtree(self.directorio)
+
+    def get(self, url=None, **extra):
+        with self.settings(REPORT_CACHE_DIR=self.directorio):
+            return self.client.get(url or self.url, **extra)
+
+    def test_etag_y_304(self):
+        response = self.get()
+        self.assertEquals(response.status_code, 200)
+        etag = response['ETag']
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(self.generados, 1)
+
+    def test_pdf_servido_desde_la_cache(self):
+        primero = self.get()
+        segundo = self.get()
+        self.assertEquals(''.join(primero.streaming_content), ''.join(segundo.streaming_content))
+        self.assertEquals(primero['ETag'], segundo['ETag'])
+        self.assertEquals(self.generados, 1)
+
+    def test_cambio_de_datos_invalida_la_cache(self):
+        etag = self.get()['ETag']
+        us = self.proyecto.userstory_set.first()
+        UserStory.objects.filter(pk=us.pk).update(nombre='Modificado', ultimo_cambio=timezone.now())
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response['ETag'], etag)
+        self.assertEquals(self.generados, 2)
+        #solo se conserva la ultima version del reporte
+        self.assertEquals(len(os.listdir(self.directorio)), 1)
+
+    def test_cambio_de_objetos_relacionados_invalida_la_cache(self):
+        etag = self.get()['ETag']
+        us = self.proyecto.userstory_set.exclude(sprint=None).exclude(desarrollador=None).first()
+        objetos = [Sprint.objects.get(pk=us.sprint_id), User.objects.get(pk=us.desarrollador_id),
+                   MiembroEquipo.objects.filter(proyecto=self.proyecto).first()]
+        if us.actividad_id:
+            objetos.append(Flujo.objects.get(actividad=us.actividad_id))
+        for objeto in objetos:
+            objeto.save()
+            response = self.get(HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(response.status_code, 200)
+            self.assertNotEquals(response['ETag'], etag)
+            etag = response['ETag']
+
+    def test_inicio_de_sesion_no_invalida_la_cache(self):
+        etag = self.get()['ETag']
+        self.client.login(username='admin_test', password='admin_test')
+        self.assertEquals(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_version_con_consultas_agregadas(self):
+        from project.views import pdf_views
+        #dos agregaciones, sin leer los user stories ni sus relaciones
+        with self.assertNumQueries(2):
+            pdf_views.version_proyecto(None, self.proyecto.pk)
+
+    def test_version_de_los_reportes_en_el_etag(self):
+        from project.views import pdf_views
+        etag = self.get()['ETag']
+        version = pdf_views.VERSION_REPORTES
+        pdf_views.VERSION_REPORTES = version + 1
+        try:
+            self.assertNotEquals(self.get()['ETag'], etag)
+        finally:
+            pdf_views.VERSION_REPORTES = version
+
+    def test_cache_respeta_permisos(self):
+        sprint = Sprint.objects.filter(proyecto=self.proyecto).first()
+        url = reverse('project:reporte_backlog_sprint', args=(sprint.pk,))
+        self.assertEquals(self.get(url).status_code, 200)
+        User.objects.create_user('otro', 'otro@test.com', 'otro')
+        self.client.login(username='otro', password='otro')
+        self.assertEquals(self.get(url).status_code, 403)
+
+    def test_reporte_asincronico_usa_la_cache(self):
+        raiz = tempfile.mkdtemp()
+        try:
+            with self.settings(REPORT_WORKERS=0, REPORT_ROOT=raiz):
+                response = self.get(self.url + '?async=1')
+                self.assertEquals(response.status_code, 302)
+                self.assertEquals(ReportJob.objects.get().estado, ReportJob.TERMINADO)
+                #el trabajo guardo el PDF en la cache: el siguiente pedido no lo vuelve a generar
+                response = self.get(self.url + '?async=1')
+        finally:
+            shutil.rmtree(raiz)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(''.join(response.streaming_content).startswith('%PDF'))
+        self.assertEquals(ReportJob.objects.count(), 1)
+        self.assertEquals(self.generados, 1)
+        self.assertEquals(self.get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_directorio_de_la_cache_no_se_puede_escribir(self):
+        #un archivo en lugar del directorio: no se puede crear ni escribir en el, aun como root
+        archivo = os.path.join(self.directorio, 'archivo')
+        open(archivo, 'w').close()
+        for directorio in [archivo, os.path.join(archivo, 'reportes')]:
+            with self.settings(REPORT_CACHE_DIR=directorio):
+                response = self.client.get(self.url)
+            self.assertEquals(response.status_code, 200)
+            self.assertTrue(''.join(response.streaming_content).startswith('%PDF'))
+        self.assertEquals(os.listdir(self.directorio), ['archivo'])
+
+
+def backlog_producto_por_estado(project):
+    """
+    Implementacion anterior de los datos del reporte de backlog: dos agregaciones por estado.
+    Se usa como referencia en las pruebas.
+    """
+    datos = {}
+    for estado, clave in [(4, 'cancelados'), (0, 'inactivos'), (1, 'en_curso'), (2, 'pendientes'), (3, 'aprobados')]:
+        us_set = project.userstory_set.filter(estado=estado).order_by('sprint__inicio', '-prioridad')
+        datos[clave] = set(us_set)
+        datos['sum_' + clave] = us_set.aggregate(sum=Sum('tiempo_estimado'))['sum']
+        datos['sum_%s_real' % clave] = us_set.aggregate(sum=Sum('tiempo_registrado'))['sum']
+    datos['sum_proyecto'] = sum(datos['sum_' + c] or 0 for c in ['cancelados', 'inactivos', 'en_curso', 'pendientes', 'aprobados'])
+    datos['sum_proyecto_real'] = sum(datos['sum_%s_real' % c] or 0 for c in ['cancelados', 'inactivos', 'en_curso', 'pendientes', 'aprobados'])
+    return datos
+
+
+class BacklogProductoTest(BaseDatosFinalTestCase):
+
+    def setUp(self):
+        super(BacklogProductoTest, self).setUp()
+        from project.views import get_backlog_producto
+        self.get_backlog_producto = get_backlog_producto
+
+    def test_igual_a_agregaciones_por_estado(self):
+        proyectos = Proyecto.objects.filter(userstory__isnull=False).distinct()
+        self.assertTrue(proyectos.exists())
+        for proyecto in proyectos:
+            contexto = self.get_backlog_producto(proyecto)
+            referencia = backlog_producto_por_estado(proyecto)
+            for clave, valor in referencia.items():
+                if isinstance(valor, set):
+                    self.assertEquals(set(contexto[clave]), valor)
+                    #la posicion de los user stories sin sprint depende de la base de datos
+                    orden = [(us.sprint.inicio, -us.prioridad) for us in contexto[clave] if us.sprint]
+                    self.assertEquals(orden, sorted(orden))
+                else:
+                    self.assertEquals(contexto[clave], valor)
+
+    def test_cantidad_de_consultas(self):
+        #una consulta de los user stories con sus relaciones y otra agrupada de las estadisticas del proyecto
+        proyecto = Proyecto.objects.filter(userstory__isnull=False).distinct().first()
+        with self.assertNumQueries(2):
+            contexto = self.get_backlog_producto(proyecto)
+            for clave in ['cancelados', 'inactivos', 'en_curso', 'pendientes', 'aprobados']:
+                for us in contexto[clave]:
+                    unicode(us.desarrollador), unicode(us.sprint), us.actividad and unicode(us.actividad.flujo)
+
+
+class ReporteStreamingTest(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.client.login(username='admin_test', password='admin_test')
+        self.proyecto = Proyecto.objects.create(nombre_corto='Grande', nombre_largo='Backlog grande',
+                                                inicio=timezone.now(), fin=timezone.now(), duracion_sprint=30,
+                                                descripcion='Proyecto con un backlog grande')
+        UserStory.objects.bulk_create([UserStory(nombre='US %d' % i, descripcion='Descripcion ' * 50, valor_negocio=1,
+                                                 valor_tecnico=1, tiempo_estimado=i % 20, estado=i % 5,
+                                                 proyecto=self.proyecto) for i in range(500)])
+
+    def test_pdf_grande_por_bloques(self):
+        generados = []
+        generar_pdf = reports.generar_pdf
+
+        def guardar(*args):
+            generados.append(generar_pdf(*args))
+            return generados[-1]
+        reports.generar_pdf = guardar
+        try:
+            with self.settings(REPORT_SPOOL_MAX_BYTES=64 * 1024):
+                response = self.client.get(reverse('project:reporte_backlog_producto', args=(self.proyecto.pk,)))
+        finally:
+            reports.generar_pdf = generar_pdf
+        self.assertEquals(response['Content-Type'], 'application/pdf')
+        self.assertTrue(response.streaming)
+        #el PDF supera el limite en memoria, por lo que se genero en un archivo temporal
+        self.assertTrue(generados[0]._rolled)
+        bloques = list(response.streaming_content)
+        self.assertTrue(len(bloques) > 1)
+        self.assertTrue(all(len(b) <= reports.BLOQUE for b in bloques))
+        self.assertEquals(int(response['Content-Length']), sum(len(b) for b in bloques))
+        self.assertTrue(int(response['Content-Length']) > 64 * 1024)
+
+
+class AlmacenEnMemoria(object):
+    """
+    Almacen de adjuntos de prueba que no usa el sistema de archivos. Falla al guardar un contenido que
+    contiene 'sin espacio', como si el disco estuviera lleno.
+    """
+    contenidos = {}
+
+    def save(self, contenido):
+        contenido = b''.join(contenido)
+        if b'sin espacio' in contenido:
+            raise IOError(28, 'No queda espacio en el dispositivo')
+        sha256 = hashlib.sha256(contenido).hexdigest()
+        self.contenidos[sha256] = contenido
+        return sha256, len(contenido)
+
+    def open(self, sha256):
+        return StringIO(self.contenidos[sha256])
+
+    def size(self, sha256):
+        return len(self.contenidos[sha256])
+
+    def exists(self, sha256):
+        return sha256 in self.contenidos
+
+    def delete(self, sha256):
+        self.contenidos.pop(sha256, None)
+
+
+class AdjuntoTest(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.client.login(username='admin_test', password='admin_test')
+        proyecto = Proyecto.objects.create(nombre_corto='Adjuntos', nombre_largo='Adjuntos', inicio=timezone.now(),
+                                           fin=timezone.now(), descripcion='Proyecto con adjuntos')
+        self.us = UserStory.objects.create(nombre='US', descripcion='US con adjuntos', valor_negocio=1,
+                                           valor_tecnico=1, tiempo_estimado=1, proyecto=proyecto)
+        self.directorio = tempfile.mkdtemp()
+        self.derivados = tempfile.mkdtemp()
+        self.storage = override_settings(ATTACHMENT_STORAGE={'BACKEND': 'project.storage.FileSystemBlobStore',
+                                                             'OPTIONS': {'location': self.directorio}},
+                                         ATTACHMENT_DERIVATIVES_DIR=self.derivados)
+        self.storage.enable()
+
+    def tearDown(self):
+        self.storage.disable()
+        shutil.rmtree(self.directorio)
+        shutil.rmtree(self.derivados)
+
+    def subir(self, contenido, nombre='archivo.txt', content_type='text/plain'):
+        archivo = SimpleUploadedFile(nombre, contenido, content_type=content_type)
+        self.client.post(reverse('project:file_upload', args=(self.us.pk,)),
+                         {'nombre': nombre, 'descripcion': 'Archivo de prueba', 'file': archivo})
+        return Adjunto.objects.latest('pk')
+
+    def descargar(self, adjunto):
+        response = self.client.get(reverse('project:download_attachment', args=(adjunto.pk,)))
+        return ''.join(response.streaming_content) if response.streaming else response.content
+
+    def blobs(self):
+        return [f for _, _, archivos in os.walk(self.directorio) for f in archivos]
+
+    def test_subir_guarda_en_el_almacen(self):
+        adjunto = self.subir('contenido del archivo')
+        self.assertIsNone(adjunto.binario)
+        self.assertEquals(adjunto.sha256, hashlib.sha256('contenido del archivo').hexdigest())
+        self.assertEquals(self.blobs(), [adjunto.sha256])
+        self.assertEquals(self.descargar(adjunto), 'contenido del archivo')
+        response = self.client.get(reverse('project:file_detail', args=(adjunto.pk,)))
+        self.assertContains(response, 'contenido del archivo')
+
+    def test_contenido_repetido_se_guarda_una_vez(self):
+        primero = self.subir('mismo contenido', 'a.txt')
+        segundo = self.subir('mismo contenido', 'b.txt')
+        self.assertNotEquals(primero.pk, segundo.pk)
+        self.assertEquals(primero.sha256, segundo.sha256)
+        self.assertEquals(len(self.blobs()), 1)
+
+    def test_adjunto_en_la_base_de_datos(self):
+        adjunto = Adjunto.objects.create(nombre='viejo', descripcion='Adjunto anterior', filename='viejo.txt',
+                                         binario='contenido anterior', content_type='text/plain', user_story=self.us)
+        self.assertEquals(self.descargar(adjunto), 'contenido anterior')
+        call_command('migrate_attachments', verbosity=0)
+        adjunto = Adjunto.objects.get(pk=adjunto.pk)
+        self.assertIsNone(adjunto.binario)
+        self.assertEquals(adjunto.sha256, hashlib.sha256('contenido anterior').hexdigest())
+        self.assertEquals(self.descargar(adjunto), 'contenido anterior')
+
+    def test_migracion_lee_cada_adjunto_con_una_consulta(self):
+        for n in range(2):
+            Adjunto.objects.create(nombre='viejo', descripcion='Adjunto anterior', filename='viejo%d.txt' % n,
+                                   binario='contenido %d' % n, content_type='text/plain', user_story=self.us)
+        #los ids pendientes, una lectura y un update por adjunto, y los adjuntos sin tamano
+        with self.assertNumQueries(6):
+            call_command('migrate_attachments', verbosity=0)
+
+    def test_archivo_grande_por_bloques(self):
+        #3 MB: Django lo recibe en un archivo temporal y se copia al almacen por bloques
+        contenido = ''.join(chr(i % 251) for i in range(3 * 1024 * 1024))
+        with self.settings(ATTACHMENT_CHUNK_SIZE=32 * 1024):
+            adjunto = self.subir(contenido, 'grande.bin', 'application/octet-stream')
+            response = self.client.get(reverse('project:download_attachment', args=(adjunto.pk,)))
+            self.assertTrue(response.streaming)
+            bloques = list(response.streaming_content)
+        self.assertEquals(int(response['Content-Length']), len(contenido))
+        self.assertTrue(all(len(b) <= 32 * 1024 for b in bloques))
+        self.assertEquals(''.join(bloques), contenido)
+
+    def test_limite_de_tamano(self):
+        with self.settings(ATTACHMENT_MAX_SIZE=1024):
+            response = self.client.post(reverse('project:file_upload', args=(self.us.pk,)),
+                                        {'nombre': 'grande', 'descripcion': 'Archivo grande',
+                                         'file': SimpleUploadedFile('grande.bin', 'x' * 2048)})
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response.context['form'].errors['file'])
+        self.assertFalse(Adjunto.objects.exists())
+        self.assertEquals(self.blobs(), [])
+
+    def test_rangos(self):
+        adjunto = self.subir('0123456789')
+        url = reverse('project:download_attachment', args=(adjunto.pk,))
+        for rango, status, contenido, content_range in [('bytes=2-5', 206, '2345', 'bytes 2-5/10'),
+                                                        ('bytes=7-', 206, '789', 'bytes 7-9/10'),
+                                                        ('bytes=-3', 206, '789', 'bytes 7-9/10'),
+                                                        ('bytes=8-20', 206, '89', 'bytes 8-9/10'),
+                                                        ('bytes=10-', 416, '', 'bytes */10'),
+                                                        ('bytes=5-2', 200, '0123456789', None),
+                                                        ('items=1-2', 200, '0123456789', None)]:
+            response = self.client.get(url, HTTP_RANGE=rango)
+            self.assertEquals(response.status_code, status)
+            self.assertEquals(''.join(response.streaming_content) if response.streaming else response.content, contenido)
+            self.assertEquals(response.get('Content-Range'), content_range)
+
+    def test_listado_no_lee_el_contenido(self):
+        contenido = 'x' * 100 * 1024
+        Adjunto.objects.bulk_create([Adjunto(nombre='a%d' % i, descripcion='Adjunto grande', filename='a.bin',
+                                             binario=contenido, user_story=self.us) for i in range(50)])
+        with CaptureQueriesContext(connection) as consultas:
+            response = self.client.get(reverse('project:file_list', args=(self.us.pk,)))
+        self.assertEquals(len(response.context['adjuntos']), 50)
+        self.assertTrue(consultas.captured_queries)
+        for consulta in consultas.captured_queries:
+            self.assertNotIn('binario', consulta['sql'])
+        #el contenido se lee solo cuando se pide
+        adjunto = Adjunto.objects.first()
+        self.assertEquals(adjunto.tamano(), len(contenido))
+        self.assertEquals(adjunto.contenido(), contenido)
+
+    def test_tamano_guardado(self):
+        adjunto = self.subir('12345')
+        self.assertEquals(adjunto.size, 5)
+        viejo = Adjunto.objects.create(nombre='viejo', descripcion='Adjunto anterior', binario='123',
+                                       user_story=self.us)
+        self.assertIsNone(Adjunto.objects.get(pk=viejo.pk).size)
+        call_command('migrate_attachments', verbosity=0)
+        self.assertEquals(Adjunto.objects.get(pk=viejo.pk).size, 3)
+
+    def limpiar(self, antiguedad=0):
+        salida = StringIO()
+        with self.settings(ATTACHMENT_ORPHAN_MIN_AGE=antiguedad):
+            call_command('clean_attachments', stdout=salida)
+        return salida.getvalue()
+
+    def test_eliminar_adjunto_libera_el_contenido(self):
+        primero = self.subir('compartido', 'a.txt')
+        segundo = self.subir('compartido', 'b.txt')
+        primero.delete()
+        self.limpiar()
+        self.assertEquals(len(self.blobs()), 1)
+        segundo.delete()
+        #el contenido no se borra al eliminar el adjunto, sino con clean_attachments
+        self.assertEquals(len(self.blobs()), 1)
+        #los contenidos escritos recientemente no se eliminan
+        self.assertIn('0 contenidos', self.limpiar(3600))
+        self.assertIn('1 contenidos', self.limpiar())
+        self.assertEquals(self.blobs(), [])
+
+    def test_eliminacion_deshecha_conserva_el_contenido(self):
+        adjunto = self.subir('contenido conservado')
+        pk = adjunto.pk
+        try:
+            with transaction.atomic():
+                adjunto.delete()
+                raise ValueError
+        except ValueError:
+            pass
+        self.limpiar()
+        self.assertEquals(self.descargar(Adjunto.objects.get(pk=pk)), 'contenido conservado')
+
+    def test_descarga_get_condicional(self):
+        adjunto = self.subir('contenido que no cambia')
+        url = reverse('project:download_attachment', args=(adjunto.pk,))
+        response = self.client.get(url)
+        self.assertEquals(response['ETag'], '"%s"' % adjunto.sha256)
+        self.assertEquals(response['Cache-Control'], 'private, no-cache')
+        abrir = Adjunto.abrir
+        Adjunto.abrir = None  #una respuesta 304 no debe leer el contenido
+        try:
+            for cabeceras in [{'HTTP_IF_NONE_MATCH': response['ETag']},
+                              {'HTTP_IF_MODIFIED_SINCE': response['Last-Modified']}]:
+                respuesta = self.client.get(url, **cabeceras)
+                self.assertEquals(respuesta.status_code, 304)
+                self.assertEquals(respuesta['ETag'], response['ETag'])
+        finally:
+            Adjunto.abrir = abrir
+        self.assertEquals(self.client.get(url, HTTP_IF_NONE_MATCH='"otro"').status_code, 200)
+        #sin permiso no se responde 304
+        User.objects.create_user('ajeno', 'ajeno@test.com', 'ajeno')
+        self.client.login(username='ajeno', password='ajeno')
+        self.assertEquals(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 403)
+
+    def test_subir_varios_archivos(self):
+        archivos = [SimpleUploadedFile('a.txt', 'primero', content_type='text/plain'),
+                    SimpleUploadedFile('b.py', 'print 2', content_type='text/x-python')]
+        response = self.client.post(reverse('project:file_upload_multiple', args=(self.us.pk,)),
+                                    {'descripcion': 'Varios archivos', 'files': archivos})
+        self.assertRedirects(response, reverse('project:file_list', args=(self.us.pk,)))
+        adjuntos = list(self.us.adjunto_set.order_by('pk'))
+        self.assertEquals([(a.nombre, a.tipo, a.contenido()) for a in adjuntos],
+                          [('a.txt', 'text', 'primero'), ('b.py', 'src', 'print 2')])
+        #si un archivo supera el limite no se guarda ninguno
+        with self.settings(ATTACHMENT_MAX_SIZE=10):
+            response = self.client.post(reverse('project:file_upload_multiple', args=(self.us.pk,)),
+                                        {'descripcion': 'Varios archivos',
+                                         'files': [SimpleUploadedFile('c.txt', 'chico'),
+                                                   SimpleUploadedFile('d.txt', 'demasiado grande')]})
+        self.assertTrue(response.context['form'].errors['files'])
+        self.assertEquals(self.us.adjunto_set.count(), 2)
+
+    def test_descargar_todos_en_zip(self):
+        self.subir('contenido de a', 'a.txt')
+        self.subir('contenido de otro a', 'a.txt')
+        Adjunto.objects.create(nombre='viejo', descripcion='Adjunto anterior', filename='viejo.txt',
+                               binario='contenido anterior', content_type='text/plain', user_story=self.us)
+        #cada adjunto se comprime en varios bloques
+        with self.settings(ATTACHMENT_CHUNK_SIZE=4):
+            response = self.client.get(reverse('project:file_zip', args=(self.us.pk,)))
+        self.assertEquals(response['Content-Type'], 'application/zip')
+        #el zip se genera mientras se envia, una parte por vez, y no tiene Content-Length
+        self.assertFalse(response.has_header('Content-Length'))
+        bloques = list(response.streaming_content)
+        self.assertGreater(len(bloques), 6)
+        contenido = ''.join(bloques)
+        comprimido = zipfile.ZipFile(StringIO(contenido))
+        self.assertIsNone(comprimido.testzip())
+        self.assertEquals(dict((n, comprimido.read(n)) for n in comprimido.namelist()),
+                          {'a.txt': 'contenido de a', 'a (2).txt': 'contenido de otro a',
+                           'viejo.txt': 'contenido anterior'})
+        User.objects.create_user('ajeno', 'ajeno@test.com', 'ajeno')
+        self.client.login(username='ajeno', password='ajeno')
+        self.assertEquals(self.client.get(reverse('project:file_zip', args=(self.us.pk,))).status_code, 403)
+
+    def test_zip_con_otro_almacen(self):
+        AlmacenEnMemoria.contenidos.clear()
+        with self.settings(ATTACHMENT_STORAGE={'BACKEND': 'project.tests.AlmacenEnMemoria', 'OPTIONS': {}}):
+            self.subir('contenido en memoria', 'a.txt')
+            response = self.client.get(reverse('project:file_zip', args=(self.us.pk,)))
+            comprimido = zipfile.ZipFile(StringIO(''.join(response.streaming_content)))
+        self.assertEquals(comprimido.read('a.txt'), 'contenido en memoria')
+        self.assertEquals(self.blobs(), [])
+
+    def test_error_del_almacen_al_subir_varios(self):
+        AlmacenEnMemoria.contenidos.clear()
+        with self.settings(ATTACHMENT_STORAGE={'BACKEND': 'project.tests.AlmacenEnMemoria', 'OPTIONS': {}}):
+            response = self.client.post(reverse('project:file_upload_multiple', args=(self.us.pk,)),
+                                        {'descripcion': 'Varios archivos',
+                                         'files': [SimpleUploadedFile('a.txt', 'primero'),
+                                                   SimpleUploadedFile('b.txt', 'sin espacio')]})
+        self.assertEquals(response.status_code, 200)
+        self.assertIn('No queda espacio', response.context['form'].errors['files'][0])
+        self.assertEquals(self.us.adjunto_set.count(), 0)
+        #el contenido del primer archivo, que ya se habia guardado, queda en el almacen hasta que lo elimina
+        #clean_attachments: otra subida del mismo contenido podria estar usandolo
+        self.assertEquals(AlmacenEnMemoria.contenidos.values(), ['primero'])
+
+    def test_subida_fallida_deja_el_contenido_para_la_limpieza(self):
+        guardar = Adjunto.save
+
+        def fallar(adjunto, *args, **kwargs):
+            if adjunto.nombre == 'b.txt':
+                raise IOError(28, 'No queda espacio en el dispositivo')
+            guardar(adjunto, *args, **kwargs)
+        Adjunto.save = fallar
+        try:
+            response = self.client.post(reverse('project:file_upload_multiple', args=(self.us.pk,)),
+                                        {'descripcion': 'Varios archivos',
+                                         'files': [SimpleUploadedFile('a.txt', 'primero'),
+                                                   SimpleUploadedFile('b.txt', 'segundo')]})
+        finally:
+            Adjunto.save = guardar
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(self.us.adjunto_set.count(), 0)
+        self.assertEquals(len(self.blobs()), 2)
+        #los contenidos recientes se conservan; pasado ATTACHMENT_ORPHAN_MIN_AGE se eliminan
+        self.limpiar(antiguedad=3600)
+        self.assertEquals(len(self.blobs()), 2)
+        self.limpiar()
+        self.assertEquals(self.blobs(), [])
+
+    def imagen(self, ancho, alto, formato='PNG'):
+        contenido = StringIO()
+        Image.new('RGB', (ancho, alto), (200, 30, 30)).save(contenido, formato)
+        return contenido.getvalue()
+
+    def test_miniaturas(self):
+        adjunto = self.subir(self.imagen(1600, 1000), 'foto.png', 'image/png')
+        self.assertEquals(adjunto.tipo, 'img')
+        #los derivados se generan al subir la imagen
+        self.assertEquals(len([f for _, _, archivos in os.walk(self.derivados) for f in archivos]), 2)
+        for tamano, dimensiones in [('miniatura', (200, 125)), ('vista', (800, 500))]:
+            response = self.client.get(reverse('project:attachment_image', args=(adjunto.pk, tamano)))
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(response['Content-Type'], 'image/jpeg')
+            self.assertIn('private', response['Cache-Control'])
+            self.assertEquals(Image.open(StringIO(''.join(response.streaming_content))).size, dimensiones)
+        response = self.client.get(reverse('project:file_detail', args=(adjunto.pk,)))
+        self.assertNotContains(response, 'base64')
+        self.assertContains(response, reverse('project:attachment_image', args=(adjunto.pk, 'vista')))
+
+    def test_miniatura_get_condicional(self):
+        adjunto = self.subir(self.imagen(300, 300), 'foto.png', 'image/png')
+        url = reverse('project:attachment_image', args=(adjunto.pk, 'miniatura'))
+        response = self.client.get(url)
+        etag, modificacion = response['ETag'], response['Last-Modified']
+        self.assertEquals(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEquals(self.client.get(url, HTTP_IF_MODIFIED_SINCE=modificacion).status_code, 304)
+        self.assertEquals(self.client.get(url, HTTP_IF_NONE_MATCH='"otro"').status_code, 200)
+
+    def test_miniatura_generada_al_pedirla(self):
+        contenido = self.imagen(400, 100, 'JPEG')
+        adjunto = Adjunto.objects.create(nombre='viejo', descripcion='Imagen anterior', filename='viejo.jpg',
+                                         binario=contenido, content_type='image/jpeg', tipo='img', user_story=self.us)
+        response = self.client.get(reverse('project:attachment_image', args=(adjunto.pk, 'miniatura')))
+        self.assertEquals(Image.open(StringIO(''.join(response.streaming_content))).size, (200, 50))
+        #si el contenido no es una imagen se envia el archivo original
+        adjunto = Adjunto.objects.create(nombre='roto', descripcion='Imagen invalida', filename='roto.png',
+                                         binario='no es una imagen', content_type='image/png', tipo='img',
+                                         user_story=self.us)
+        response = self.client.get(reverse('project:attachment_image', args=(adjunto.pk, 'miniatura')))
+        self.assertRedirects(response, unicode(adjunto.get_download_url()), fetch_redirect_response=False)
+
+
+    def test_miniatura_de_imagen_no_migrada_no_lee_el_contenido(self):
+        adjunto = Adjunto.objects.create(nombre='viejo', descripcion='Imagen anterior', filename='viejo.png',
+                                         binario=self.imagen(300, 300), content_type='image/png', tipo='img',
+                                         user_story=self.us)
+        adjunto = Adjunto.objects.get(pk=adjunto.pk)
+        with self.assertNumQueries(0):
+            clave = imagenes.clave(adjunto)
+        self.assertIn(str(adjunto.pk), clave)
+        imagenes.generar_derivados(adjunto)
+        self.assertIsNotNone(imagenes.buscar(clave, 'miniatura'))
+        adjunto.delete()
+        self.limpiar()
+        self.assertIsNone(imagenes.buscar(clave, 'miniatura'))
+
+    def test_imagen_que_pillow_rechaza(self):
+        adjunto = self.subir(self.imagen(300, 300), 'grande.png', 'image/png')
+        imagenes.eliminar_derivados(adjunto.sha256)
+        maximo = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = 1000
+        try:
+            response = self.client.get(reverse('project:attachment_image', args=(adjunto.pk, 'miniatura')))
+        finally:
+            Image.MAX_IMAGE_PIXELS = maximo
+        self.assertRedirects(response, unicode(adjunto.get_download_url()), fetch_redirect_response=False)
+        self.assertEquals([f for _, _, archivos in os.walk(self.derivados) for f in archivos], [])
+
+class PermisosRequestTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('dev', 'dev@test.com', 'dev')
+        self.proyecto = Proyecto.objects.create(nombre_corto='Permisos', nombre_largo='Permisos', inicio=timezone.now(),
+                                                fin=timezone.now(), descripcion='Proyecto con permisos')
+        self.otro = Proyecto.objects.create(nombre_corto='Otro', nombre_largo='Otro', inicio=timezone.now(),
+                                            fin=timezone.now(), descripcion='Proyecto sin permisos')
+        self.us = UserStory.objects.create(nombre='US', descripcion='US propio', valor_negocio=1, valor_tecnico=1,
+                                           tiempo_estimado=1, proyecto=self.proyecto)
+        self.ajeno = UserStory.objects.create(nombre='US ajeno', descripcion='US ajeno', valor_negocio=1,
+                                              valor_tecnico=1, tiempo_estimado=1, proyecto=self.proyecto)
+        assign_perm('view_project', self.user, self.proyecto)
+        assign_perm('edit_my_userstory', self.user, self.us)
+        grupo = Group.objects.create(name='Equipo')
+        grupo.user_set.add(self.user)
+        assign_perm('prioritize_userstory', grupo, self.proyecto)
+
+    def guardian(self, consultas):
+        return [c for c in consultas.captured_queries if 'guardian_' in c['sql']]
+
+    def test_mismos_permisos_que_guardian(self):
+        permisos = PermisosUsuario(self.user)
+        for obj in [self.proyecto, self.otro, self.us, self.ajeno]:
+            self.assertEquals(sorted(permisos.get_perms(obj)), sorted(get_perms(self.user, obj)))
+        self.assertTrue(permisos.has_perm('project.prioritize_userstory', self.proyecto))
+        self.assertFalse(permisos.has_perm('project.view_project', self.otro))
+        self.assertFalse(permisos.has_perm('project.view_project'))
+        admin = User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.assertEquals(sorted(PermisosUsuario(admin).get_perms(self.ajeno)), sorted(get_perms(admin, self.ajeno)))
+        #el prefijo del permiso debe ser la aplicacion del objeto
+        self.assertRaises(WrongAppError, self.user.has_perm, 'auth.view_project', self.proyecto)
+        for usuario in [self.user, admin]:
+            self.assertRaises(WrongAppError, PermisosUsuario(usuario).has_perm, 'auth.view_project', self.proyecto)
+
+    def test_una_carga_por_proyecto(self):
+        permisos = PermisosUsuario(self.user)
+        with CaptureQueriesContext(connection) as consultas:
+            for i in range(5):
+                for obj in [self.us, self.proyecto, self.ajeno, self.otro]:
+                    permisos.get_perms(obj)
+        #permisos propios y de grupo, para cada proyecto junto con sus user stories
+        self.assertEquals(len(self.guardian(consultas)), 4)
+        #solo se cargan los permisos sobre los objetos de esos proyectos
+        for consulta in self.guardian(consultas):
+            self.assertIn('object_pk', consulta['sql'])
+
+    def test_proyecto_con_muchos_user_stories(self):
+        UserStory.objects.bulk_create([UserStory(nombre='US %d' % i, descripcion='US', valor_negocio=1,
+                                                 valor_tecnico=1, tiempo_estimado=1, proyecto=self.proyecto)
+                                       for i in range(1200)])
+        ultimo = UserStory.objects.filter(proyecto=self.proyecto).latest('pk')
+        assign_perm('edit_my_userstory', self.user, ultimo)
+        permisos = PermisosUsuario(self.user)
+        self.assertEquals(permisos.get_perms(ultimo), ['edit_my_userstory'])
+        self.assertEquals(sorted(permisos.get_perms(self.us)), sorted(get_perms(self.user, self.us)))
+        self.assertEquals(sorted(permisos.get_perms(self.proyecto)), sorted(get_perms(self.user, self.proyecto)))
+
+    def test_vistas_consultan_los_permisos_una_vez(self):
+        self.client.login(username='dev', password='dev')
+        for url in [reverse('project:userstory_update', args=(self.us.pk,)),
+                    reverse('project:version_list', args=(self.us.pk,)),
+                    reverse('project:file_upload', args=(self.us.pk,))]:
+            with CaptureQueriesContext(connection) as consultas:
+                response = self.client.get(url)
+            self.assertEquals(response.status_code, 200)
+            #guardian hace 2 consultas en cada comprobacion; aqui a lo sumo 2 por tipo de objeto
+            self.assertLessEqual(len(self.guardian(consultas)), 4, url)
+        response = self.client.get(reverse('project:userstory_update', args=(self.ajeno.pk,)))
+        self.assertEquals(response.status_code, 403)
+
+    def test_respuesta_al_fallar_la_comprobacion(self):
+        from project.views import GlobalPermissionRequiredMixin
+        respuestas = []
+        on_permission_check_fail = GlobalPermissionRequiredMixin.on_permission_check_fail
+        GlobalPermissionRequiredMixin.on_permission_check_fail = \
+            lambda self, request, response, obj=None: respuestas.append(response)
+        try:
+            self.client.login(username='dev', password='dev')
+            response = self.client.get(reverse('project:project_detail', args=(self.otro.pk,)))
+        finally:
+            GlobalPermissionRequiredMixin.on_permission_check_fail = on_permission_check_fail
+        self.assertEquals(response.status_code, 403)
+        self.assertEquals([r.status_code for r in respuestas], [403])
+
+
+class CachedObjectTest(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.client.login(username='admin_test', password='admin_test')
+        proyecto = Proyecto.objects.create(nombre_corto='Objetos', nombre_largo='Objetos', inicio=timezone.now(),
+                                           fin=timezone.now(), descripcion='Proyecto de prueba')
+        self.sprint = Sprint.objects.create(nombre='Sprint 1', inicio=timezone.now(),
+                                            fin=timezone.now() + datetime.timedelta(days=30), proyecto=proyecto)
+        self.flujo = Flujo.objects.create(nombre='Flujo', proyecto=proyecto)
+        actividad = Actividad.objects.create(name='Desarrollo', flujo=self.flujo)
+        self.us = UserStory.objects.create(nombre='US', descripcion='US de prueba', valor_negocio=1, valor_tecnico=1,
+                                           tiempo_estimado=1, proyecto=proyecto)
+        UserStory.objects.filter(pk=self.us.pk).update(sprint=self.sprint, actividad=actividad, estado=1)
+
+    def consultas(self, url):
+        with CaptureQueriesContext(connection) as consultas:
+            response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        return len(consultas.captured_queries)
+
+    def test_consultas_ahorradas(self):
+        urls = [reverse('project:userstory_registraractividad', args=(self.us.pk,)),
+                reverse('project:userstory_update', args=(self.us.pk,)),
+                reverse('project:userstory_detail', args=(self.us.pk,)),
+                reverse('project:flujo_update', args=(self.flujo.pk,)),
+                reverse('project:sprint_update', args=(self.sprint.pk,))]
+        from project.views import CachedObjectMixin
+        memorizado = [self.consultas(url) for url in urls]
+        get_object = CachedObjectMixin.get_object
+        CachedObjectMixin.get_object = lambda self, queryset=None: SingleObjectMixin.get_object(self, queryset)
+        try:
+            sin_memorizar = [self.consultas(url) for url in urls]
+        finally:
+            CachedObjectMixin.get_object = get_object
+        for url, con, sin in zip(urls, memorizado, sin_memorizar):
+            self.assertLess(con, sin, url)
+        #registrar actividad obtenia el user story y sus relaciones mas de diez veces por request
+        self.assertGreaterEqual(sin_memorizar[0] - memorizado[0], 10)
+
+
+class RolPermisosTest(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.client.login(username='admin_test', password='admin_test')
+        self.proyecto = Proyecto.objects.create(nombre_corto='Roles', nombre_largo='Roles', inicio=timezone.now(),
+                                                fin=timezone.now(), descripcion='Proyecto con roles')
+        self.otro = Proyecto.objects.create(nombre_corto='Otro', nombre_largo='Otro', inicio=timezone.now(),
+                                            fin=timezone.now(), descripcion='Otro proyecto')
+        self.desarrollador = self.rol('Desarrollador', ['edit_userstory', 'edit_my_userstory'])
+        self.scrum = self.rol('Scrum', ['create_sprint'])
+        self.dev1 = User.objects.create_user('dev1', 'dev1@test.com', 'dev1')
+        self.dev2 = User.objects.create_user('dev2', 'dev2@test.com', 'dev2')
+        self.miembro(self.dev1, self.proyecto, self.desarrollador, self.scrum)
+        self.miembro(self.dev2, self.proyecto, self.desarrollador)
+        self.miembro(self.dev1, self.otro, self.desarrollador)
+        self.us1 = self.user_story(self.proyecto, self.dev1)
+        self.us2 = self.user_story(self.proyecto, self.dev2)
+        self.us3 = self.user_story(self.otro, self.dev1)
+        #los permisos que no vienen de los roles se eliminan al sincronizar
+        assign_perm('remove_flujo', self.dev1, self.proyecto)
+
+    def rol(self, nombre, permisos):
+        rol = Group.objects.create(name=nombre)
+        rol.permissions = Permission.objects.filter(codename__in=permisos)
+        return rol
+
+    def miembro(self, usuario, proyecto, *roles):
+        miembro = MiembroEquipo.objects.create(usuario=usuario, proyecto=proyecto)
+        miembro.roles.add(*roles)
+        return miembro
+
+    def user_story(self, proyecto, desarrollador):
+        return UserStory.objects.create(nombre='US', descripcion='US de prueba', valor_negocio=1, valor_tecnico=1,
+                                        tiempo_estimado=1, proyecto=proyecto, desarrollador=desarrollador)
+
+    def permisos(self, usuario, obj):
+        return sorted(get_perms(usuario, obj))
+
+    def test_editar_rol(self):
+        self.assertEquals(self.permisos(self.dev1, self.us1), ['edit_my_userstory'])
+        response = self.client.post(reverse('project:rol_update', args=(self.desarrollador.pk,)),
+                                    {'name': 'Desarrollador', 'perms_userstory': ['create_userstory',
+                                                                                  'registraractividad_my_userstory']})
+        self.assertRedirects(response, reverse('project:rol_detail', args=(self.desarrollador.pk,)))
+        self.assertEquals(self.permisos(self.dev1, self.proyecto), ['create_sprint', 'create_userstory', 'view_project'])
+        self.assertEquals(self.permisos(self.dev2, self.proyecto), ['create_userstory', 'view_project'])
+        self.assertEquals(self.permisos(self.dev1, self.otro), ['create_userstory', 'view_project'])
+        for usuario, us in [(self.dev1, self.us1), (self.dev2, self.us2), (self.dev1, self.us3)]:
+            self.assertEquals(self.permisos(usuario, us), ['registraractividad_my_userstory'])
+        self.assertEquals(self.permisos(self.dev2, self.us1), [])
+
+    def test_editar_rol_falla_la_sincronizacion(self):
+        from project.views import rol_views
+        antes = sorted(self.desarrollador.permissions.values_list('codename', flat=True))
+
+        def fallar(miembros):
+            raise ValueError('fallo la sincronizacion')
+        sincronizar = rol_views.sincronizar_permisos_roles
+        rol_views.sincronizar_permisos_roles = fallar
+        try:
+            self.assertRaises(ValueError, self.client.post,
+                              reverse('project:rol_update', args=(self.desarrollador.pk,)),
+                              {'name': 'Desarrollador', 'perms_userstory': ['create_userstory']})
+        finally:
+            rol_views.sincronizar_permisos_roles = sincronizar
+        #los permisos del rol no cambian si no se pudieron actualizar los de sus miembros
+        self.assertEquals(sorted(self.desarrollador.permissions.values_list('codename', flat=True)), antes)
+
+    def test_eliminar_rol(self):
+        response = self.client.post(reverse('project:rol_delete', args=(self.scrum.pk,)), {'Confirmar': True})
+        self.assertRedirects(response, reverse('project:rol_list'))
+        self.assertEquals(self.permisos(self.dev1, self.proyecto), ['edit_userstory', 'view_project'])
+        self.assertEquals(self.permisos(self.dev1, self.us1), ['edit_my_userstory'])
+
+    def test_guardar_user_story_quita_permisos_que_el_rol_ya_no_da(self):
+        self.assertEquals(self.permisos(self.dev2, self.us2), ['edit_my_userstory'])
+        self.desarrollador.permissions.remove(Permission.objects.get(codename='edit_my_userstory'))
+        self.desarrollador.permissions.add(Permission.objects.get(codename='registraractividad_my_userstory'))
+        #el desarrollador no cambia: igual se ajustan sus permisos a los de sus roles
+        self.us2.save()
+        self.assertEquals(self.permisos(self.dev2, self.us2), ['registraractividad_my_userstory'])
+        #los user stories que no se guardaron no cambian
+        self.assertEquals(self.permisos(self.dev1, self.us1), ['edit_my_userstory'])
+
+    def test_consultas_no_dependen_de_los_miembros(self):
+        miembros = list(self.desarrollador.miembroequipo_set.values_list('pk', flat=True))
+        UserObjectPermission.objects.all().delete()
+        with CaptureQueriesContext(connection) as pocos:
+            self.assertEquals(sincronizar_permisos_roles(miembros), (7, 0))
+        for i in range(10):
+            usuario = User.objects.create_user('otro%d' % i, 'otro%d@test.com' % i, 'otro')
+            miembros.append(self.miembro(usuario, self.proyecto, self.desarrollador).pk)
+            self.user_story(self.proyecto, usuario)
+        UserObjectPermission.objects.all().delete()
+        with CaptureQueriesContext(connection) as muchos:
+            self.assertEquals(sincronizar_permisos_roles(miembros), (27, 0))
+        self.assertEquals(len(muchos.captured_queries), len(pocos.captured_queries))
+
+    def test_asignacion_en_bloque(self):
+        grande = self.rol('Grande', [p.codename for p in Permission.objects.filter(
+            content_type__model__in=['proyecto', 'userstory'])])
+        chico = self.rol('Chico', ['create_sprint', 'edit_my_userstory'])
+        consultas = []
+        for rol in [chico, grande]:
+            usuario = User.objects.create_user(rol.name, 'x@test.com', 'x')
+            miembro = MiembroEquipo.objects.create(usuario=usuario, proyecto=self.proyecto)
+            UserStory.objects.bulk_create([UserStory(nombre='US', descripcion='US', valor_negocio=1, valor_tecnico=1,
+                                                     tiempo_estimado=1, proyecto=self.proyecto, desarrollador=usuario)
+                                           for i in range(5)])
+            with CaptureQueriesContext(connection) as capturadas:
+                miembro.roles.add(rol)
+            consultas.append(len(capturadas.captured_queries))
+        self.assertEquals(consultas[0], consultas[1])
+        usuario = User.objects.get(username='Grande')
+        us = UserStory.objects.filter(desarrollador=usuario).first()
+        self.assertEquals(self.permisos(usuario, us), ['edit_my_userstory', 'registraractividad_my_userstory'])
+        self.assertIn('aprobar_userstory', self.permisos(usuario, self.proyecto))
+        #al cambiar el desarrollador los permisos pasan al nuevo
+        us.desarrollador = self.dev1
+        #incluye el savepoint de la transaccion en la que se actualizan los contadores del proyecto y la
+        #consulta de los miembros del proyecto cuya navegacion se invalida
+        with self.assertNumQueries(11):
+            us.save()
+        self.assertEquals(self.permisos(usuario, us), [])
+        self.assertEquals(self.permisos(self.dev1, us), ['edit_my_userstory'])
+
+
+class ContadoresProyectoTest(TestCase):
+
+    def setUp(self):
+        self.proyecto = Proyecto.objects.create(nombre_corto='Contadores', nombre_largo='Contadores',
+                                                inicio=timezone.now(), fin=timezone.now(), descripcion='Contadores')
+        self.otro = Proyecto.objects.create(nombre_corto='Otro', nombre_largo='Otro', inicio=timezone.now(),
+                                            fin=timezone.now(), descripcion='Otro proyecto')
+
+    def user_story(self, tiempo_estimado, tiempo_registrado=0, estado=0):
+        return UserStory.objects.create(nombre='US', descripcion='US de prueba', valor_negocio=1, valor_tecnico=1,
+                                        tiempo_estimado=tiempo_estimado, tiempo_registrado=tiempo_registrado,
+                                        estado=estado, proyecto=self.proyecto)
+
+    def contadores(self, proyecto):
+        proyecto = Proyecto.objects.get(pk=proyecto.pk)
+        return (proyecto.us_total, proyecto.us_cancelados, proyecto.us_aprobados, proyecto.horas_estimadas,
+                proyecto.horas_trabajadas)
+
+    def test_contadores_al_modificar_user_stories(self):
+        us1 = self.user_story(10, 2)
+        us2 = self.user_story(5)
+        self.user_story(3, estado=4)
+        self.assertEquals(self.contadores(self.proyecto), (3, 1, 0, 18, 2))
+        us1.estado = 3
+        us1.tiempo_registrado = 8
+        us1.save()
+        self.assertEquals(self.contadores(self.proyecto), (3, 1, 1, 18, 8))
+        us2.proyecto = self.otro
+        us2.save()
+        self.assertEquals(self.contadores(self.proyecto), (2, 1, 1, 13, 8))
+        self.assertEquals(self.contadores(self.otro), (1, 0, 0, 5, 0))
+        us1.delete()
+        self.assertEquals(self.contadores(self.proyecto), (1, 1, 0, 3, 0))
+        self.assertEquals(self.proyecto.calcular_contadores(), {'us_total': 1, 'us_cancelados': 1, 'us_aprobados': 0,
+                                                                 'horas_estimadas': 3, 'horas_trabajadas': 0})
+
+    def test_progreso_sin_consultas(self):
+        self.user_story(10, 4, estado=3)
+        self.user_story(6, 1)
+        self.user_story(2, estado=4)
+        proyecto = Proyecto.objects.get(pk=self.proyecto.pk)
+        with self.assertNumQueries(0):
+            self.assertEquals(proyecto.progreso, 50)
+            self.assertEquals(proyecto.get_horas_estimadas(), 18)
+            self.assertEquals(proyecto.get_horas_trabajadas(), 5)
+
+    def test_comando_recalcula_contadores(self):
+        self.user_story(10, estado=3)
+        self.user_story(4)
+        #QuerySet.update no pasa por UserStory.save y deja los contadores desactualizados
+        UserStory.objects.filter(proyecto=self.proyecto).update(estado=4, tiempo_registrado=1)
+        self.assertEquals(self.contadores(self.proyecto), (2, 0, 1, 14, 0))
+        salida = StringIO()
+        call_command('rebuild_project_counters', verificar=True, stdout=salida)
+        self.assertIn('1 proyectos con contadores incorrectos', salida.getvalue())
+        self.assertEquals(self.contadores(self.proyecto), (2, 0, 1, 14, 0))
+        call_command('rebuild_project_counters', self.proyecto.pk, verbosity=0)
+        self.assertEquals(self.contadores(self.proyecto), (2, 2, 0, 14, 2))
+
+    def test_guardados_desde_una_instancia_desactualizada(self):
+        us = self.user_story(10, 2)
+        otra = UserStory.objects.get(pk=us.pk)
+        us.estado = 3
+        us.tiempo_registrado = 6
+        us.save()
+        #la segunda instancia se leyo antes del primer guardado; sus diferencias se calculan sobre la fila
+        #guardada y no sobre los valores que tenia al leerse
+        otra.estado = 4
+        otra.tiempo_estimado = 12
+        otra.save()
+        self.assertEquals(self.contadores(self.proyecto), (1, 1, 0, 12, 2))
+        proyecto = Proyecto.objects.get(pk=self.proyecto.pk)
+        self.assertEquals(self.contadores(proyecto), tuple(proyecto.calcular_contadores()[c] for c in Proyecto.CONTADORES))
+
+    def test_guardar_proyecto_no_pisa_los_contadores(self):
+        proyecto = Proyecto.objects.get(pk=self.proyecto.pk)
+        self.user_story(10, 3, estado=3)
+        proyecto.descripcion = 'Descripcion nueva'
+        proyecto.save()
+        proyecto = Proyecto.objects.get(pk=self.proyecto.pk)
+        self.assertEquals(proyecto.descripcion, 'Descripcion nueva')
+        self.assertEquals(self.contadores(proyecto), (1, 0, 1, 10, 3))
+
+    def test_migracion_carga_los_contadores(self):
+        self.user_story(10, 2)
+        self.user_story(3, estado=4)
+        Proyecto.objects.update(**dict.fromkeys(Proyecto.CONTADORES, 0))
+        migracion = import_module('project.migrations.0015_calcular_contadores_proyecto')
+        migracion.calcular_contadores(apps, None)
+        self.assertEquals(self.contadores(self.proyecto), (2, 1, 0, 13, 2))
+        self.assertEquals(self.contadores(self.otro), (0, 0, 0, 0, 0))
+
+
+@override_settings(NAV_CACHE_TIMEOUT=300)
+class NavCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.usuario = User.objects.create_user('nav', 'nav@test.com', 'nav')
+        self.proyecto = Proyecto.objects.create(nombre_corto='Nav', nombre_largo='Nav', inicio=timezone.now(),
+                                                fin=timezone.now(), descripcion='Proyecto de la navegacion')
+        MiembroEquipo.objects.create(usuario=self.usuario, proyecto=self.proyecto)
+        self.us = UserStory.objects.create(nombre='US nav', descripcion='US', valor_negocio=1, valor_tecnico=1,
+                                           tiempo_estimado=4, estado=3, proyecto=self.proyecto,
+                                           desarrollador=self.usuario)
+
+    def nav(self, usuario=None):
+        request = RequestFactory().get('/')
+        request.user = User.objects.get(pk=(usuario or self.usuario).pk)
+        return nav_context_processor(request)
+
+    def test_nav_en_cache(self):
+        nav = self.nav()
+        self.assertEquals(nav['nav_projects'], [self.proyecto])
+        self.assertEquals(nav['nav_us'], [self.us])
+        request = RequestFactory().get('/')
+        request.user = User.objects.get(pk=self.usuario.pk)
+        with self.assertNumQueries(0):
+            nav = nav_context_processor(request)
+            self.assertEquals(nav['nav_projects'][0].progreso, 100)
+            self.assertEquals(nav['nav_us'][0].progreso, 0)
+
+    def test_pagina_sin_consultas_de_nav(self):
+        self.client.login(username='nav', password='nav')
+        url = reverse('project:project_detail', args=(self.proyecto.pk,))
+        assign_perm('view_project', self.usuario, self.proyecto)
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as capturadas:
+            response = self.client.get(url)
+        self.assertContains(response, '100% Complete')
+        consultas = [q['sql'] for q in capturadas.captured_queries]
+        self.assertFalse([q for q in consultas if 'ORDER BY "project_proyecto"."nombre_corto"' in q or
+                          'ORDER BY "project_userstory"."nombre"' in q], consultas)
+
+    def test_invalidacion(self):
+        self.nav()
+        self.us.nombre = 'US renombrado'
+        self.us.save()
+        self.assertEquals(self.nav()['nav_us'][0].nombre, 'US renombrado')
+        otro = Proyecto.objects.create(nombre_corto='A otro', nombre_largo='Otro', inicio=timezone.now(),
+                                       fin=timezone.now(), descripcion='Otro proyecto')
+        MiembroEquipo.objects.create(usuario=self.usuario, proyecto=otro)
+        self.assertEquals(self.nav()['nav_projects'], [otro, self.proyecto])
+        MiembroEquipo.objects.filter(proyecto=otro).delete()
+        self.assertEquals(self.nav()['nav_projects'], [self.proyecto])
+        grupo = Group.objects.create(name='Todos')
+        grupo.permissions.add(Permission.objects.get(codename='list_all_projects'))
+        self.usuario.groups.add(grupo)
+        self.assertEquals(self.nav()['nav_projects'], [otro, self.proyecto])
+
+    def test_invalidacion_por_usuario(self):
+        ajeno = User.objects.create_user('ajeno', 'ajeno@test.com', 'ajeno')
+        admin = User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        otro = Proyecto.objects.create(nombre_corto='A otro', nombre_largo='Otro', inicio=timezone.now(),
+                                       fin=timezone.now(), descripcion='Otro proyecto')
+        MiembroEquipo.objects.create(usuario=ajeno, proyecto=otro)
+        self.nav()
+        self.nav(admin)
+        UserStory.objects.create(nombre='A primero', descripcion='US', valor_negocio=1, valor_tecnico=1,
+                                 tiempo_estimado=1, proyecto=otro, desarrollador=ajeno)
+        #el cambio en otro proyecto no invalida la navegacion del usuario, pero si la de quien ve todos
+        with self.assertNumQueries(1):
+            self.nav()
+        self.assertEquals(self.nav(admin)['nav_us'][0].nombre, 'A primero')
+
+    def test_user_story_reasignado(self):
+        ajeno = User.objects.create_user('ajeno', 'ajeno@test.com', 'ajeno')
+        otro = Proyecto.objects.create(nombre_corto='A otro', nombre_largo='Otro', inicio=timezone.now(),
+                                       fin=timezone.now(), descripcion='Otro proyecto')
+        MiembroEquipo.objects.create(usuario=ajeno, proyecto=otro)
+        MiembroEquipo.objects.create(usuario=self.usuario, proyecto=otro)
+        us = UserStory.objects.create(nombre='A asignado', descripcion='US', valor_negocio=1, valor_tecnico=1,
+                                      tiempo_estimado=1, proyecto=otro, desarrollador=self.usuario)
+        MiembroEquipo.objects.filter(usuario=self.usuario, proyecto=otro).delete()
+        self.assertEquals(self.nav()['nav_us'], [us, self.us])
+        #el desarrollador anterior ya no es miembro del proyecto: se invalida por haber sido el desarrollador
+        us.desarrollador = ajeno
+        us.save()
+        self.assertEquals(self.nav()['nav_us'], [self.us])
+        self.assertEquals(self.nav(ajeno)['nav_us'], [us])
+
+    def test_usuario_anonimo(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        with self.assertNumQueries(0):
+            self.assertEquals(nav_context_processor(request), {'nav_projects': [], 'nav_us': []})
+
+    def test_generacion_descartada_por_la_cache(self):
+        self.nav()
+        self.us.nombre = 'US renombrado'
+        self.us.save()
+        self.nav()
+        #si la cache descarta la generacion no se vuelve a una generacion anterior
+        cache.delete(context_processors.clave_usuario(self.usuario.pk))
+        UserStory.objects.filter(pk=self.us.pk).update(nombre='US sin signal')
+        self.assertEquals(self.nav()['nav_us'][0].nombre, 'US sin signal')
+
+
+class ListadosAnotadosTest(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.client.login(username='admin_test', password='admin_test')
+        self.proyecto = Proyecto.objects.create(nombre_corto='Listados', nombre_largo='Listados',
+                                                inicio=timezone.now(), fin=timezone.now(), descripcion='Listados')
+        self.usuario = User.objects.create_user('miembro', 'miembro@test.com', 'miembro')
+        self.rol = Group.objects.create(name='Rol')
+
+    def agregar_filas(self, n):
+        """
+        Agrega n sprints, flujos, plantillas y miembros, con user stories y actividades.
+        """
+        for i in range(n):
+            sufijo = '%s-%s' % (Sprint.objects.count(), i)
+            sprint = Sprint.objects.create(nombre='Sprint ' + sufijo, inicio=timezone.now(), fin=timezone.now(),
+                                           proyecto=self.proyecto)
+            for j in range(i + 1):
+                UserStory.objects.create(nombre='US', descripcion='US', valor_negocio=1, valor_tecnico=1,
+                                         tiempo_estimado=1, proyecto=self.proyecto, sprint=sprint, estado=j % 5)
+            for proyecto in (self.proyecto, None):
+                flujo = Flujo.objects.create(nombre='Flujo ' + sufijo, proyecto=proyecto)
+                for j in range(i + 1):
+                    Actividad.objects.create(name='Actividad %s' % j, flujo=flujo)
+            miembro = MiembroEquipo.objects.create(usuario=User.objects.create_user('u' + sufijo), proyecto=self.proyecto)
+            miembro.roles.add(self.rol)
+
+    def consultas(self, url):
+        with CaptureQueriesContext(connection) as consultas:
+            response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        return len(consultas.captured_queries)
+
+    def test_consultas_constantes(self):
+        urls = [reverse('project:sprint_list', args=(self.proyecto.pk,)),
+                reverse('project:flujo_list', args=(self.proyecto.pk,)),
+                reverse('project:plantilla_list'),
+                reverse('project:project_detail', args=(self.proyecto.pk,))]
+        self.agregar_filas(1)
+        pocas = [self.consultas(url) for url in urls]
+        self.agregar_filas(4)
+        muchas = [self.consultas(url) for url in urls]
+        self.assertEquals(pocas, muchas)
+
+    def test_cantidades(self):
+        self.agregar_filas(3)
+        self.assertEquals(sorted(s.num_user_stories for s in Sprint.objects.with_story_counts()), [1, 2, 3])
+        self.assertEquals(sorted(f.num_actividades for f in self.proyecto.flujo_set.with_activity_counts()), [1, 2, 3])
+        response = self.client.get(reverse('project:project_detail', args=(self.proyecto.pk,)))
+        self.assertEquals((response.context['total_us'], response.context['approved_us'],
+                           response.context['pending_us']), (6, 0, 1))
+
+
+@override_settings(PROJECT_STATS_TIMEOUT=60)
+class EstadisticasProyectoTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.proyecto = Proyecto.objects.create(nombre_corto='Stats', nombre_largo='Stats', inicio=timezone.now(),
+                                                fin=timezone.now(), descripcion='Estadisticas')
+        self.otro = Proyecto.objects.create(nombre_corto='Otro', nombre_largo='Otro', inicio=timezone.now(),
+                                            fin=timezone.now(), descripcion='Otro proyecto')
+        for estado, estimado, registrado in [(0, 4, 0), (1, 6, 2), (1, 2, 1), (3, 8, 8), (4, 3, 1)]:
+            self.us = UserStory.objects.create(nombre='US', descripcion='US', valor_negocio=1, valor_tecnico=1,
+                                               tiempo_estimado=estimado, tiempo_registrado=registrado,
+                                               estado=estado, proyecto=self.proyecto)
+
+    def test_una_consulta_y_cache(self):
+        proyecto = Proyecto.objects.get(pk=self.proyecto.pk)
+        with self.assertNumQueries(1):
+            datos = estadisticas.get_estadisticas(proyecto)
+        #totales, horas y progreso salen de los contadores del proyecto
+        self.assertEquals((datos['total'], datos['horas_estimadas'], datos['horas_trabajadas'], datos['progreso']),
+                          (5, 23, 12, 25))
+        self.assertEquals(datos['por_estado'], {0: 1, 1: 2, 2: 0, 3: 1, 4: 1})
+        self.assertEquals(datos['horas_por_estado'], {0: (4, 0), 1: (8, 3), 2: (None, None), 3: (8, 8), 4: (3, 1)})
+        with self.assertNumQueries(0):
+            self.assertEquals(estadisticas.get_estadisticas(proyecto), datos)
+
+    def test_invalidacion(self):
+        estadisticas.get_estadisticas(self.proyecto)
+        estadisticas.get_estadisticas(self.otro)
+        self.us.proyecto = self.otro
+        self.us.save()
+        self.assertEquals(estadisticas.get_estadisticas(self.proyecto)['por_estado'][4], 0)
+        self.assertEquals(estadisticas.get_estadisticas(self.otro)['por_estado'][4], 1)
+        self.us.delete()
+        self.assertEquals(estadisticas.get_estadisticas(self.otro)['por_estado'][4], 0)
+
+    def test_invalidacion_al_confirmar_la_transaccion(self):
+        Proyecto.objects.filter(pk=self.proyecto.pk).update(estado='EP')
+        User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.client.login(username='admin_test', password='admin_test')
+
+        def leer_antes_de_confirmar(sender, **kwargs):
+            #otro request que lee antes de que se confirme la transaccion de la vista vuelve a guardar las
+            #cantidades anteriores en la cache
+            cache.set(estadisticas.clave(self.proyecto.pk), estadisticas.calcular_por_estado(self.proyecto.pk))
+        reversion.post_revision_commit.connect(leer_antes_de_confirmar)
+        try:
+            response = self.client.post(reverse('project:userstory_update', args=(self.us.pk,)),
+                                        {'nombre': 'US editado', 'descripcion': 'US', 'prioridad': 1,
+                                         'valor_negocio': 1, 'valor_tecnico': 1, 'tiempo_estimado': 3})
+        finally:
+            reversion.post_revision_commit.disconnect(leer_antes_de_confirmar)
+        self.assertEquals(response.status_code, 302)
+        self.assertIsNone(cache.get(estadisticas.clave(self.proyecto.pk)))
+
+    def test_transaccion(self):
+        try:
+            with estadisticas.transaccion():
+                self.us.save()
+                raise ValueError
+        except ValueError:
+            pass
+        #los proyectos registrados en la conexion no pasan a la siguiente transaccion
+        self.assertIsNone(getattr(connection, 'estadisticas_pendientes', None))
+        with estadisticas.transaccion():
+            self.us.estado = 0
+            self.us.save()
+            #una lectura antes de confirmar vuelve a guardar las estadisticas en la cache
+            estadisticas.get_estadisticas(self.proyecto)
+        self.assertIsNone(cache.get(estadisticas.clave(self.proyecto.pk)))
+        #fuera de transaccion() no se registra nada en la conexion
+        self.us.save()
+        self.assertIsNone(getattr(connection, 'estadisticas_pendientes', None))
+
+    def test_comando_de_contadores_invalida(self):
+        estadisticas.get_estadisticas(self.proyecto)
+        UserStory.objects.filter(pk=self.us.pk).update(estado=0)
+        call_command('rebuild_project_counters', verbosity=0)
+        proyecto = Proyecto.objects.get(pk=self.proyecto.pk)
+        self.assertEquals(estadisticas.get_estadisticas(proyecto)['por_estado'][4], 0)
+
+    def test_project_detail(self):
+        User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.client.login(username='admin_test', password='admin_test')
+        response = self.client.get(reverse('project:project_detail', args=(self.proyecto.pk,)))
+        self.assertEquals([response.context[c] for c in ('total_us', 'approved_us', 'active_us', 'pending_us',
+                                                         'failed_us')], [5, 1, 2, 0, 1])
+
+
+class TableroFlujoTest(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser('admin_test', 'admin@test.com', 'admin_test')
+        self.client.login(username='admin_test', password='admin_test')
+        self.proyecto = Proyecto.objects.create(nombre_corto='Tablero', nombre_largo='Tablero', inicio=timezone.now(),
+                                                fin=timezone.now(), descripcion='Tablero')
+        self.sprint = Sprint.objects.create(nombre='Sprint 1', inicio=timezone.now(), fin=timezone.now(),
+                                            proyecto=self.proyecto)
+        self.flujo = Flujo.objects.create(nombre='Flujo', proyecto=self.proyecto)
+        self.actividades = []
+
+    def agregar_actividades(self, n):
+        for i in range(n):
+            actividad = Actividad.objects.create(name='Actividad %s' % len(self.actividades), flujo=self.flujo)
+            self.actividades.append(actividad)
+            for prioridad in range(3):
+                us = UserStory.objects.create(nombre='US', descripcion='US', valor_negocio=1, valor_tecnico=1,
+                                              tiempo_estimado=prioridad + 1, tiempo_registrado=prioridad,
+                                              prioridad=prioridad, proyecto=self.proyecto)
+                UserStory.objects.filter(pk=us.pk).update(actividad=actividad, estado_actividad=prioridad,
+                                                          sprint=self.sprint if prioridad else None)
+
+    def consultas(self, url):
+        with CaptureQueriesContext(connection) as consultas:
+            response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        return len(consultas.captured_queries)
+
+    def test_consultas_constantes(self):
+        urls = [reverse('project:flujo_detail', args=(self.flujo.pk,)),
+                reverse('project:flujo_detail_sprint', args=(self.flujo.pk, self.sprint.pk))]
+        self.agregar_actividades(1)
+        pocas = [self.consultas(url) for url in urls]
+        self.agregar_actividades(4)
+        muchas = [self.consultas(url) for url in urls]
+        self.assertEquals(pocas, muchas)
+
+    def test_contexto(self):
+        self.agregar_actividades(2)
+        response = self.client.get(reverse('project:flujo_detail', args=(self.flujo.pk,)))
+        self.assertEquals(response.context['actividades'], [[a, 3] for a in self.actividades])
+        for actividad, us in zip(self.actividades, response.context['act_us']):
+            self.assertEquals(us, list(actividad.userstory_set.order_by('-prioridad')))
+        self.assertEquals((response.context['registrado'], response.context['estimado']), (6, 12))
+        response = self.client.get(reverse('project:flujo_detail_sprint', args=(self.flujo.pk, self.sprint.pk)))
+        self.assertEquals(response.context['actividades'], [[a, 2] for a in self.actividades])
+        self.assertEquals([[u.prioridad for u in us] for us in response.context['act_us']], [[2, 1], [2, 1]])
+        self.assertEquals((response.context['registrado'], response.context['estimado']), (6, 10))
+        otro = Sprint.objects.create(nombre='Sprint 2', inicio=timezone.now(), fin=timezone.now(),
+                                     proyecto=self.proyecto)
+        response = self.client.get(reverse('project:flujo_detail_sprint', args=(self.flujo.pk, otro.pk)))
+        self.assertEquals((response.context['registrado'], response.context['estimado']), (None, None))
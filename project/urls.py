@@ -18,11 +18,15 @@ urlpatterns = patterns('',
                        url(r'^projects/(?P<pk>\d+)/delete/$', views.ProjectDelete.as_view(), name='project_delete'),
                        url(r'^projects/(?P<pk>\d+)/aprobar/$', views.ApproveProject.as_view(), name='project_aprobar'),
                        url(r'^projects/(?P<pk>\d+)/$', views.ProjectDetail.as_view(), name='project_detail'),
+                       url(r'^projects/(?P<pk>\d+)/velocidad/$', views.ProjectVelocity.as_view(), name='project_velocity'),
                        url(r'^projects/(?P<project_pk>\d+)/flujo/$',views.FlujoList.as_view(),name='flujo_list'),
                        url(r'^projects/(?P<proyecto_id>\d+)/reporte/backlog/$',views.reporte_backlog_producto, name='reporte_backlog_producto'),
                        url(r'^projects/(?P<proyecto_id>\d+)/reporte/lista_priorizada/$',views.reporte_lista_priorizada, name='reporte_lista_priorizada'),
                        url(r'^projects/(?P<proyecto_id>\d+)/reporte/equipo/$',views.reporte_equipo_proyecto, name='reporte_equipo_proyecto'),
                         url(r'^projects/(?P<proyecto_id>\d+)/reporte/burndown/$', views.reporte_burndown, name='reporte_burndown'),
+                       url(r'^reportes/(?P<pk>\d+)/$', views.report_job, name='report_job'),
+                       url(r'^reportes/(?P<pk>\d+)/estado/$', views.report_job_status, name='report_job_status'),
+                       url(r'^reportes/(?P<pk>\d+)/descarga/$', views.report_job_download, name='report_job_download'),
                        url(r'^flujo/(?P<pk>\d+)/$', views.FlujoDetail.as_view(), name='flujo_detail'),
                        url(r'^flujo/(?P<pk>\d+)/sprint/(?P<sprint_pk>\d+)/$', views.FlujoDetailSprint.as_view(), name='flujo_detail_sprint'),
                        url(r'^projects/(?P<project_pk>\d+)/flujo/add/$', views.AddFlujo.as_view(), name="flujo_add"),
@@ -43,6 +47,9 @@ urlpatterns = patterns('',
                        url(r'^userstory/(?P<pk>\d+)/revert/(?P<version_pk>\d+)/$', views.UpdateVersion.as_view(), name="version_revert"),
                        url(r'^userstory/(?P<pk>\d+)/files/$', views.FileList.as_view(), name="file_list"),
                        url(r'^userstory/(?P<pk>\d+)/files/upload/$', views.UploadFileView.as_view(), name="file_upload"),
+                       url(r'^userstory/(?P<pk>\d+)/files/upload/multiple/$', views.UploadFilesView.as_view(),
+                           name="file_upload_multiple"),
+                       url(r'^userstory/(?P<pk>\d+)/files/zip/$', views.download_all_attachments, name="file_zip"),
                        url(r'^file/(?P<pk>\d+)/$', views.FileDetail.as_view(), name="file_detail"),
                        url(r'^nota/(?P<pk>\d+)/$', views.NotaDetail.as_view(), name='nota_detail'),
                        url(r'^userstory/(?P<pk>\d+)/notas/$', views.NotaList.as_view(), name="nota_list"),
@@ -52,6 +59,8 @@ urlpatterns = patterns('',
                        url(r'^roles/(?P<pk>\d+)/edit/$', views.UpdateRolView.as_view(), name="rol_update"),
                        url(r'^roles/(?P<pk>\d+)/delete/$', views.DeleteRolView.as_view(), name="rol_delete"),
                        url(r'^attachment/(?P<pk>\d+)/$', views.download_attachment, name='download_attachment'),
+                       url(r'^attachment/(?P<pk>\d+)/(?P<tamano>miniatura|vista)/$', views.attachment_image,
+                           name='attachment_image'),
                        url(r'^projects/(?P<project_pk>\d+)/sprint/add/$', views.AddSprintView.as_view(), name="sprint_add"),
                        url(r'^sprint/(?P<pk>\d+)/$', views.SprintDetail.as_view(), name='sprint_detail'),
                        url(r'^projects/(?P<project_pk>\d+)/sprint/$', views.SprintList.as_view(),name="sprint_list"),
@@ -1,21 +1,38 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import struct
+import zipfile
+import zlib
+from calendar import timegm
+from contextlib import closing
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import PermissionDenied, ValidationError
 from django.views import generic
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden
+from django.db import transaction
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden, StreamingHttpResponse, \
+    HttpResponseNotModified
 from django.shortcuts import get_object_or_404
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
 from guardian.decorators import permission_required_or_403
 from guardian.mixins import LoginRequiredMixin
-from guardian.shortcuts import get_perms
 from os.path import splitext
-from project.forms import FileUploadForm
+from project import imagenes
+from project.forms import FileUploadForm, MultiFileUploadForm
 from project.models import UserStory, Adjunto, Proyecto
+from project.permissions import get_permisos
+from project.storage import get_blob_store
 from project.views import CreateViewPermissionRequiredMixin, GlobalPermissionRequiredMixin
 
 
 lang = {'.c': 'clike', '.py': 'python', '.rb': 'ruby', '.css': 'css', '.php': 'php', '.scala': 'scala', '.sql': 'sql',
         '.sh': 'bash', '.js': 'javascript', '.html': 'markup'}
 
+#Cabecera Range con un solo rango de bytes, por ejemplo 'bytes=0-499', 'bytes=500-' o 'bytes=-500'
+RANGO = re.compile(r'^bytes=(\d*)-(\d*)$')
+
 
 # TODO subir archivo dentro de una nota?
 class UploadFileView(LoginRequiredMixin, generic.FormView):
@@ -35,9 +52,9 @@ class UploadFileView(LoginRequiredMixin, generic.FormView):
         :return: PermissionDenied si el usuario no cuenta con permisos
         """
         self.user_story = get_object_or_404(UserStory, pk=self.kwargs['pk'])
-        if 'edit_userstory' in get_perms(request.user, self.user_story.proyecto):
+        if 'edit_userstory' in get_permisos(request).get_perms(self.user_story.proyecto):
             return super(UploadFileView, self).dispatch(request, *args, **kwargs)
-        elif 'edit_my_userstory' in get_perms(self.request.user, self.user_story):
+        elif 'edit_my_userstory' in get_permisos(self.request).get_perms(self.user_story):
             return super(UploadFileView, self).dispatch(request, *args, **kwargs)
         else:
             raise PermissionDenied()
@@ -57,8 +74,10 @@ class UploadFileView(LoginRequiredMixin, generic.FormView):
                 attachment.tipo = 'text'
 
         attachment.content_type = uploaded_file.content_type
-        attachment.binario = uploaded_file.read()
+        attachment.sha256, attachment.size = get_blob_store().save(uploaded_file.chunks(settings.ATTACHMENT_CHUNK_SIZE))
         attachment.save()
+        if attachment.tipo == 'img':
+            imagenes.generar_derivados(attachment)
 
     def form_valid(self, form):
         attachment = form.save(commit=False)
@@ -66,6 +85,28 @@ class UploadFileView(LoginRequiredMixin, generic.FormView):
         return HttpResponseRedirect(attachment.get_absolute_url())
 
 
+class UploadFilesView(UploadFileView):
+    """
+    Vista que permite subir varios archivos adjuntos a la vez. Los permisos se comprueban una sola vez
+    y todos los adjuntos se guardan en la misma transaccion.
+    """
+    form_class = MultiFileUploadForm
+
+    def form_valid(self, form):
+        try:
+            with transaction.atomic():
+                for uploaded_file in form.cleaned_data['files']:
+                    attachment = Adjunto(nombre=uploaded_file.name[:Adjunto._meta.get_field('nombre').max_length],
+                                         descripcion=form.cleaned_data['descripcion'])
+                    self.upload_handler(attachment, uploaded_file)
+        except (EnvironmentError, ValidationError) as e:
+            #Si falla algun archivo no se guarda ninguno. El contenido que ya se copio al almacen no se borra
+            #aqui, porque otra subida del mismo contenido puede estar por confirmarse: lo elimina clean_attachments
+            form.add_error('files', u'No se pudieron guardar los archivos: %s' % e)
+            return self.form_invalid(form)
+        return HttpResponseRedirect(reverse('project:file_list', args=(self.user_story.pk,)))
+
+
 class FileDetail(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.DetailView):
     model = Adjunto
     template_name = 'project/adjunto/file_view.html'
@@ -114,11 +155,253 @@ def download_attachment(request, pk):
     :return: respuesta http con el archivo adjunto
     """
     attachment = get_object_or_404(Adjunto, pk=pk)
-    if request.user.has_perm('project.view_project', attachment.user_story.proyecto):
-        response = HttpResponse(attachment.binario, content_type=attachment.content_type)
+    if get_permisos(request).has_perm('project.view_project', attachment.user_story.proyecto):
+        #El contenido no cambia despues de subirlo: si el cliente ya lo tiene no se lee del almacen
+        if no_modificado(request, attachment.sha256, attachment.creacion):
+            response = HttpResponseNotModified()
+        else:
+            response = respuesta_archivo(request, attachment.abrir(), attachment.tamano(), attachment.content_type)
+        agregar_validadores(response, attachment.sha256, attachment.creacion)
         if attachment.tipo == 'img':
             response['Content-Disposition'] = 'filename=%s' % attachment.filename
         else:
             response['Content-Disposition'] = 'attachment; filename=%s' % attachment.filename
         return response
-    raise PermissionDenied()
\ No newline at end of file
+    raise PermissionDenied()
+
+
+@login_required
+def download_all_attachments(request, pk):
+    """
+    Vista que permite descargar todos los adjuntos de un user story en un archivo zip. El zip se genera
+    mientras se envia, comprimiendo cada adjunto por bloques, por lo que el primer byte sale sin esperar a
+    que se comprima todo. Como el tamano no se conoce de antemano, la respuesta no tiene Content-Length
+    ni admite rangos.
+    :param request: request del cliente
+    :param pk: id del user story
+    :return: respuesta http con el zip de los adjuntos
+    """
+    user_story = get_object_or_404(UserStory, pk=pk)
+    if not get_permisos(request).has_perm('project.view_project', user_story.proyecto):
+        raise PermissionDenied()
+    nombres = set()
+    entradas = [(nombre_en_zip(attachment.filename or attachment.nombre, nombres), attachment)
+                for attachment in user_story.adjunto_set.order_by('pk')]
+    response = StreamingHttpResponse(zip_en_bloques(entradas), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename=adjuntos-us%s.zip' % user_story.pk
+    return response
+
+
+#Maximo de los campos de 32 bits del formato zip; por encima se usan los campos ZIP64
+LIMITE_ZIP = 0xffffffff
+
+
+def zip_en_bloques(entradas):
+    """
+    Genera un archivo zip por bloques, sin escribirlo en disco ni cargarlo en memoria. ZipFile de Python 2.7
+    necesita volver atras en el archivo para completar la cabecera de cada entrada, por eso el formato se
+    escribe aqui: cada entrada lleva su CRC y sus tamanos en un descriptor despues de los datos (bit 3 de
+    los flags), y el directorio central se escribe al final. Los adjuntos que pueden superar los 4 GB, y
+    las posiciones que los superan, usan las extensiones ZIP64.
+
+    :param entradas: lista de tuplas (nombre dentro del zip, adjunto); el contenido se lee con Adjunto.abrir()
+    :return: generador de los bloques del zip
+    """
+    posicion = 0
+    directorio = []
+    for nombre, attachment in entradas:
+        flags = 0x08
+        if isinstance(nombre, unicode):
+            try:
+                nombre = nombre.encode('ascii')
+            except UnicodeEncodeError:
+                nombre, flags = nombre.encode('utf-8'), flags | 0x800
+        fecha = attachment.creacion.timetuple()
+        hora_dos = fecha[3] << 11 | fecha[4] << 5 | fecha[5] // 2
+        fecha_dos = max(fecha[0] - 1980, 0) << 9 | fecha[1] << 5 | fecha[2]
+        #el contenido comprimido puede ser algo mayor que el original
+        zip64 = attachment.tamano() * 1.05 > LIMITE_ZIP
+        version = 45 if zip64 else 20
+        extra = struct.pack('<2H2Q', 1, 16, 0, 0) if zip64 else b''
+        cabecera = struct.pack('<4s5H3L2H', b'PK\x03\x04', version, flags, zipfile.ZIP_DEFLATED, hora_dos,
+                               fecha_dos, 0, LIMITE_ZIP if zip64 else 0, LIMITE_ZIP if zip64 else 0,
+                               len(nombre), len(extra))
+        inicio = posicion
+        yield cabecera + nombre + extra
+        posicion += len(cabecera) + len(nombre) + len(extra)
+        cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        crc = tamano = comprimido = 0
+        with closing(attachment.abrir()) as origen:
+            for bloque in iter(lambda: origen.read(settings.ATTACHMENT_CHUNK_SIZE), b''):
+                tamano += len(bloque)
+                crc = zlib.crc32(bloque, crc) & 0xffffffff
+                bloque = cmpr.compress(bloque)
+                if bloque:
+                    comprimido += len(bloque)
+                    yield bloque
+        bloque = cmpr.flush()
+        comprimido += len(bloque)
+        if not zip64 and max(tamano, comprimido) >= LIMITE_ZIP:
+            raise zipfile.LargeZipFile('El adjunto %s cambio de tamano al comprimirlo' % nombre)
+        descriptor = struct.pack('<4sL2Q' if zip64 else '<4s3L', b'PK\x07\x08', crc, comprimido, tamano)
+        yield bloque + descriptor
+        posicion += comprimido + len(descriptor)
+        directorio.append((nombre, flags, hora_dos, fecha_dos, crc, comprimido, tamano, inicio))
+
+    inicio_directorio = posicion
+    for nombre, flags, hora_dos, fecha_dos, crc, comprimido, tamano, inicio in directorio:
+        #en el directorio central solo llevan el campo ZIP64 los valores que no entran en 32 bits
+        grandes = [valor for valor in (tamano, comprimido, inicio) if valor >= LIMITE_ZIP]
+        extra = struct.pack('<2H%dQ' % len(grandes), 1, 8 * len(grandes), *grandes) if grandes else b''
+        version = 45 if grandes else 20
+        entrada = struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 3 << 8 | version, version, flags,
+                              zipfile.ZIP_DEFLATED, hora_dos, fecha_dos, crc, min(comprimido, LIMITE_ZIP),
+                              min(tamano, LIMITE_ZIP), len(nombre), len(extra), 0, 0, 0, 0o644 << 16,
+                              min(inicio, LIMITE_ZIP))
+        yield entrada + nombre + extra
+        posicion += len(entrada) + len(nombre) + len(extra)
+
+    cantidad, tamano_directorio = len(directorio), posicion - inicio_directorio
+    fin = b''
+    if cantidad >= 0xffff or max(tamano_directorio, inicio_directorio) >= LIMITE_ZIP:
+        fin = struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 3 << 8 | 45, 45, 0, 0, cantidad, cantidad,
+                          tamano_directorio, inicio_directorio)
+        fin += struct.pack('<4sLQL', b'PK\x06\x07', 0, posicion, 1)
+    fin += struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, min(cantidad, 0xffff), min(cantidad, 0xffff),
+                       min(tamano_directorio, LIMITE_ZIP), min(inicio_directorio, LIMITE_ZIP), 0)
+    yield fin
+
+
+def nombre_en_zip(nombre, usados):
+    """
+    Nombre de un adjunto dentro del zip. Si ya hay otro adjunto con el mismo nombre se le agrega un numero.
+
+    :param nombre: nombre del archivo adjunto
+    :param usados: nombres ya usados en el zip; se agrega el nombre elegido
+    """
+    base, ext = splitext(nombre)
+    candidato, n = nombre, 1
+    while candidato in usados:
+        n += 1
+        candidato = '%s (%d)%s' % (base, n, ext)
+    usados.add(candidato)
+    return candidato
+
+
+@login_required
+def attachment_image(request, pk, tamano):
+    """
+    Vista que envia la miniatura o la vista previa de un adjunto de tipo imagen. Se genera la primera vez
+    que se pide y el navegador la puede reutilizar, ya que el contenido de un adjunto no cambia.
+    :param request: request del cliente
+    :param pk: id del adjunto
+    :param tamano: nombre del derivado, una de las claves de ATTACHMENT_IMAGE_SIZES
+    :return: respuesta http con la imagen, 304 si el cliente ya la tiene, o redireccion a la descarga
+    si el contenido no es una imagen que se pueda reducir
+    """
+    attachment = get_object_or_404(Adjunto, pk=pk, tipo='img')
+    if not get_permisos(request).has_perm('project.view_project', attachment.user_story.proyecto):
+        raise PermissionDenied()
+    etag = '%s-%s' % (imagenes.clave(attachment), tamano)
+    if no_modificado(request, etag, attachment.creacion):
+        response = HttpResponseNotModified()
+    else:
+        try:
+            ruta, content_type = imagenes.derivado(attachment, tamano)
+        except IOError:
+            return HttpResponseRedirect(attachment.get_download_url())
+        response = respuesta_archivo(request, open(ruta, 'rb'), os.path.getsize(ruta), content_type)
+    agregar_validadores(response, etag, attachment.creacion, settings.ATTACHMENT_IMAGE_MAX_AGE)
+    return response
+
+
+def no_modificado(request, etag, modificacion):
+    """
+    Evalua las cabeceras If-None-Match e If-Modified-Since de un GET condicional.
+
+    :param request: request del cliente
+    :param etag: etag actual del recurso, sin comillas; None si el recurso no tiene etag
+    :param modificacion: fecha de la ultima modificacion del recurso
+    :return: True si la copia que tiene el cliente sigue vigente
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return (etag is not None and etag in etags) or '*' in etags
+    desde = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return desde is not None and timegm(modificacion.utctimetuple()) <= desde
+
+
+def agregar_validadores(response, etag, modificacion, max_age=None):
+    """
+    Agrega a la respuesta las cabeceras para que el cliente pueda guardarla y revalidarla. La cache es
+    privada porque los adjuntos solo los pueden ver los miembros del proyecto.
+
+    :param max_age: segundos que el cliente puede usar su copia sin consultar; sin max_age debe
+    revalidarla en cada uso, con lo que se vuelven a comprobar los permisos del usuario
+    """
+    if etag is not None:
+        response['ETag'] = quote_etag(etag)
+    response['Last-Modified'] = http_date(timegm(modificacion.utctimetuple()))
+    if max_age is None:
+        response['Cache-Control'] = 'private, no-cache'
+    else:
+        response['Cache-Control'] = 'private, max-age=%d' % max_age
+    return response
+
+
+def leer_bloques(archivo, cantidad):
+    """
+    Lee una cantidad de bytes de un archivo en bloques de ATTACHMENT_CHUNK_SIZE y lo cierra al terminar.
+
+    :param archivo: archivo posicionado al inicio de lo que se quiere leer
+    :param cantidad: cantidad de bytes a leer
+    """
+    try:
+        while cantidad > 0:
+            bloque = archivo.read(min(settings.ATTACHMENT_CHUNK_SIZE, cantidad))
+            if not bloque:
+                break
+            cantidad -= len(bloque)
+            yield bloque
+    finally:
+        archivo.close()
+
+
+def respuesta_archivo(request, archivo, tamano, content_type):
+    """
+    Respuesta que envia un archivo por bloques, con soporte para pedidos de un rango de bytes
+    (cabecera Range), de manera que la memoria usada no depende del tamaño del archivo.
+
+    :param request: request del cliente
+    :param archivo: archivo abierto; se cierra al terminar la respuesta
+    :param tamano: tamaño del archivo en bytes
+    :param content_type: tipo de contenido del archivo
+    :return: respuesta 200 con el archivo, 206 con el rango pedido o 416 si el rango no se puede
+    satisfacer. Un rango mal formado (por ejemplo bytes=5-2) se ignora, como indica el RFC 7233
+    """
+    inicio, fin, status = 0, tamano - 1, 200
+    rango = RANGO.match(request.META.get('HTTP_RANGE', ''))
+    if rango and rango.group(1) and rango.group(2) and int(rango.group(2)) < int(rango.group(1)):
+        rango = None
+    if rango and any(rango.groups()):
+        desde, hasta = rango.groups()
+        if desde:
+            inicio = int(desde)
+            fin = min(int(hasta), tamano - 1) if hasta else tamano - 1
+        else:
+            #Rango final: los ultimos N bytes
+            inicio = max(tamano - int(hasta), 0)
+        if inicio > fin:
+            archivo.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % tamano
+            return response
+        status = 206
+    archivo.seek(inicio)
+    response = StreamingHttpResponse(leer_bloques(archivo, fin - inicio + 1), status=status, content_type=content_type)
+    response['Content-Length'] = fin - inicio + 1
+    response['Accept-Ranges'] = 'bytes'
+    if status == 206:
+        response['Content-Range'] = 'bytes %d-%d/%d' % (inicio, fin, tamano)
+    return response
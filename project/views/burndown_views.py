@@ -1,21 +1,22 @@
 from datetime import timedelta
 from django.core.urlresolvers import reverse_lazy
-from django.db.models import Sum
+from django.db.models import Sum, Count
 from django.http import HttpResponse
 from django.shortcuts import render, get_object_or_404, redirect
 from django.utils import timezone
 from django.views import generic
 from guardian.mixins import PermissionRequiredMixin, LoginRequiredMixin
-from project.models import MiembroEquipo, Proyecto, UserStory, Adjunto, Nota, Sprint
+from project.models import MiembroEquipo, Proyecto, UserStory, Adjunto, Nota, Sprint, SprintDaySnapshot
 from random import randint
-from project.views import GlobalPermissionRequiredMixin
+from project.views import GlobalPermissionRequiredMixin, CachedObjectMixin
 
 
-class SprintBurndown(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.DetailView):
+class SprintBurndown(LoginRequiredMixin, GlobalPermissionRequiredMixin, CachedObjectMixin, generic.DetailView):
     """
     Vista del burndown chart
     """
     model = Sprint
+    select_related = ('proyecto',)
     template_name = 'project/sprint/sprint_burndown.html'
     permission_required = 'project.view_project'
 
@@ -39,6 +40,26 @@ class SprintBurndown(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.
         return context
 
 
+class ProjectVelocity(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.DetailView):
+    """
+    Vista de la velocidad del equipo a lo largo de los sprints del proyecto
+    """
+    model = Proyecto
+    template_name = 'project/proyecto/project_velocity.html'
+    permission_required = 'project.view_project'
+    context_object_name = 'proyecto'
+
+    def get_context_data(self, **kwargs):
+        """
+        Agregar datos al contexto
+        :param:**kwargs : argumentos clave
+        :return: retorna el contexto
+        """
+        context = super(ProjectVelocity, self).get_context_data(**kwargs)
+        context.update(get_project_burndown(self.object))
+        return context
+
+
 def daterange(start_date, end_date):
     for n in range(int((end_date - start_date).days)):
         yield start_date + timedelta(n)
@@ -73,24 +94,79 @@ def generarNotas(request, sprint_pk):
 
 
 def get_sprint_burndown(sprint):
-    project = sprint.proyecto
-    total = sprint.userstory_set.aggregate(sum=Sum('tiempo_estimado'))['sum']
-    h_restante = h_total = total if total else 0 # Horas estimadas de US
+    """
+    Calcula las series del burndown chart de un sprint.
+
+    :param sprint: sprint del cual se obtiene el burndown
+    :return: diccionario con las series ideal, real, us_faltante, us_terminado y db_hwork
+    """
+    totales = sprint.userstory_set.aggregate(sum=Sum('tiempo_estimado'), count=Count('id'))
+    return calcular_burndown(sprint, sprint.proyecto.duracion_sprint, totales['sum'], totales['count'],
+                             SprintDaySnapshot.get_rango(sprint))
+
+
+def get_project_burndown(project):
+    """
+    Calcula el burndown de todos los sprints del proyecto y la velocidad del equipo en cada sprint.
+    La cantidad de consultas es fija, sin importar cuantos sprints tenga el proyecto.
+
+    :param project: proyecto del cual se obtienen los datos
+    :return: diccionario con la lista de (sprint, burndown), el resumen por sprint y las series de velocidad
+    """
+    sprints = list(project.sprint_set.order_by('inicio'))
+    totales = UserStory.objects.filter(sprint__proyecto=project).values('sprint')\
+        .annotate(sum=Sum('tiempo_estimado'), count=Count('id'))
+    totales = dict((t['sprint'], t) for t in totales)
+    snapshots = {}
+    for snapshot in SprintDaySnapshot.objects.filter(sprint__proyecto=project):
+        snapshots.setdefault(snapshot.sprint_id, []).append(snapshot)
+
+    burndowns = []
+    resumen = []  # (sprint, horas estimadas, horas trabajadas, user stories completados)
+    velocidad = {'sprints': [], 'estimado': [], 'trabajado': [], 'completados': []}
+    for sprint in sprints:
+        total = totales.get(sprint.id, {})
+        burndown = calcular_burndown(sprint, project.duracion_sprint, total.get('sum'), total.get('count', 0),
+                                     snapshots.get(sprint.id, []))
+        estimado, trabajado, completados = burndown['ideal'][0], sum(burndown['db_hwork']), sum(burndown['us_terminado'])
+        burndowns.append((sprint, burndown))
+        resumen.append((sprint, estimado, trabajado, completados))
+        velocidad['sprints'].append(sprint.nombre)
+        velocidad['estimado'].append(estimado)
+        velocidad['trabajado'].append(trabajado)
+        velocidad['completados'].append(completados)
+    trabajado = velocidad['trabajado']
+    velocidad['promedio'] = round(float(sum(trabajado)) / len(trabajado), 1) if trabajado else 0
+    return {'burndowns': burndowns, 'resumen': resumen, 'velocidad': velocidad}
+
+
+def calcular_burndown(sprint, duracion_sprint, h_total, us_total, snapshots):
+    """
+    Arma las series del burndown chart de un sprint a partir de sus resumenes diarios.
+
+    :param sprint: sprint del cual se obtiene el burndown
+    :param duracion_sprint: duracion en dias de los sprints del proyecto
+    :param h_total: horas estimadas de los user stories del sprint
+    :param us_total: cantidad de user stories del sprint
+    :param snapshots: resumenes diarios del sprint
+    :return: diccionario con las series ideal, real, us_faltante, us_terminado y db_hwork
+    """
+    h_restante = h_total = h_total if h_total else 0 # Horas estimadas de US
     lh_real = [h_total]  # Lista de horas registradas
     lh_ideal = [h_total]  # Lista de horas reales
-    m = float(h_total) / project.duracion_sprint  # Velocidad ideal
-    us_restante = us_total = sprint.userstory_set.count()  # User Stories del sprint
+    m = float(h_total) / duracion_sprint  # Velocidad ideal
+    us_restante = us_total  # User Stories del sprint
     lus_restante = [us_total]  # Lista de user stories que faltan
     lus_completado = [0]  # Lista de user stories que se terminaron
     # TODO: si todavia no termino el sprint, se muestra hasta hoy o hasta el fin de sprint?
     today = timezone.now()
     fin = today if today < sprint.fin else sprint.fin
     db_hwork = [0]
+    snapshots = dict((s.dia, s) for s in snapshots)  # Resumenes diarios del sprint
     for dia in daterange(sprint.inicio, sprint.fin):
-        notas = sprint.nota_set.filter(fecha__year=dia.year, fecha__month=dia.month, fecha__day=dia.day)
-        completados = notas.filter(estado=3).count()  # User Stories terminados en el dia
-        hwork = notas.aggregate(sum=Sum('horas_a_registrar'))['sum']  # Total de horas registradas en el dia
-        hwork = hwork if hwork else 0  # Por si aggregate devuelve None
+        snapshot = snapshots.get(dia.date())
+        completados = snapshot.us_completados if snapshot else 0  # User Stories terminados en el dia
+        hwork = snapshot.horas_trabajadas if snapshot else 0  # Total de horas registradas en el dia
         # TODO: controlar si se registran mas horas de lo estimado
         db_hwork.append(hwork)
         h_restante -= hwork if h_restante >= hwork else 0  # Si se terminan las horas antes del fin
@@ -1,16 +1,16 @@
 # -*- coding: utf-8 -*-
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse, reverse_lazy
-from django.db.models import Sum
 from django.http import HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
 from django.template import RequestContext
 from django.views import generic
 from guardian.mixins import LoginRequiredMixin, PermissionRequiredMixin
-from guardian.shortcuts import get_perms
 from project.forms import ActividadFormSet, FlujosCreateForm, CreateFromPlantillaForm
 from project.models import Flujo, Proyecto, UserStory, Sprint
-from project.views import CreateViewPermissionRequiredMixin, GlobalPermissionRequiredMixin, ActiveProjectRequiredMixin
+from project.permissions import get_permisos
+from project.views import CreateViewPermissionRequiredMixin, GlobalPermissionRequiredMixin, ActiveProjectRequiredMixin, \
+    CachedObjectMixin
 
 
 class FlujoList(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.ListView):
@@ -30,20 +30,21 @@ class FlujoList(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.ListV
 
     def get_context_data(self, **kwargs):
         context = super(FlujoList, self).get_context_data(**kwargs)
-        context['proyecto_perms'] = get_perms(self.request.user, self.project)
+        context['proyecto_perms'] = get_permisos(self.request).get_perms(self.project)
         return context
 
     def get_queryset(self):
         if not self.project:
             self.project = get_object_or_404(Proyecto, pk=self.kwargs['project_pk'])
-        return Flujo.objects.filter(proyecto=self.project)
+        return Flujo.objects.filter(proyecto=self.project).with_activity_counts()
 
 
-class FlujoDetail(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.DetailView):
+class FlujoDetail(LoginRequiredMixin, GlobalPermissionRequiredMixin, CachedObjectMixin, generic.DetailView):
     """
     Vista de Detalles de un flujo
     """
     model = Flujo
+    select_related = ('proyecto',)
     template_name = 'project/flujo/flujo_detail.html'
     permission_required = 'project.view_project'
     context_object_name = 'flujo'
@@ -61,13 +62,32 @@ class FlujoDetail(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.Det
         :return: contexto
         """
         context = super(FlujoDetail, self).get_context_data(**kwargs)
-        context['actividades'] = [[a, a.userstory_set.count()]for a in self.object.actividad_set.all()]
-        context['act_us'] = [a.userstory_set.order_by('-prioridad') for a in self.object.actividad_set.all()]
-        us = self.object.proyecto.userstory_set.filter(actividad__flujo=self.object) #User Stories del Flujo
-        time = us.aggregate(registrado=Sum('tiempo_registrado'), estimado=Sum('tiempo_estimado')) #Aggregate retorna None en vez de 0
-        context.update(time)
+        context.update(self.get_tablero())
         return context
 
+    def get_tablero(self, sprint=None):
+        """
+        Arma el tablero del flujo con una sola consulta de sus user stories, que se reparten en memoria
+        por actividad, ordenados por prioridad.
+
+        :param sprint: si se indica, solo se incluyen los user stories del sprint
+        :return: diccionario con las actividades y su cantidad de user stories, los user stories de cada
+        actividad y el tiempo registrado y estimado de todos ellos (None si no hay user stories)
+        """
+        actividades = list(self.object.actividad_set.all())
+        por_actividad = dict((a.pk, []) for a in actividades)
+        us = self.object.proyecto.userstory_set.filter(actividad__flujo=self.object) #User Stories del Flujo
+        if sprint is not None:
+            us = us.filter(sprint=sprint)
+        for u in us.select_related('desarrollador', 'sprint').order_by('-prioridad', 'pk'):
+            por_actividad[u.actividad_id].append(u)
+        todos = [u for lista in por_actividad.values() for u in lista]
+        #Igual que aggregate, las sumas son None si no hay user stories
+        return {'actividades': [[a, len(por_actividad[a.pk])] for a in actividades],
+                'act_us': [por_actividad[a.pk] for a in actividades],
+                'registrado': sum(u.tiempo_registrado for u in todos) if todos else None,
+                'estimado': sum(u.tiempo_estimado for u in todos) if todos else None}
+
 
 class FlujoDetailSprint(FlujoDetail):
     sprint = None
@@ -80,12 +100,8 @@ class FlujoDetailSprint(FlujoDetail):
         """
         self.sprint = get_object_or_404(Sprint, pk=self.kwargs['sprint_pk'])
         context = super(generic.DetailView, self).get_context_data(**kwargs)
-        context['actividades'] = [[a, a.userstory_set.filter(sprint=self.sprint).count()] for a in self.object.actividad_set.all()]
         context['sprint'] = self.sprint
-        context['act_us'] = [a.userstory_set.filter(sprint=self.sprint).order_by('-prioridad') for a in self.object.actividad_set.all()]
-        us = self.object.proyecto.userstory_set.filter(actividad__flujo=self.object, sprint=self.sprint) #User Stories del Flujo
-        time = us.aggregate(registrado=Sum('tiempo_registrado'), estimado=Sum('tiempo_estimado'))
-        context.update(time)
+        context.update(self.get_tablero(self.sprint))
         return context
 
 
@@ -152,11 +168,12 @@ class AddFlujo(ActiveProjectRequiredMixin, LoginRequiredMixin, CreateViewPermiss
                            context_instance=RequestContext(self.request))
 
 
-class UpdateFlujo(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.UpdateView):
+class UpdateFlujo(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPermissionRequiredMixin, CachedObjectMixin, generic.UpdateView):
     """
     View que agrega un flujo al sistema
     """
     model = Flujo
+    select_related = ('proyecto',)
     template_name = 'project/flujo/flujo_form.html'
     form_class = FlujosCreateForm
     permission_required = 'project.edit_flujo'
@@ -206,11 +223,12 @@ class UpdateFlujo(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPermissi
                            context_instance=RequestContext(self.request))
 
 
-class DeleteFlujo(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.DeleteView):
+class DeleteFlujo(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPermissionRequiredMixin, CachedObjectMixin, generic.DeleteView):
     """
     Vista de Eliminacion de Flujos
     """
     model = Flujo
+    select_related = ('proyecto',)
     template_name = 'project/flujo/flujo_delete.html'
     permission_required = 'project.delete_flujo'
     context_object_name = 'flujo'
@@ -1,34 +1,47 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import os
+from functools import wraps
 from django import http
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
-from django.utils._os import safe_join
 from guardian.decorators import permission_required
 from django.contrib.auth.models import User
-from django.db.models import Sum
-from django.http import HttpResponse
-from django.shortcuts import render_to_response, get_object_or_404, render
+from django.db.models import Max, Count
+from django.http import HttpResponse, Http404, JsonResponse
+from django.shortcuts import render_to_response, get_object_or_404, render, redirect
 from django.template.loader import get_template
 from django.template import Context, RequestContext
-from guardian.shortcuts import get_perms
-from project.models import Proyecto, Sprint
-from project.views import get_sprint_burndown
+from django.views.decorators.http import condition
+from project import charts, reports
+from project.estadisticas import get_estadisticas
+from project.models import Proyecto, Sprint, ReportJob, UserStory, Nota
+from project.permissions import get_permisos
+from project.reports import url_fetcher
+from project.views import get_project_burndown
 from projectium import settings
 import weasyprint
 
 
+def render_pdf(request, template_name, contexto, nombre):
+    """
+    Genera la respuesta de un reporte en PDF. Con el parametro ?async=1 el PDF se genera en segundo
+    plano: se crea un ReportJob y se redirige a la pagina de estado del trabajo.
 
-def url_fetcher(url):
-    if url.startswith('assets://'):
-        url = url[len('assets://'):]
-        url = "file://" + safe_join(settings.ASSETS_ROOT, url)
-    return weasyprint.default_url_fetcher(url)
+    :param request: pedido del reporte
+    :param template_name: template del reporte
+    :param contexto: contexto del template
+    :param nombre: nombre del reporte, usado para el trabajo y el archivo descargado
+    :return: el PDF o la redireccion al trabajo
+    """
+    html = get_template(template_name).render(RequestContext(request, contexto))
+    base_url = request.build_absolute_uri(request.path)
+    if request.GET.get('async'):
+        job = ReportJob.objects.create(usuario=request.user, nombre=nombre)
+        reports.encolar(job, html, base_url, getattr(request, '_cache_reporte', None))
+        return redirect(job)
+    return reports.respuesta_pdf(reports.generar_pdf(html, base_url))
 
-import requests
-import json
-
-export_url = 'http://127.0.0.1:3003'
 
 def pdf(request):
     project = get_object_or_404(Proyecto, pk=7)
@@ -37,60 +50,135 @@ def pdf(request):
     return render(request, 'project/report.html', {'graph': graficos})
 
 def get_graficos(project):
-    sprints = project.sprint_set.all()
-    graficos = []
-    xAxis = "xAxis: {labels: {format: 'Dia {value}'}}"
-    yAxis = "yAxis: { title: {text: 'Esfuerzo Restante'}, min: 0, labels: {format: '{value} hs'}}"
-
-    for sprint in sprints:
-        burndown = get_sprint_burndown(sprint)
-        title = "credits: false, title: {text:'Burndown Chart'}, subtitle: {text: '%s'}" % sprint.nombre
-        series = "series:[{name: 'Ideal', data: %s}, {name: 'Real', data: %s}]" % (burndown['ideal'], burndown['real'], )
-        infile = "{ %s }" % ",".join([title, xAxis, yAxis, series])
-        d = {'infile': infile}
-        pdata = json.dumps(d)
-        #print pdata
-        r = requests.post(export_url, data=pdata, headers={'Content-Type': 'application/json'}, timeout=5)
-        graficos.append(r.content)
-
-    return graficos
+    """
+    Genera los burndown charts de todos los sprints del proyecto.
+    Por defecto se dibujan como SVG en el mismo proceso; con BURNDOWN_CHART_RENDERER = 'highcharts'
+    se usa el servidor de exportacion de Highcharts, con los graficos exportados en paralelo.
+
+    :param project: proyecto del cual se generan los graficos
+    :return: lista de imagenes como data URI, una por sprint; None si no se pudo generar
+    """
+    burndowns = get_project_burndown(project)['burndowns']
+    return charts.graficos_burndown([(burndown, sprint.nombre) for sprint, burndown in burndowns])
+
+def get_backlog_producto(project):
+    """
+    Datos del reporte de backlog del proyecto: los user stories agrupados por estado con sus horas
+    estimadas y registradas. Los user stories se obtienen con una sola consulta ordenada y se reparten por
+    estado en memoria; las sumas por estado salen de las estadisticas del proyecto.
+
+    :param project: proyecto del reporte
+    :return: contexto del template reportes/backlog_producto.html
+    """
+    por_estado = dict((estado, []) for estado, nombre in UserStory.estado_choices)
+    user_stories = project.userstory_set.select_related('desarrollador', 'sprint', 'actividad__flujo')\
+        .order_by('sprint__inicio', '-prioridad', 'tiempo_estimado')
+    for us in user_stories:
+        por_estado[us.estado].append(us)
+
+    horas = get_estadisticas(project)['horas_por_estado']
+    contexto = {'proyecto': project}
+    for estado, clave in [(4, 'cancelados'), (0, 'inactivos'), (1, 'en_curso'), (2, 'pendientes'), (3, 'aprobados')]:
+        contexto[clave] = por_estado[estado]
+        contexto['sum_' + clave], contexto['sum_%s_real' % clave] = horas[estado]
+    contexto['sum_proyecto'] = sum(estimado or 0 for estimado, registrado in horas.values())
+    contexto['sum_proyecto_real'] = sum(registrado or 0 for estimado, registrado in horas.values())
+    return contexto
+
+
+#Version de los templates y del codigo de los reportes; se incrementa al cambiar lo que muestran para
+#que no se sirvan los PDF guardados con la version anterior
+VERSION_REPORTES = 1
+
+def version_datos(userstories, notas, proyectos):
+    """
+    Calcula una version barata de los datos de un reporte: el ultimo cambio y la cantidad de sus user
+    stories y notas, con dos agregaciones, y las generaciones de los sprints, flujos, actividades, equipos
+    y usuarios de los proyectos indicados, que se renuevan al modificarlos (ver reports.invalidar_reportes).
+    Si cambia alguno de esos datos cambia la version.
+
+    :param userstories: user stories del reporte
+    :param notas: notas de esos user stories
+    :param proyectos: ids de los proyectos de esos user stories
+    :return: version como texto
+    """
+    us = userstories.aggregate(ultimo=Max('ultimo_cambio'), total=Count('id'))
+    nt = notas.aggregate(ultimo=Max('fecha'), total=Count('id'))
+    return repr((VERSION_REPORTES, us['ultimo'], us['total'], nt['ultimo'], nt['total']) +
+                reports.get_generaciones(proyectos))
+
+
+def version_proyecto(request, proyecto_id):
+    return version_datos(UserStory.objects.filter(proyecto_id=proyecto_id),
+                         Nota.objects.filter(user_story__proyecto_id=proyecto_id), [proyecto_id])
+
+
+def version_sprint(request, sprint_id):
+    sprint = Sprint.objects.filter(pk=sprint_id).select_related('proyecto').first()
+    #Sin permiso no se usa la cache, la vista rechaza el pedido
+    if sprint is None or 'view_project' not in get_permisos(request).get_perms(sprint.proyecto):
+        return None
+    return version_datos(sprint.userstory_set.all(), Nota.objects.filter(user_story__sprint_id=sprint_id),
+                         [sprint.proyecto_id])
+
+
+def version_usuario(request, user_id):
+    userstories = UserStory.objects.filter(desarrollador_id=user_id)
+    return version_datos(userstories, Nota.objects.filter(user_story__desarrollador_id=user_id),
+                         userstories.order_by().values_list('proyecto', flat=True).distinct())
+
+
+def reporte_cacheado(tipo, version):
+    """
+    Decorador de las vistas de reportes que guarda el PDF generado. El etag del reporte se obtiene de la
+    version de sus datos: si el cliente ya tiene esa version se responde 304, y si el PDF de esa version
+    esta en la cache se devuelve sin ejecutar la vista ni WeasyPrint, aun cuando se pidio con ?async=1.
+
+    :param tipo: tipo de reporte, parte de la clave de la cache
+    :param version: funcion (request, *args, **kwargs) que devuelve la version de los datos o None
+    :return: decorador
+    """
+    def etag(request, *args, **kwargs):
+        #Se calcula una sola vez por pedido, la usan condition y la cache
+        if not hasattr(request, '_etag_reporte'):
+            datos = version(request, *args, **kwargs)
+            request._etag_reporte = hashlib.sha1('%s:%s' % (tipo, datos)).hexdigest() if datos else None
+        return request._etag_reporte
+
+    def decorator(view):
+        @condition(etag_func=etag)
+        @wraps(view)
+        def _view(request, *args, **kwargs):
+            clave = etag(request, *args, **kwargs)
+            if clave is None or not reports.cache_reportes.directorio:
+                return view(request, *args, **kwargs)
+            objetivo = '-'.join([tipo] + [str(a) for a in args] + [str(kwargs[k]) for k in sorted(kwargs)])
+            pdf = reports.cache_reportes.get(objetivo, clave)
+            if pdf is not None:
+                #tambien con ?async=1: el PDF ya esta generado y no hace falta crear un trabajo
+                return reports.respuesta_pdf(pdf)
+            #con ?async=1 el trabajo guarda el PDF en la cache al terminar
+            request._cache_reporte = (objetivo, clave)
+            response = view(request, *args, **kwargs)
+            archivo = getattr(response, 'archivo_pdf', None)
+            if response.status_code == 200 and archivo is not None:
+                return reports.respuesta_pdf(reports.cache_reportes.set(objetivo, clave, archivo))
+            return response
+        return _view
+    return decorator
+
 
 @login_required
 @permission_required('project.view_project', (Proyecto, 'id', 'proyecto_id'))
+@reporte_cacheado('backlog_producto', version_proyecto)
 def reporte_backlog_producto(request, proyecto_id):
     project = get_object_or_404(Proyecto, id=proyecto_id)
-    us_set_cancelados = project.userstory_set.filter(estado=4).order_by('sprint__inicio', '-prioridad')
-    cancelados_sum = us_set_cancelados.aggregate(sum=Sum('tiempo_estimado'))['sum']
-    cancelados_real_sum = us_set_cancelados.aggregate(sum=Sum('tiempo_registrado'))['sum']
-    us_set_inactivos = project.userstory_set.filter(estado=0).order_by('sprint__inicio', '-prioridad', 'tiempo_estimado')
-    inactivos_sum = us_set_inactivos.aggregate(sum=Sum('tiempo_estimado'))['sum']
-    inactivos_real_sum = us_set_inactivos.aggregate(sum=Sum('tiempo_registrado'))['sum']
-    us_set_curso = project.userstory_set.filter(estado=1).order_by('sprint__inicio', '-prioridad')
-    encurso_sum = us_set_curso.aggregate(sum=Sum('tiempo_estimado'))['sum']
-    encurso__real_sum = us_set_curso.aggregate(sum=Sum('tiempo_registrado'))['sum']
-    us_set_pendientes = project.userstory_set.filter(estado=2).order_by('sprint__inicio', '-prioridad', 'tiempo_estimado')
-    pendientes_sum = us_set_pendientes.aggregate(sum=Sum('tiempo_estimado'))['sum']
-    pendientes_real_sum = us_set_pendientes.aggregate(sum=Sum('tiempo_registrado'))['sum']
-    us_set_aprobados = project.userstory_set.filter(estado=3).order_by('sprint__inicio', '-prioridad')
-    aprobados_sum = us_set_aprobados.aggregate(sum=Sum('tiempo_estimado'))['sum']
-    aprobados_real_sum = us_set_aprobados.aggregate(sum=Sum('tiempo_registrado'))['sum']
-    proyecto_sum = (cancelados_sum if cancelados_sum else 0) + (inactivos_sum if inactivos_sum else 0) + (encurso_sum if encurso_sum else 0) + (pendientes_sum if pendientes_sum else 0) + (aprobados_sum if aprobados_sum else 0)
-    proyecto_sum_real = (cancelados_real_sum if cancelados_real_sum else 0) + (inactivos_real_sum if inactivos_real_sum else 0)+ (encurso__real_sum if encurso__real_sum else 0) + (pendientes_real_sum if pendientes_real_sum else 0) + (aprobados_real_sum if aprobados_real_sum else 0)
-    contexto = {'proyecto': project, 'cancelados': us_set_cancelados,
-                'inactivos': us_set_inactivos, 'en_curso': us_set_curso, 'pendientes': us_set_pendientes,
-                'aprobados': us_set_aprobados, 'sum_inactivos': inactivos_sum, 'sum_inactivos_real': inactivos_real_sum,
-                'sum_en_curso': encurso_sum, 'sum_en_curso_real': encurso__real_sum, 'sum_cancelados': cancelados_sum,
-                'sum_cancelados_real': cancelados_real_sum, 'sum_aprobados': aprobados_sum, 'sum_aprobados_real': aprobados_real_sum,
-                'sum_pendientes': pendientes_sum, 'sum_pendientes_real': pendientes_real_sum, 'sum_proyecto': proyecto_sum,
-                'sum_proyecto_real': proyecto_sum_real}
-    template = get_template('reportes/backlog_producto.html')
-    html = template.render(RequestContext(request, contexto))
-    response = HttpResponse(content_type="application/pdf")
-    weasyprint.HTML(string=html, base_url=request.build_absolute_uri(), url_fetcher=url_fetcher).write_pdf(response)
-    return response
+    contexto = get_backlog_producto(project)
+    return render_pdf(request, 'reportes/backlog_producto.html', contexto, u'Backlog del Proyecto %s' % project)
 
 @login_required
 @permission_required('project.view_project', (Proyecto, 'id', 'proyecto_id'))
+@reporte_cacheado('equipo_proyecto', version_proyecto)
 def reporte_equipo_proyecto(request, proyecto_id):
     project = get_object_or_404(Proyecto, id=proyecto_id)
     equipo = project.miembroequipo_set.all()
@@ -102,24 +190,13 @@ def reporte_equipo_proyecto(request, proyecto_id):
             us_sets.append(us_set)
 
     contexto = {'proyecto': project, 'equipo': equipo, 'sets': us_sets}
-    template = get_template('reportes/equipo_proyecto.html')
-    html = template.render(RequestContext(request, contexto))
-    response = HttpResponse(content_type="application/pdf")
-    weasyprint.HTML(string=html, base_url=request.build_absolute_uri(), url_fetcher=url_fetcher).write_pdf(response)
-    return response
+    return render_pdf(request, 'reportes/equipo_proyecto.html', contexto, u'Trabajo en curso del Equipo %s' % project)
 
 @login_required
 @permission_required('project.view_project', (Proyecto, 'id', 'proyecto_id'))
 def html_reporte_backlog_producto(request, proyecto_id):
     project = get_object_or_404(Proyecto, id=proyecto_id)
-    us_set_cancelados = project.userstory_set.filter(estado=4).order_by('sprint__inicio', '-prioridad')
-    us_set_inactivos = project.userstory_set.filter(estado=0).order_by('sprint__inicio', '-prioridad')
-    us_set_curso = project.userstory_set.filter(estado=1).order_by('sprint__inicio', '-prioridad')
-    us_set_pendientes = project.userstory_set.filter(estado=2).order_by('sprint__inicio', '-prioridad')
-    us_set_aprobados = project.userstory_set.filter(estado=3).order_by('sprint__inicio', '-prioridad')
-    contexto = {'proyecto': project, 'cancelados': us_set_cancelados,
-                'inactivos': us_set_inactivos, 'en_curso': us_set_curso, 'pendientes': us_set_pendientes,
-                'aprobados': us_set_aprobados}
+    contexto = get_backlog_producto(project)
     template = get_template('reportes/backlog_producto.html')
     html = template.render(RequestContext(request, contexto))
     response = HttpResponse(content_type="application/pdf")
@@ -130,34 +207,28 @@ def html_reporte_backlog_producto(request, proyecto_id):
 @permission_required('project.view_project', (Proyecto, 'id', 'proyecto_id'))
 def reporte_burndown(request, proyecto_id):
     project = get_object_or_404(Proyecto, id=proyecto_id)
-    try:
-        graficos = get_graficos(project)
-    except requests.ConnectionError:
+    graficos = get_graficos(project)
+    if graficos and not any(graficos):
+        #Fallaron todos los graficos: el servidor de exportacion no esta disponible
         return render(request, 'reportes/export_error.html', {})
     contexto = {'proyecto': project, 'graph':graficos}
-    template = get_template('reportes/burndown.html')
-    html = template.render(RequestContext(request, contexto))
-    response = HttpResponse(content_type="application/pdf")
-    weasyprint.HTML(string=html, base_url=request.build_absolute_uri(), url_fetcher=url_fetcher).write_pdf(response)
-    return response
+    return render_pdf(request, 'reportes/burndown.html', contexto, u'Estado del Proyecto %s' % project)
 
 @login_required
+@reporte_cacheado('backlog_sprint', version_sprint)
 def reporte_backlog_sprint(request, sprint_id):
 
     sprint = get_object_or_404(Sprint, id=sprint_id)
     #Comprobamos el permiso manualmente
-    if 'view_project' in get_perms(request.user, sprint.proyecto):
+    if 'view_project' in get_permisos(request).get_perms(sprint.proyecto):
         us_set = sprint.userstory_set.all()
         contexto = {'sprint': sprint, 'user_stories': us_set}
-        template = get_template('reportes/backlog_sprint.html')
-        html = template.render(RequestContext(request, contexto))
-        response = HttpResponse(content_type="application/pdf")
-        weasyprint.HTML(string=html, base_url=request.build_absolute_uri(), url_fetcher=url_fetcher).write_pdf(response)
-        return response
+        return render_pdf(request, 'reportes/backlog_sprint.html', contexto, u'Backlog del %s' % sprint)
     else:
         raise PermissionDenied()
 
 @login_required
+@reporte_cacheado('userstories_user', version_usuario)
 def reporte_userstories_user(request, user_id):
     usuario = get_object_or_404(User, id=user_id)
     us_pendientes = usuario.userstory_set.filter(estado=0)
@@ -165,14 +236,11 @@ def reporte_userstories_user(request, user_id):
     us_finalizados = usuario.userstory_set.filter(estado=3)
     contexto = {'usuario': usuario, 'pendientes': us_pendientes,
                 'en_curso': us_encurso, 'finalizados':us_finalizados}
-    template = get_template('reportes/userstories_user.html')
-    html = template.render(RequestContext(request, contexto))
-    response = HttpResponse(content_type="application/pdf")
-    weasyprint.HTML(string=html, base_url=request.build_absolute_uri(), url_fetcher=url_fetcher).write_pdf(response)
-    return response
+    return render_pdf(request, 'reportes/userstories_user.html', contexto, u'User Stories de %s' % usuario)
 
 @login_required
 @permission_required('project.view_project', (Proyecto, 'id', 'proyecto_id'))
+@reporte_cacheado('lista_priorizada', version_proyecto)
 def reporte_lista_priorizada(request, proyecto_id):
     proyecto = get_object_or_404(Proyecto, id=proyecto_id)
     us_bajo = proyecto.userstory_set.filter(prioridad=0).order_by('sprint__inicio')
@@ -180,9 +248,36 @@ def reporte_lista_priorizada(request, proyecto_id):
     us_alto = proyecto.userstory_set.filter(prioridad=2).order_by('sprint__inicio')
     contexto = {'proyecto': proyecto, 'bajos': us_bajo,
                 'medios': us_medio, 'altos':us_alto}
-    template = get_template('reportes/userstories_priorizados.html')
-    html = template.render(RequestContext(request, contexto))
-    response = HttpResponse(content_type="application/pdf")
-    weasyprint.HTML(string=html, base_url=request.build_absolute_uri(), url_fetcher=url_fetcher).write_pdf(response)
-    return response
+    return render_pdf(request, 'reportes/userstories_priorizados.html', contexto, u'User Stories priorizados del Proyecto %s' % proyecto)
+
+
+@login_required
+def report_job(request, pk):
+    """
+    Pagina de estado de un reporte generado en segundo plano.
+    """
+    job = get_object_or_404(ReportJob, pk=pk, usuario=request.user)
+    return render(request, 'reportes/report_job.html', {'job': job})
+
 
+@login_required
+def report_job_status(request, pk):
+    """
+    Estado de un reporte generado en segundo plano, en JSON, para consultarlo periodicamente.
+    """
+    job = get_object_or_404(ReportJob, pk=pk, usuario=request.user)
+    return JsonResponse({'estado': job.estado, 'descripcion': job.get_estado_display(), 'error': job.error,
+                         'descarga': unicode(job.get_download_url()) if job.estado == ReportJob.TERMINADO else None})
+
+
+@login_required
+def report_job_download(request, pk):
+    """
+    Descarga del PDF de un reporte generado en segundo plano.
+    """
+    job = get_object_or_404(ReportJob, pk=pk, usuario=request.user, estado=ReportJob.TERMINADO)
+    try:
+        pdf = open(job.ruta(), 'rb')
+    except IOError:
+        raise Http404
+    return reports.respuesta_pdf(pdf, job.nombre)
@@ -17,7 +17,7 @@ class PlantillaList(LoginRequiredMixin, generic.ListView):
     model = Flujo
     template_name = 'project/plantilla/plantilla_list.html'
     context_object_name = 'plantillas'
-    queryset = Flujo.objects.filter(proyecto_id=None)
+    queryset = Flujo.objects.filter(proyecto_id=None).with_activity_counts()
 
 
 class PlantillaDetail(LoginRequiredMixin, generic.DetailView):
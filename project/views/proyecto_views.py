@@ -18,6 +18,7 @@ from django.views.generic.detail import SingleObjectTemplateResponseMixin
 from guardian.mixins import LoginRequiredMixin
 from guardian.shortcuts import remove_perm
 from guardian.shortcuts import get_perms
+from project.estadisticas import get_estadisticas
 from project.forms import MiembrosEquipoFormset
 from project.models import Proyecto
 from project.models import MiembroEquipo
@@ -57,14 +58,16 @@ class ProjectDetail(LoginRequiredMixin, GlobalPermissionRequiredMixin, DetailVie
 
     def get_context_data(self, **kwargs):
         context = super(ProjectDetail, self).get_context_data(**kwargs)
-        context['team'] = self.object.miembroequipo_set.all()
-        context['flows'] = self.object.flujo_set.all()
-        context['sprints'] = self.object.sprint_set.all()
-        context['total_us'] = self.object.userstory_set.all().count()
-        context['approved_us'] = self.object.userstory_set.filter(estado=3).count()
-        context['active_us'] = self.object.userstory_set.filter(estado=1).count()
-        context['pending_us'] = self.object.userstory_set.filter(estado=2).count()
-        context['failed_us'] = self.object.userstory_set.filter(estado=4).count()
+        context['team'] = self.object.miembroequipo_set.select_related('usuario').prefetch_related('roles')
+        context['flows'] = self.object.flujo_set.with_activity_counts()
+        context['sprints'] = self.object.sprint_set.with_story_counts()
+        estadisticas = get_estadisticas(self.object)
+        por_estado = estadisticas['por_estado']
+        context['total_us'] = estadisticas['total']
+        context['approved_us'] = por_estado[3]
+        context['active_us'] = por_estado[1]
+        context['pending_us'] = por_estado[2]
+        context['failed_us'] = por_estado[4]
         return context
 
 
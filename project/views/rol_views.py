@@ -5,11 +5,10 @@ from django.core.urlresolvers import reverse_lazy
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect
 from django.views import generic
+from django.db import transaction
 from guardian.mixins import LoginRequiredMixin
-from guardian.shortcuts import remove_perm
-from guardian.shortcuts import get_perms
 from project.forms import RolForm
-from project.models import UserStory
+from project.permissions import sincronizar_permisos_roles
 from project.views import GlobalPermissionRequiredMixin
 from project.views import get_selected_perms
 from project.views import CreateViewPermissionRequiredMixin
@@ -106,31 +105,17 @@ class UpdateRolView(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.U
         :param form: formulario recibido
         :return: URL de redireccion correcta
         """
-        super(UpdateRolView, self).form_valid(form)
-        # eliminamos permisos anteriores
-        self.object.permissions.clear()
-        escogidas = get_selected_perms(self.request.POST)
-        for permname in escogidas:
-            perm = Permission.objects.get(codename=permname)
-            self.object.permissions.add(perm)
-        # actualizamos los permisos de los miembros de equipos que tienen este rol
-        team_members_set = self.object.miembroequipo_set.all()
-        for team_member in team_members_set:
-            user = team_member.usuario
-            project = team_member.proyecto
-            # borramos todos los permisos que tiene asociado el usuario en el proyecto
-            for perm in get_perms(user, project):
-                if perm!='view_project': #cuidamos de no eliminar permiso de ver proyecto
-                    remove_perm(perm, user, project)
-            #borramos todos los permisos que tiene asociado el usuario a los User Stories del proyecto
-            for us in UserStory.objects.filter(desarrollador=user, proyecto=project):
-                for perm in get_perms(user, us):
-                    remove_perm(perm, user, us)
-
-            all_roles = team_member.roles.all()
-            for role in all_roles:
-                team_member.roles.remove(role)  #desacociamos al usuario de los demas roles con los que contaba (para que se eliminen los permisos anteriores)
-                team_member.roles.add(role)  #volvemos a agregar para que se copien los permisos actualizados
+        # el rol y los permisos de sus miembros se actualizan juntos: si falla la sincronizacion no cambia nada
+        with transaction.atomic():
+            super(UpdateRolView, self).form_valid(form)
+            # eliminamos permisos anteriores
+            self.object.permissions.clear()
+            escogidas = get_selected_perms(self.request.POST)
+            for permname in escogidas:
+                perm = Permission.objects.get(codename=permname)
+                self.object.permissions.add(perm)
+            # actualizamos los permisos de los miembros de equipos que tienen este rol
+            sincronizar_permisos_roles(self.object.miembroequipo_set.values_list('pk', flat=True))
         return HttpResponseRedirect(self.get_success_url())
 
 
@@ -154,28 +139,12 @@ class DeleteRolView(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.D
         '''
         self.object = self.get_object()
         success_url = self.get_success_url()
-        miembroequipo_set = self.object.miembroequipo_set
-
-        # actualizamos los permisos de los miembros de equipos que tienen este rol
-        team_members_set = miembroequipo_set.all()
-        self.object.delete()
-        for team_member in team_members_set:
-            print('team_member')
-            user = team_member.usuario
-            project = team_member.proyecto
-            #borramos todos los permisos que tiene asociado el usuario en el proyecto
-            for perm in get_perms(user, project):
-                if perm != 'view_project':
-                    remove_perm(perm, user, project)
-            #borramos todos los permisos que tiene asociado el usuario a los User Stories del proyecto
-            for us in UserStory.objects.filter(desarrollador=user, proyecto=project):
-                for perm in get_perms(user, us):
-                    remove_perm(perm, user, us)
-
-            other_roles = team_member.roles.all()
-            for role in other_roles:
-                team_member.roles.remove(role)  #desacociamos al usuario de los demas roles con los que contaba (para que se eliminen los permisos anteriores)
-                team_member.roles.add(role)  #volvemos a agregar para que se copien los permisos actualizados
+        # miembros de equipos que tienen este rol, obtenidos antes de eliminarlo
+        team_members = list(self.object.miembroequipo_set.values_list('pk', flat=True))
+        with transaction.atomic():
+            self.object.delete()
+            # actualizamos sus permisos con los roles que les quedan
+            sincronizar_permisos_roles(team_members)
 
         return HttpResponseRedirect(success_url)
 
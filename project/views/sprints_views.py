@@ -8,10 +8,11 @@ from django.http import HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
 from django.template import RequestContext
 from guardian.mixins import LoginRequiredMixin
-from guardian.shortcuts import get_perms
 from project.forms import AddToSprintForm, AddToSprintFormset, AddSprintBaseForm
 from project.models import Sprint, Proyecto, Actividad, Flujo, UserStory
-from project.views import CreateViewPermissionRequiredMixin, GlobalPermissionRequiredMixin, ActiveProjectRequiredMixin
+from project.permissions import get_permisos
+from project.views import CreateViewPermissionRequiredMixin, GlobalPermissionRequiredMixin, ActiveProjectRequiredMixin, \
+    CachedObjectMixin
 from django.views import generic
 from django.core.urlresolvers import reverse
 from django.utils import timezone
@@ -44,7 +45,7 @@ class SprintList(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.List
         :return: retorna el contexto
         """
         context = super(SprintList, self).get_context_data(**kwargs)
-        context['proyecto_perms'] = get_perms(self.request.user, self.project)
+        context['proyecto_perms'] = get_permisos(self.request).get_perms(self.project)
         return context
 
     def get_queryset(self):
@@ -54,13 +55,14 @@ class SprintList(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.List
         """
         project_pk = self.kwargs['project_pk']
         self.project = get_object_or_404(Proyecto, pk=project_pk)
-        return Sprint.objects.filter(proyecto=self.project)
+        return Sprint.objects.filter(proyecto=self.project).with_story_counts()
 
-class SprintDetail(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.DetailView):
+class SprintDetail(LoginRequiredMixin, GlobalPermissionRequiredMixin, CachedObjectMixin, generic.DetailView):
     """
     Vista del detalle de un Sprint en el sistema
     """
     model = Sprint
+    select_related = ('proyecto',)
     permission_required = 'project.view_project'
     template_name = 'project/sprint/sprint_detail.html'
     context_object_name = 'sprint'
@@ -182,11 +184,12 @@ class AddSprintView(ActiveProjectRequiredMixin, LoginRequiredMixin, CreateViewPe
             return HttpResponseRedirect(self.get_success_url())
 
 
-class UpdateSprintView(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.UpdateView):
+class UpdateSprintView(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPermissionRequiredMixin, CachedObjectMixin, generic.UpdateView):
     """
     Vista para actualizar los datos del Sprint y  del UserStory que son el desarrollador, la actividad y el Sprint
     """
     model = Sprint
+    select_related = ('proyecto',)
     permission_required = 'project.edit_sprint'
     template_name = 'project/sprint/sprint_form.html'
     form_class = modelform_factory(Sprint,form=AddSprintBaseForm,
@@ -224,7 +227,7 @@ class UpdateSprintView(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPer
         :return: los datos de contexto
         """
         context= super(UpdateSprintView,self).get_context_data(**kwargs)
-        current_us = self.get_object().userstory_set.all()
+        current_us = self.get_object().userstory_set.select_related('actividad__flujo', 'desarrollador')
         formset= self.UserStoryFormset(self.request.POST if self.request.method == 'POST' else None, initial=[{'userStory':us, 'flujo':us.actividad.flujo, 'desarrollador':us.desarrollador} for us in current_us])
         self.__filtrar_formset__(formset)
         context['current_action'] = 'Editar'
@@ -5,7 +5,6 @@ from django.core.mail import send_mail
 from django.core.urlresolvers import reverse, reverse_lazy
 from django.forms.models import modelform_factory, inlineformset_factory, modelformset_factory
 from django.http import HttpResponseRedirect, HttpResponseForbidden, Http404
-from django.db import transaction
 from django.shortcuts import get_object_or_404, render
 from django.template.loader import get_template, render_to_string
 from django.utils import timezone
@@ -13,12 +12,15 @@ from django.views import generic
 from django.views.generic import detail
 from django.views.generic.detail import SingleObjectTemplateResponseMixin
 from guardian.mixins import LoginRequiredMixin
-from guardian.shortcuts import get_perms, get_perms_for_model, assign_perm
+from guardian.shortcuts import get_perms_for_model, assign_perm
 from guardian.utils import get_403_or_None
 import reversion
+from project import estadisticas
 from project.forms import RegistrarActividadForm
 from project.models import UserStory, Proyecto, MiembroEquipo, Sprint, Actividad, Nota
-from project.views import CreateViewPermissionRequiredMixin, GlobalPermissionRequiredMixin, ActiveProjectRequiredMixin
+from project.permissions import get_permisos
+from project.views import CreateViewPermissionRequiredMixin, GlobalPermissionRequiredMixin, ActiveProjectRequiredMixin, \
+    UserStoryObjectMixin
 from django.contrib.sites.shortcuts import get_current_site
 
 
@@ -39,7 +41,7 @@ class UserStoriesList(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic
 
     def get_context_data(self, **kwargs):
         context = super(UserStoriesList, self).get_context_data(**kwargs)
-        context['proyecto_perms'] = get_perms(self.request.user, self.project)
+        context['proyecto_perms'] = get_permisos(self.request).get_perms(self.project)
         return context
 
     def get_queryset(self):
@@ -58,7 +60,7 @@ class ApprovalPendingUserStories(UserStoriesList):
             self.project = get_object_or_404(Proyecto, pk=self.kwargs['project_pk'])
         return manager.filter(proyecto=self.project, estado=2)
 
-class UserStoryDetail(LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.DetailView):
+class UserStoryDetail(LoginRequiredMixin, GlobalPermissionRequiredMixin, UserStoryObjectMixin, generic.DetailView):
     """
     Vista de Detalles de un user story
     """
@@ -94,7 +96,7 @@ class AddUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, CreateViewPer
     def get_form_class(self):
         project = get_object_or_404(Proyecto, id=self.kwargs['project_pk'])
         form_fields = ['nombre', 'descripcion', 'valor_negocio', 'valor_tecnico', 'tiempo_estimado']
-        if 'prioritize_userstory' in get_perms(self.request.user, project):
+        if 'prioritize_userstory' in get_permisos(self.request).get_perms(project):
             form_fields.insert(2, 'prioridad')
         form_class = modelform_factory(UserStory, fields=form_fields)
         return form_class
@@ -121,14 +123,14 @@ class AddUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, CreateViewPer
         self.object.proyecto = self.get_proyecto()
         self.object.proyecto.estado = 'EP'
         self.object.proyecto.save()
-        with transaction.atomic(), reversion.create_revision():
+        with estadisticas.transaccion(), reversion.create_revision():
             reversion.set_user(self.request.user)
             reversion.set_comment("Version Inicial")
             self.object.save()
 
         return HttpResponseRedirect(self.get_success_url())
 
-class UpdateUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, generic.UpdateView):
+class UpdateUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, UserStoryObjectMixin, generic.UpdateView):
     """
     View que actualiza un user story del sistema
     """
@@ -146,9 +148,9 @@ class UpdateUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, generic.Up
         :param kwargs: argumentos adicionales en forma de diccionario
         :return: PermissionDenied si el usuario no cuenta con permisos
         """
-        if 'edit_userstory' in get_perms(request.user, self.get_object().proyecto):
+        if 'edit_userstory' in get_permisos(request).get_perms(self.get_object().proyecto):
             return super(UpdateUserStory, self).dispatch(request, *args, **kwargs)
-        elif 'edit_my_userstory' in get_perms(self.request.user, self.get_object()):
+        elif 'edit_my_userstory' in get_permisos(self.request).get_perms(self.get_object()):
             return super(UpdateUserStory, self).dispatch(request, *args, **kwargs)
         else:
             raise PermissionDenied()
@@ -156,7 +158,7 @@ class UpdateUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, generic.Up
     def get_form_class(self):
         project = self.get_object().proyecto
         form_fields = ['nombre', 'descripcion', 'valor_negocio', 'valor_tecnico', 'tiempo_estimado']
-        if 'prioritize_userstory' in get_perms(self.request.user, project):
+        if 'prioritize_userstory' in get_permisos(self.request).get_perms(project):
             form_fields.insert(2, 'prioridad')
         form_class = modelform_factory(UserStory, fields=form_fields)
         return form_class
@@ -184,7 +186,7 @@ class UpdateUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, generic.Up
         :return: URL de redireccion
         """
         if form.has_changed():
-            with transaction.atomic(), reversion.create_revision():
+            with estadisticas.transaccion(), reversion.create_revision():
                 self.object = form.save()
                 reversion.set_user(self.request.user)
                 reversion.set_comment("Modificacion: {}".format(str.join(', ', form.changed_data)))
@@ -249,7 +251,7 @@ class CancelUserStory(LoginRequiredMixin, ActiveProjectRequiredMixin, generic.Fo
         return HttpResponseRedirect(self.get_success_url())
 
 
-class RegistrarActividadUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, generic.UpdateView):
+class RegistrarActividadUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, UserStoryObjectMixin, generic.UpdateView):
     """
     View que permite registrar los cambios aplicados a un user story
     """
@@ -275,8 +277,8 @@ class RegistrarActividadUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin
         :param kwargs: argumentos adicionales en forma de diccionario
         :return: PermissionDenied si el usuario no cuenta con permisos
         """
-        if 'registraractividad_userstory' in get_perms(request.user, self.get_object().proyecto) \
-                or ('registraractividad_my_userstory' in get_perms(request.user, self.get_object())): #Comprobacion de permisos
+        if 'registraractividad_userstory' in get_permisos(request).get_perms(self.get_object().proyecto) \
+                or ('registraractividad_my_userstory' in get_permisos(request).get_perms(self.get_object())): #Comprobacion de permisos
             if self.get_object().sprint and self.get_object().sprint.inicio.date() <= timezone.now().date() and self.get_object().sprint.fin.date() >= timezone.now().date():
                 if self.get_object().actividad:
                     current_priority = self.get_object().prioridad
@@ -299,8 +301,8 @@ class RegistrarActividadUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin
         del User Story.
         """
         actual_fields = ['estado_actividad']
-        if 'edit_userstory' in get_perms(self.request.user, self.get_object().proyecto) or \
-                        'edit_my_userstory' in get_perms(self.request.user, self.get_object()):
+        if 'edit_userstory' in get_permisos(self.request).get_perms(self.get_object().proyecto) or \
+                        'edit_my_userstory' in get_permisos(self.request).get_perms(self.get_object()):
             actual_fields.insert(1, 'actividad')
         return modelform_factory(UserStory, form=RegistrarActividadForm, fields=actual_fields)
 
@@ -359,7 +361,7 @@ class RegistrarActividadUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin
         send_mail(subject, message, 'noreply.projectium15@gmail.com', recipients, html_message=message)
 
 
-class DeleteUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPermissionRequiredMixin, generic.DeleteView):
+class DeleteUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPermissionRequiredMixin, UserStoryObjectMixin, generic.DeleteView):
     """
     Vista de Eliminacion de User Stories
     """
@@ -380,7 +382,7 @@ class DeleteUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPerm
 
 
 
-class ApproveUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPermissionRequiredMixin, SingleObjectTemplateResponseMixin, detail.BaseDetailView):
+class ApproveUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPermissionRequiredMixin, UserStoryObjectMixin, SingleObjectTemplateResponseMixin, detail.BaseDetailView):
     """
     Vista de Aprobación de User Story
     """
@@ -437,7 +439,7 @@ class ApproveUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, GlobalPer
         send_mail(subject, message, 'projectium15@gamil.com', recipients, html_message=message)
 
 
-class RechazarUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, generic.UpdateView):
+class RechazarUserStory(ActiveProjectRequiredMixin, LoginRequiredMixin, UserStoryObjectMixin, generic.UpdateView):
     model = UserStory
     template_name = 'project/userstory/userstory_rechazar.html'
     fields = ['actividad', 'estado_actividad']
@@ -504,9 +506,9 @@ class VersionList(LoginRequiredMixin, generic.ListView):
         :return: PermissionDenied si el usuario no cuenta con permisos
         """
         self.us = get_object_or_404(UserStory, pk=self.kwargs['pk'])
-        if 'edit_userstory' in get_perms(request.user, self.us.proyecto):
+        if 'edit_userstory' in get_permisos(request).get_perms(self.us.proyecto):
             return super(VersionList, self).dispatch(request, *args, **kwargs)
-        elif 'edit_my_userstory' in get_perms(self.request.user, self.us):
+        elif 'edit_my_userstory' in get_permisos(self.request).get_perms(self.us):
             return super(VersionList, self).dispatch(request, *args, **kwargs)
         else:
             raise PermissionDenied()
@@ -548,7 +550,7 @@ class UpdateVersion(UpdateUserStory):
         :param form: formulario recibido
         :return: URL de redireccion
         """
-        with transaction.atomic(), reversion.create_revision():
+        with estadisticas.transaccion(), reversion.create_revision():
             self.object = form.save()
             reversion.set_user(self.request.user)
             # rev = self.version.revision
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import copy
 from datetime import timedelta
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
@@ -8,11 +9,14 @@ from django.forms.models import modelform_factory
 from django.http import HttpResponseRedirect, HttpResponse
 from django.shortcuts import render
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
 from django.views import generic
 from django.views.generic.detail import SingleObjectMixin
 from guardian.mixins import PermissionRequiredMixin, LoginRequiredMixin
 from guardian.admin import *;
+from guardian.utils import get_403_or_None
 from project.models import MiembroEquipo, Proyecto, UserStory, Adjunto, Nota, Sprint, Flujo
+from project.permissions import get_permisos
 from random import randint
 
 
@@ -24,6 +28,49 @@ class GlobalPermissionRequiredMixin(PermissionRequiredMixin):
     return_403 = True
     raise_exception = True
 
+    def check_permissions(self, request):
+        """
+        Comprueba los permisos requeridos, primero como permisos globales y luego sobre el objeto, con los
+        permisos del usuario cargados una vez por request.
+        :param request: request del cliente
+        :return: PermissionDenied si el usuario no cuenta con permisos
+        """
+        obj = self.get_permission_object()
+        forbidden = get_403_or_None(request_con_permisos(request), perms=self.get_required_permissions(request),
+                                    obj=obj, login_url=self.login_url, redirect_field_name=self.redirect_field_name,
+                                    return_403=self.return_403, accept_global_perms=self.accept_global_perms)
+        if forbidden:
+            self.on_permission_check_fail(request, forbidden, obj=obj)
+            if self.raise_exception:
+                raise PermissionDenied()
+        return forbidden
+
+
+class UsuarioConPermisos(SimpleLazyObject):
+    """
+    Usuario del request cuyo has_perm se responde con los permisos cargados una vez por request
+    (get_permisos). El resto de los atributos son los del usuario.
+    """
+
+    def __init__(self, request):
+        super(UsuarioConPermisos, self).__init__(lambda: request.user)
+        self.__dict__['_permisos'] = get_permisos(request)
+
+    def has_perm(self, perm, obj=None):
+        return self._permisos.has_perm(perm, obj)
+
+
+def request_con_permisos(request):
+    """
+    Copia del request con un UsuarioConPermisos, para que las funciones de guardian, como get_403_or_None,
+    comprueben los permisos sin consultar la base de datos y armen la respuesta segun su configuracion.
+    :param request: request del cliente
+    :return: copia del request
+    """
+    copia = copy.copy(request)
+    copia.user = UsuarioConPermisos(request)
+    return copia
+
 
 class CreateViewPermissionRequiredMixin(GlobalPermissionRequiredMixin):
     '''
@@ -34,6 +81,31 @@ class CreateViewPermissionRequiredMixin(GlobalPermissionRequiredMixin):
         return None
 
 
+class CachedObjectMixin(object):
+    '''
+    Mixin que obtiene el objeto de la vista una sola vez por request. Las vistas llaman a get_object
+    varias veces (comprobacion de permisos, proyecto activo, formulario), y cada llamada era una consulta.
+    '''
+    select_related = ()  # Relaciones que se obtienen junto con el objeto
+
+    def get_object(self, queryset=None):
+        if queryset is not None:
+            return super(CachedObjectMixin, self).get_object(queryset)
+        if getattr(self, '_cached_object', None) is None:
+            queryset = self.get_queryset()
+            if self.select_related:
+                queryset = queryset.select_related(*self.select_related)
+            self._cached_object = super(CachedObjectMixin, self).get_object(queryset)
+        return self._cached_object
+
+
+class UserStoryObjectMixin(CachedObjectMixin):
+    '''
+    Mixin para las vistas de un user story, con las relaciones que usan sus comprobaciones
+    '''
+    select_related = ('proyecto', 'sprint', 'actividad__flujo', 'desarrollador')
+
+
 class ActiveProjectRequiredMixin(object):
     proyecto = None
 
@@ -117,6 +117,57 @@ EMAIL_HOST_USER = 'user@domain.com'
 EMAIL_HOST_PASSWORD = 'password'
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
+# Graficos de los reportes en PDF: 'svg' los dibuja en el proceso, 'highcharts' usa el servidor de
+# exportacion de Highcharts (highchart-export/highcharts-convert.js) en HIGHCHARTS_EXPORT_URL, con hasta
+# HIGHCHARTS_EXPORT_WORKERS graficos en paralelo y HIGHCHARTS_EXPORT_TIMEOUT segundos por grafico
+BURNDOWN_CHART_RENDERER = 'svg'
+HIGHCHARTS_EXPORT_URL = 'http://127.0.0.1:3003'
+HIGHCHARTS_EXPORT_WORKERS = 4
+HIGHCHARTS_EXPORT_TIMEOUT = 5
+# Cache en disco de los graficos generados; None la desactiva
+CHART_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'graficos')
+CHART_CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+# Reportes en PDF generados en segundo plano (?async=1): directorio de los PDF y cantidad de hilos que
+# los generan; con 0 se generan en el mismo pedido
+REPORT_ROOT = os.path.join(BASE_DIR, 'reportes_generados')
+REPORT_WORKERS = 2
+# Segundos que se guardan los trabajos terminados y sus PDF, y segundos luego de los cuales un trabajo
+# pendiente o en generacion se considera interrumpido (por ejemplo por un reinicio del servidor)
+REPORT_JOB_MAX_AGE = 7 * 24 * 60 * 60
+REPORT_JOB_TIMEOUT = 60 * 60
+# Los PDF de hasta este tamano se generan en memoria, los mas grandes en un archivo temporal
+REPORT_SPOOL_MAX_BYTES = 1024 * 1024
+# Cache en disco de los PDF de los reportes, invalidada por la version de los datos; None la desactiva
+REPORT_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'reportes')
+
+# Los avisos de la aplicacion (por ejemplo un reporte que no se pudo guardar en la cache) se muestran
+# en la consola
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {'console': {'class': 'logging.StreamHandler'}},
+    'loggers': {'project': {'handlers': ['console'], 'level': 'WARNING'}},
+}
+
+# Almacen del contenido de los archivos adjuntos
+ATTACHMENT_STORAGE = {
+    'BACKEND': 'project.storage.FileSystemBlobStore',
+    'OPTIONS': {'location': os.path.join(BASE_DIR, 'adjuntos')},
+}
+# Tamano maximo de un adjunto y tamano de los bloques con los que se escriben y se envian
+ATTACHMENT_MAX_SIZE = 20 * 1024 * 1024
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+# Miniaturas y vistas previas de los adjuntos de tipo imagen: tamano maximo (ancho, alto) de cada una y
+# directorio donde se guardan una vez generadas
+ATTACHMENT_IMAGE_SIZES = {'miniatura': (200, 200), 'vista': (800, 800)}
+ATTACHMENT_DERIVATIVES_DIR = os.path.join(BASE_DIR, 'cache', 'adjuntos')
+# Segundos que el navegador puede reutilizar una miniatura sin volver a pedirla
+ATTACHMENT_IMAGE_MAX_AGE = 24 * 60 * 60
+# El comando clean_attachments elimina los contenidos y derivados que ningun adjunto usa y que no se
+# escribieron en los ultimos ATTACHMENT_ORPHAN_MIN_AGE segundos, para no tocar los de una subida en curso
+ATTACHMENT_ORPHAN_MIN_AGE = 24 * 60 * 60
+
 TEMPLATE_CONTEXT_PROCESSORS = (
     "django.contrib.auth.context_processors.auth",
     "django.core.context_processors.debug",
@@ -128,6 +179,28 @@ TEMPLATE_CONTEXT_PROCESSORS = (
     "project.context_processors.nav_context_processor",
 )
 
+# Cache de Django. El contexto de navegacion y las estadisticas de los proyectos se invalidan desde el
+# proceso que modifica los datos, por lo que la cache debe ser compartida por todos los procesos del
+# servidor: la cache en memoria por defecto (LocMemCache) es propia de cada proceso y los demas seguirian
+# sirviendo datos viejos. La cache en archivos se comparte entre los procesos de un mismo servidor; con
+# varios servidores se debe usar memcached.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'django'),
+    }
+}
+# Segundos que se guarda en la cache el contexto de navegacion de cada usuario; None lo desactiva
+NAV_CACHE_TIMEOUT = 300
+# Segundos que se guardan en la cache las estadisticas de cada proyecto; None las desactiva
+PROJECT_STATS_TIMEOUT = 60
+
 import sys
 if 'test' in sys.argv:
     DATABASES['default'] = {'ENGINE': 'django.db.backends.sqlite3'}
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    LOGGING['loggers']['project']['level'] = 'ERROR'
+    CHART_CACHE_DIR = None
+    REPORT_CACHE_DIR = None
+    NAV_CACHE_TIMEOUT = None
+    PROJECT_STATS_TIMEOUT = None